@@ -25,8 +25,8 @@ import atexit
 import collections
 import datetime
 import functools
+import numpy as np
 import operator
-import random
 import re
 import serial
 import serial_asyncio
@@ -36,6 +36,13 @@ import sys
 import time
 from serial.tools import list_ports
 
+from ieapspect.eventlog import EventLog, EventLogWriter
+from ieapspect.histogram import Histogram
+from ieapspect import metrics
+from ieapspect.pulse import PulseProcessor
+from ieapspect.shmring import RingReader
+from ieapspect.spectra import SpectrumModel, HistogramModel, DUMMY_PEAKS, ALPHA_PEAKS
+
 
 class ConfigProp:
 
@@ -46,6 +53,12 @@ class ConfigProp:
         self.to = to
 
 
+# Columnar batch of events, values is an array with one entry per event, the
+# other columns are either None or have the same length as values
+EventBatch = collections.namedtuple("EventBatch", ["values", "timestamps",
+                                                   "tot", "waveforms"])
+
+
 class Spectrometer:
 
     def __init__(self, channels):
@@ -59,6 +72,9 @@ class Spectrometer:
     def end(self):
         pass
 
+    def close(self):
+        pass
+
     async def next_event(self):
         raise NotImplementedError
 
@@ -68,7 +84,70 @@ class Spectrometer:
     async def get_prop(self, prop):
         raise NotImplementedError
 
-    async def __aiter__(self):
+    async def get_props(self, props, cached=True):
+        """
+        Returns a dict with the values of props. Drivers which mirror the
+        device properties answer from the mirror if cached is set.
+        """
+        return {p: await self.get_prop(p) for p in props}
+
+    def metrics(self):
+        """
+        Returns a list of ieapspect.metrics.Metric with the driver counters,
+        drivers extend it with their own.
+        """
+        return []
+
+    async def batches(self, max_events=4096, max_latency=0.05):
+        """
+        Yields EventBatch tuples of at most max_events events, holding events
+        back for at most max_latency seconds to fill a batch. This default
+        implementation collects events from next_event, drivers override it
+        if they can decode events in bulk.
+        """
+        loop = asyncio.get_event_loop()
+        pending = None
+        while True:
+            evs = []
+            deadline = None
+            while len(evs) < max_events:
+                if pending is None:
+                    # The task is kept across batches instead of being
+                    # cancelled, cancelling a read mid-packet would desync us
+                    pending = asyncio.ensure_future(self.next_event())
+                timeout = None if deadline is None else deadline - loop.time()
+                if timeout is not None and timeout <= 0:
+                    break
+                done, _ = await asyncio.wait([pending], timeout=timeout)
+                if not done:
+                    break
+                evs.append(pending.result())
+                pending = None
+                if deadline is None:
+                    deadline = loop.time() + max_latency
+            yield self._make_batch(evs)
+
+    @staticmethod
+    def _make_batch(evs):
+        def column(name, dtype=None):
+            col = [getattr(e, name, None) for e in evs]
+            if any(c is None for c in col):
+                return None
+            if name == "waveform" and len(set(map(len, col))) > 1:
+                # Ragged waveforms stay a list of arrays
+                return [np.array(c) for c in col]
+            return np.array(col, dtype=dtype)
+
+        waveforms = column("waveform")
+        values = column("value")
+        if values is None and waveforms is not None:
+            values = np.array([max(e.waveform) for e in evs])
+        return EventBatch(values=values,
+                          timestamps=column("timestamp", dtype=np.uint64),
+                          tot=column("tot"),
+                          waveforms=waveforms)
+
+    def __aiter__(self):
         return self
 
     async def __anext__(self):
@@ -76,25 +155,73 @@ class Spectrometer:
 
 
 class DummySpect(Spectrometer):
+    """
+    Generates events with exponentially distributed inter-arrival times at
+    rate events per second (1 / period if rate is not given). The values are
+    drawn from spectrum (see ieapspect.spectra), by default from the same
+    two peaks DummySpect has always generated.
+    """
 
     Event = collections.namedtuple("Event", ["value"])
 
-    def __init__(self, period=1, channels=1024):
+    def __init__(self, period=1, channels=1024, rate=None, spectrum=None, seed=None):
         super(DummySpect, self).__init__(channels=channels)
-        self.period = period
-        self._last = time.time()
+        self.rate = rate if rate is not None else 1 / period
+        self.period = 1 / self.rate
+        self.spectrum = spectrum or SpectrumModel(channels, DUMMY_PEAKS, noise=0)
+        self.rng = np.random.default_rng(seed)
         self.fw_version = "1.0"
+        self._last = time.time()
+        self._times = np.zeros(0)
+        self._values = np.zeros(0, dtype=np.int64)
+        self._pos = 0
+
+    def _generate(self, n):
+        """
+        Makes sure that at least n events which have not been taken yet are
+        generated, the arrival times can be in the future.
+        """
+        if len(self._times) - self._pos >= n:
+            return
+        # Generate in chunks of about 100 ms worth of events
+        cnt = max(n, min(int(self.rate * 0.1), 1 << 16), 1)
+        times = self._last + np.cumsum(self.rng.exponential(self.period, cnt))
+        self._last = times[-1]
+        self._times = np.concatenate([self._times[self._pos:], times])
+        self._values = np.concatenate([self._values[self._pos:],
+                                       self.spectrum.sample(cnt, self.rng)])
+        self._pos = 0
+
+    def _take(self, n):
+        """
+        Returns the values of at most n events which have already arrived.
+        """
+        end = self._pos + np.searchsorted(self._times[self._pos:self._pos + n],
+                                          time.time(), side="right")
+        ret = self._values[self._pos:end]
+        self._pos = end
+        return ret
+
+    async def batches(self, max_events=4096, max_latency=0.05):
+        while True:
+            self._generate(max_events)
+            # Wait until either the batch is full or the first event is
+            # max_latency old
+            deadline = min(self._times[self._pos] + max_latency,
+                           self._times[self._pos + max_events - 1])
+            delay = deadline - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield EventBatch(values=self._take(max_events), timestamps=None,
+                             tot=None, waveforms=None)
 
     async def next_event(self):
-        dt = time.time() - self._last
-        if dt < self.period:
-            await asyncio.sleep(self.period - dt)
-        self._last += self.period
-        val = None
-        while val is None or val <= 0 or val > self.channels:
-            val = random.gauss(0.05, 0.025) if random.random() < 0.2 else random.gauss(0.5, 0.075)
-            val *= self.channels
-            val = int(val)
+        self._generate(1)
+        delay = self._times[self._pos] - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        val = int(self._values[self._pos])
+        self._pos += 1
         return DummySpect.Event(value=val)
 
 
@@ -105,22 +232,55 @@ class AsyncSerialSpectrometer(Spectrometer, asyncio.Protocol):
     def __init__(self, channels):
         super(AsyncSerialSpectrometer, self).__init__(channels=channels)
         self._initsem = asyncio.Semaphore(value=0)
-        self._recvqueue = asyncio.Queue()
+        self._recvbuf = bytearray()
+        self._recvevent = asyncio.Event()
+        self.bytes_received = 0
+        # The exception readers get once the device goes away
+        self.lost = None
 
     def connection_made(self, transport):
         self._transport = transport
         self._initsem.release()
 
+    def connection_lost(self, exc):
+        self.lost = exc if exc is not None else EOFError("The device was disconnected")
+        self._recvevent.set()
+
     def data_received(self, data):
-        for x in range(len(data)):
-            self._recvqueue.put_nowait(data[x:x + 1])
+        self._recvbuf += data
+        self.bytes_received += len(data)
+        self._recvevent.set()
+
+    async def _wait_recv(self, nbytes):
+        while len(self._recvbuf) < nbytes:
+            if self.lost is not None:
+                raise self.lost
+            self._recvevent.clear()
+            await self._recvevent.wait()
+
+    async def peek(self, nbytes=1):
+        await self._wait_recv(nbytes)
+        return bytes(self._recvbuf[:nbytes])
+
+    async def recv_exactly(self, nbytes):
+        await self._wait_recv(nbytes)
+        ret = bytes(self._recvbuf[:nbytes])
+        # bytearray keeps an offset to its start, so dropping the head does
+        # not move the rest of the buffer around
+        del self._recvbuf[:nbytes]
+        return ret
 
-    async def recv(self, nbytes=1):
-        ret = b""
-        for _ in range(nbytes):
-            ret += await self._recvqueue.get()
+    async def recv_available(self, maxbytes=None):
+        await self._wait_recv(1)
+        if maxbytes is None:
+            maxbytes = len(self._recvbuf)
+        ret = bytes(self._recvbuf[:maxbytes])
+        del self._recvbuf[:maxbytes]
         return ret
 
+    async def recv(self, nbytes=1):
+        return await self.recv_exactly(nbytes)
+
     @classmethod
     async def connect(cls, port=None):
         if port is None and cls._description is not None:
@@ -137,11 +297,19 @@ class AsyncSerialSpectrometer(Spectrometer, asyncio.Protocol):
         pass
 
     def flush(self):
-        self._recvqueue = asyncio.Queue()
+        self._recvbuf.clear()
 
     def close(self):
         self._transport.close()
 
+    def metrics(self):
+        return super(AsyncSerialSpectrometer, self).metrics() + [
+            metrics.counter("ieapspect_received_bytes_total",
+                            "Bytes received from the device", self.bytes_received),
+            metrics.gauge("ieapspect_receive_buffer_bytes",
+                          "Bytes received but not parsed yet", len(self._recvbuf)),
+        ]
+
 
 class SIPOSSpect(AsyncSerialSpectrometer):
 
@@ -150,18 +318,132 @@ class SIPOSSpect(AsyncSerialSpectrometer):
     _description = "Photodiode Spectrometer"
     _initbaud = 500000
 
-    def __init__(self, sername):
+    def __init__(self):
         super(SIPOSSpect, self).__init__(channels=4096)
 
+    async def batches(self, max_events=4096, max_latency=0.05):
+        while True:
+            await self._wait_recv(2)
+            n = min(len(self._recvbuf) // 2, max_events)
+            at = np.frombuffer(await self.recv_exactly(n * 2),
+                               dtype=np.uint8).reshape(n, 2).astype(np.uint16)
+            vals = (((at[:, 0] & 0x3f) << 6) | (at[:, 1] & 0x7f)) ^ 0xfff
+            yield EventBatch(values=vals, timestamps=None,
+                             tot=None, waveforms=None)
+
     async def next_event(self):
-        at = await self.recv(2)
+        at = await self.recv_exactly(2)
         val = (((at[0] & 0x3f) << 6) | (at[1] & 0x7f)) ^ 0xfff
         return SIPOSSpect.Event(value=val)
 
 
+class BoundedQueue:
+    """
+    FIFO with an optional limit on its size. put() takes the size of the
+    item, so that an item can be an array of many events, an item bigger than
+    the limit still fits into an empty queue. When the queue is full, policy
+    decides whether the oldest items are dropped to make room (DROP_OLDEST),
+    the new item is dropped (DROP_NEWEST) or put() refuses it (BLOCK), in
+    which case the producer should stop until get() calls on_space.
+    """
+
+    DROP_OLDEST = "drop-oldest"
+    DROP_NEWEST = "drop-newest"
+    BLOCK = "block"
+
+    POLICIES = [DROP_OLDEST, DROP_NEWEST, BLOCK]
+
+    def __init__(self, maxsize=None, policy=DROP_OLDEST, on_space=None):
+        self.configure(maxsize, policy)
+        self.on_space = on_space
+        self.size = 0
+        self.dropped = 0
+        self._items = collections.deque()
+        self._ready = asyncio.Event()
+        self._blocked = False
+        self._closed = None
+
+    def configure(self, maxsize, policy):
+        if policy not in BoundedQueue.POLICIES:
+            raise ValueError("Unknown queue policy %s" % policy)
+        self.maxsize = maxsize
+        self.policy = policy
+
+    def __len__(self):
+        return len(self._items)
+
+    def full(self, n=1):
+        return self.maxsize is not None and self.size > 0 and \
+            self.size + n > self.maxsize
+
+    def put(self, item, n=1):
+        """
+        Returns False if the item was refused because of the BLOCK policy.
+        """
+        if self.full(n):
+            if self.policy == BoundedQueue.BLOCK:
+                self._blocked = True
+                return False
+            if self.policy == BoundedQueue.DROP_NEWEST:
+                self.dropped += n
+                return True
+            while self.full(n):
+                dn, _ = self._items.popleft()
+                self.size -= dn
+                self.dropped += dn
+        self._items.append((n, item))
+        self.size += n
+        self._ready.set()
+        return True
+
+    def unget(self, item, n=1):
+        """
+        Returns the unconsumed part of an item to the front of the queue.
+        """
+        self._items.appendleft((n, item))
+        self.size += n
+        self._ready.set()
+
+    def get_nowait(self):
+        n, item = self._items.popleft()
+        self.size -= n
+        if self._blocked:
+            self._blocked = False
+            if self.on_space is not None:
+                self.on_space()
+        return item
+
+    def close(self, exc):
+        """
+        Makes the consumers raise exc once the queue is drained.
+        """
+        self._closed = exc
+        self._ready.set()
+
+    async def wait(self):
+        while not self._items:
+            if self._closed is not None:
+                raise self._closed
+            self._ready.clear()
+            await self._ready.wait()
+
+    async def get(self):
+        await self.wait()
+        return self.get_nowait()
+
+
 class SerSpectException(Exception):
 
+    ERROR_NAMES = {
+        1: "EUNKNOWN",
+        2: "EINKEY",
+        3: "EINOP",
+    }
+
     def __init__(self, errorcode):
+        super(SerSpectException, self).__init__(
+            "Device error %d (%s)" % (errorcode,
+                                      self.ERROR_NAMES.get(errorcode, "?")))
         self.errorcode = errorcode
 
 
@@ -184,6 +466,15 @@ class SerSpect(AsyncSerialSpectrometer):
     PACK_WAVE = 0x88
     PACK_ERROR = 0xff
 
+    # For the metrics
+    PACK_NAMES = {
+        PACK_PONG: "pong",
+        PACK_GETRESP: "getresp",
+        PACK_EVENT: "event",
+        PACK_WAVE: "wave",
+        PACK_ERROR: "error",
+    }
+
     PROP_FW = 0x01
     PROP_THRESH = 0x02
     PROP_BIAS = 0x03
@@ -207,15 +498,39 @@ class SerSpect(AsyncSerialSpectrometer):
         PROP_SERNO: 2,
     }
 
+    EUNKNOWN = 1
+    EINKEY = 2
+    EINOP = 3
+
     _description = "Spectrometer Acquisition Board"
     _initbaud = 115200  # Does not matter really
 
+    # Default limits, in events for the event queue and in packets for the
+    # queues created by subscribe()
+    EVENT_QUEUE_SIZE = 1 << 20
+    PACKET_QUEUE_SIZE = 1024
+
     def __init__(self):
         super(SerSpect, self).__init__(channels=4096)
         self.event_loop = asyncio.get_event_loop()
-        self._packqueues = [asyncio.Queue() for _ in range(256)]
+        self._eventqueue = BoundedQueue(SerSpect.EVENT_QUEUE_SIZE,
+                                        on_space=self._resume)
+        # Only the packet types somebody subscribed to get queued
+        self._packqueues = {}
+        # (response type, propid, future) of the requests sent to the device,
+        # in the order it answers them. SETs have no response type and no
+        # future, they only get an ERROR if they fail.
+        self._inflight = collections.deque()
+        # propid -> future of the GET in flight, shared by all the readers
+        self._propgets = {}
+        # Last property values the device reported, see get_props()
+        self.props = {}
+        self.prop_errors = 0
+        self._paused = False
         self._packlock = asyncio.Lock()
-        self._proplock = asyncio.Lock()
+        self.packets_received = [0] * 256
+        self.packets_unrouted = [0] * 256
+        self.resync_drops = 0
 
         self._transport = None
 
@@ -228,7 +543,7 @@ class SerSpect(AsyncSerialSpectrometer):
 
     async def _ainit(self):
         # Flush the device buffer if it has not been flushed yet
-        self._transport.write([SerSpect.PACK_NOP] * 100)
+        self._transport.write(bytes([SerSpect.PACK_NOP] * 100))
         self.flush()
         asyncio.ensure_future(self._recv_loop())
         self.set_prop(SerSpect.PROP_BIAS, 0)
@@ -241,8 +556,180 @@ class SerSpect(AsyncSerialSpectrometer):
 
     async def _recv_loop(self):
         while True:
-            pack = await self.recv_packet()
-            self._packqueues[pack[0]].put_nowait(pack)
+            async with self._packlock:
+                self._recvevent.clear()
+                self._parse_recvbuf()
+            await self._recvevent.wait()
+
+    # Upper bound on the amount of EVENT packets checked in one go, keeps the
+    # cost of finding the end of an event run proportional to its length
+    _EVENT_RUN_WINDOW = 4096
+
+    def _parse_recvbuf(self):
+        # The parser works on views of the buffer, they have to be gone
+        # before its head can be dropped
+        del self._recvbuf[:self._parse_packets(self._recvbuf)]
+
+    def _parse_packets(self, buf):
+        """
+        Hands the complete packets at the start of buf over to their queues,
+        returns the amount of bytes they took.
+        """
+        arr = np.frombuffer(buf, dtype=np.uint8)
+        evs = None
+        try:
+            pos = 0
+            while pos < len(buf):
+                if buf[pos] == SerSpect.PACK_EVENT:
+                    cnt = min((len(buf) - pos) // 3, self._EVENT_RUN_WINDOW)
+                    if cnt == 0:
+                        break
+                    nonevent = np.flatnonzero(arr[pos:pos + cnt * 3:3] != SerSpect.PACK_EVENT)
+                    run = nonevent[0] if len(nonevent) else cnt
+                    evs = arr[pos:pos + run * 3].reshape(run, 3)
+                    if not self._eventqueue.put(evs[:, 1].astype(np.uint16) |
+                                                (evs[:, 2].astype(np.uint16) << 8), run):
+                        self._block()
+                        break
+                    self.packets_received[SerSpect.PACK_EVENT] += run
+                    pos += run * 3
+                    continue
+                ln = self._packet_length(buf, pos)
+                if ln is None or pos + ln > len(buf):
+                    break
+                if ln == 0:
+                    # Drop the byte
+                    self.resync_drops += 1
+                    pos += 1
+                    continue
+                if not self._route(arr[pos:pos + ln].tobytes()):
+                    self._block()
+                    break
+                self.packets_received[buf[pos]] += 1
+                pos += ln
+            return pos
+        finally:
+            # A view that outlives the parse, in a traceback say, would keep
+            # the buffer from being resized
+            del arr, evs
+
+    def _route(self, pack):
+        """
+        Hands a parsed packet over to whoever waits for it. Returns False if
+        it has to wait in the receive buffer because its queue is full.
+        """
+        typ = pack[0]
+        if typ == SerSpect.PACK_GETRESP:
+            self.props[pack[1]] = SerSpect._decode_lendian(pack[2:])
+        if self._complete(typ, pack):
+            return True
+        queue = self._packqueues.get(typ)
+        if queue is None:
+            self.packets_unrouted[typ] += 1
+            return True
+        return queue.put(pack)
+
+    def _complete(self, typ, pack):
+        """
+        Hands a response over to the request it belongs to. The device
+        answers in order, so the SETs sent before that request went through.
+        """
+        inflight = self._inflight
+        if typ == SerSpect.PACK_ERROR:
+            # The protocol does not tell what the error belongs to. A SET
+            # which went through gets no response at all, so the error goes
+            # to the oldest request somebody waits for and the SETs before
+            # it are done. Every SET is followed by the GET reading it back,
+            # if it was the SET that got refused, that GET reports it.
+            if not inflight:
+                return False
+            self.prop_errors += 1
+            for i, (resptyp, propid, fut) in enumerate(inflight):
+                if fut is not None:
+                    break
+            else:
+                # Only SETs in flight, nobody to tell
+                inflight.popleft()
+                return True
+            for _ in range(i + 1):
+                inflight.popleft()
+            if not fut.done():
+                fut.set_exception(SerSpectException(pack[1]))
+            return True
+        propid = pack[1] if typ == SerSpect.PACK_GETRESP else None
+        for i, (resptyp, pid, fut) in enumerate(inflight):
+            if resptyp == typ and pid == propid:
+                break
+        else:
+            return False
+        for _ in range(i):
+            resptyp, pid, f = inflight.popleft()
+            if f is not None and not f.done():
+                # Answered out of order, its response got lost on the way
+                f.set_exception(IOError("The device did not respond"))
+        inflight.popleft()
+        if not fut.done():
+            fut.set_result(self.props[propid] if propid is not None else pack)
+        return True
+
+    def connection_lost(self, exc):
+        super(SerSpect, self).connection_lost(exc)
+        self._eventqueue.close(self.lost)
+        for queue in self._packqueues.values():
+            queue.close(self.lost)
+        for _, _, fut in self._inflight:
+            if fut is not None and not fut.done():
+                fut.set_exception(self.lost)
+        self._inflight.clear()
+
+    def _block(self):
+        # Let the backpressure propagate to the device
+        if not self._paused:
+            self._paused = True
+            self._transport.pause_reading()
+
+    def _resume(self):
+        if self._paused:
+            self._paused = False
+            self._transport.resume_reading()
+        self._recvevent.set()
+
+    def subscribe(self, typ, maxsize=PACKET_QUEUE_SIZE, policy=BoundedQueue.DROP_OLDEST):
+        """
+        Starts queueing packets of type typ or changes the limits of its
+        queue. PACK_EVENT configures the event queue, its maxsize is in
+        events. Returns the queue.
+        """
+        if typ == SerSpect.PACK_EVENT:
+            queue = self._eventqueue
+        elif typ in self._packqueues:
+            queue = self._packqueues[typ]
+        else:
+            queue = BoundedQueue(on_space=self._resume)
+            self._packqueues[typ] = queue
+        queue.configure(maxsize, policy)
+        return queue
+
+    @staticmethod
+    def _packet_length(buf, pos=0):
+        """
+        Returns the length of the packet starting at buf[pos], 0 if there is
+        no valid packet type at buf[pos] or None if more bytes are needed to
+        tell.
+        """
+        if pos >= len(buf):
+            return None
+        typ = buf[pos]
+        if typ in (SerSpect.PACK_GETRESP, SerSpect.PACK_WAVE):
+            if pos + 1 >= len(buf):
+                return None
+            if typ == SerSpect.PACK_WAVE:
+                return 2 + buf[pos + 1] * 2
+            propid = buf[pos + 1]
+            if propid not in SerSpect.PROP_LENGTH_MAP:
+                return 0
+            return 2 + SerSpect.PROP_LENGTH_MAP[propid]
+        return SerSpect.PACK_LENGTH_MAP.get(typ, 0)
 
     @staticmethod
     def _encode_lendian(val, ln):
@@ -250,12 +737,38 @@ class SerSpect(AsyncSerialSpectrometer):
 
     @staticmethod
     def _decode_lendian(bytss):
-        return functools.reduce(operator.add,
-                                map(lambda i, v: v << (i * 8), *zip(*enumerate(bytss))))
+        return int.from_bytes(bytss, "little")
+
+    def _request(self, resptyp, propid=None):
+        """
+        Registers a request in flight, the caller sends it. Returns the future
+        of its response.
+        """
+        fut = None
+        if resptyp is not None:
+            fut = self.event_loop.create_future()
+            if self.lost is not None:
+                fut.set_exception(self.lost)
+            # Nobody might be waiting for it, e.g. after set_prop
+            fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight.append((resptyp, propid, fut))
+        return fut
+
+    def _request_get(self, prop, packets):
+        """
+        Returns the future of a GET of prop, appending the packet to packets
+        if a new one has to be sent.
+        """
+        fut = self._propgets.get(prop)
+        if fut is None or fut.done():
+            fut = self._propgets[prop] = self._request(SerSpect.PACK_GETRESP, prop)
+            packets.append(bytes([SerSpect.PACK_GET, prop]))
+        return fut
 
     async def ping(self):
+        fut = self._request(SerSpect.PACK_PONG)
         self.send_packet(SerSpect.PACK_PING)
-        await self.recv_packet_queued(SerSpect.PACK_PONG)
+        await fut
 
     def start(self):
         self.send_packet(SerSpect.PACK_START)
@@ -264,19 +777,53 @@ class SerSpect(AsyncSerialSpectrometer):
         self.send_packet(SerSpect.PACK_END)
 
     def set_prop(self, prop, val):
-        self.send_packet(SerSpect.PACK_SET,
-                         prop,
-                         SerSpect._encode_lendian(val,
-                                                  SerSpect.PROP_LENGTH_MAP[prop]))
+        """
+        Sets prop and reads it back in the same write, the mirror does not
+        have prop until the device confirms the new value.
+        """
+        self.props.pop(prop, None)
+        self._request(None, prop)
+        # A GET which is already in flight would return the old value
+        self._propgets.pop(prop, None)
+        packets = [bytes([SerSpect.PACK_SET, prop]) +
+                   SerSpect._encode_lendian(val, SerSpect.PROP_LENGTH_MAP[prop])]
+        self._request_get(prop, packets)
+        self._transport.write(b"".join(packets))
 
     async def get_prop(self, prop):
-        async with self._proplock:
-            self.send_packet(SerSpect.PACK_GET, prop)
-            pack = await self.recv_packet_queued(SerSpect.PACK_GETRESP)
-            return SerSpect._decode_lendian(pack[2:])
+        return (await self.get_props([prop], cached=False))[prop]
+
+    async def get_props(self, props, cached=True):
+        """
+        Returns a dict with the values of props. The ones which are not in the
+        mirror (or all of them, if cached is not set) are read from the
+        device, with all the GETs in a single write. Reads of a property
+        which is already being read share the GET.
+        """
+        if self.lost is not None:
+            raise self.lost
+        packets = []
+        futs = {p: self._request_get(p, packets) for p in props
+                if not (cached and p in self.props)}
+        if packets:
+            self._transport.write(b"".join(packets))
+        ret = {p: self.props[p] for p in props if p not in futs}
+        for p, fut in futs.items():
+            # Shielded, the future is shared with the other readers
+            ret[p] = await asyncio.shield(fut)
+        return {p: ret[p] for p in props}
 
     async def recv_packet_queued(self, typ):
-        return await self._packqueues[typ].get()
+        """
+        Returns the next packet of type typ, subscribing to it with the
+        default limits on the first call.
+        """
+        queue = self._packqueues.get(typ)
+        if queue is None:
+            queue = self.subscribe(typ)
+            if self.lost is not None:
+                queue.close(self.lost)
+        return await queue.get()
 
     def send_packet(self, *args):
         self._transport.write(
@@ -287,29 +834,84 @@ class SerSpect(AsyncSerialSpectrometer):
     async def recv_packet(self):
         async with self._packlock:
             while True:
-                pack = await self.recv(1)
-                typ = pack[0]
-                if typ == SerSpect.PACK_GETRESP:
-                    pack += await self.recv(1)
-                    propid = pack[-1]
-                    return pack + (await self.recv(SerSpect.PROP_LENGTH_MAP[propid]))
-                elif typ == SerSpect.PACK_WAVE:
-                    pack += await self.recv(1)
-                    return pack + (await self.recv(pack[-1] * 2))
-                elif typ in SerSpect.PACK_LENGTH_MAP:
-                    ln = SerSpect.PACK_LENGTH_MAP[typ]
-                    return pack + ((await self.recv(ln - 1)) if ln > 1 else b"")
-                # Drop the byte
+                ln = self._packet_length(self._recvbuf)
+                if ln is None:
+                    await self._wait_recv(len(self._recvbuf) + 1)
+                elif ln == 0:
+                    # Drop the byte
+                    self.resync_drops += 1
+                    del self._recvbuf[:1]
+                else:
+                    self.packets_received[self._recvbuf[0]] += 1
+                    return await self.recv_exactly(ln)
+
+    async def next_events(self, max_n=None):
+        """
+        Returns a uint16 array of at least one and at most max_n pending
+        event values.
+        """
+        queue = self._eventqueue
+        await queue.wait()
+        ret = []
+        n = 0
+        while queue and (max_n is None or n < max_n):
+            evs = queue.get_nowait()
+            if max_n is not None and n + len(evs) > max_n:
+                queue.unget(evs[max_n - n:], n + len(evs) - max_n)
+                evs = evs[:max_n - n]
+            ret.append(evs)
+            n += len(evs)
+        return ret[0] if len(ret) == 1 else np.concatenate(ret)
+
+    async def batches(self, max_events=4096, max_latency=0.05):
+        while True:
+            vals = await self.next_events(max_events)
+            yield EventBatch(values=vals, timestamps=None,
+                             tot=None, waveforms=None)
 
     async def next_event(self):
-        p = await self.recv_packet_queued(SerSpect.PACK_EVENT)
-        val = self._decode_lendian(p[1:])
-        return SerSpect.Event(value=val)
+        val = (await self.next_events(1))[0]
+        return SerSpect.Event(value=int(val))
 
     async def next_wave(self):
         p = await self.recv_packet_queued(SerSpect.PACK_WAVE)
         return struct.unpack(">%dH" % p[1], p[2:])
 
+    def metrics(self):
+        return super(SerSpect, self).metrics() + [
+            metrics.labeled("ieapspect_packets_total", "counter",
+                            "Packets received by type",
+                            {n: self.packets_received[t]
+                             for t, n in SerSpect.PACK_NAMES.items()}, "type"),
+            metrics.counter("ieapspect_resync_dropped_bytes_total",
+                            "Bytes dropped while looking for a valid packet",
+                            self.resync_drops),
+            metrics.gauge("ieapspect_requests_in_flight",
+                          "Requests sent to the device which were not answered yet",
+                          len(self._inflight)),
+            metrics.counter("ieapspect_prop_errors_total",
+                            "Property requests the device refused", self.prop_errors),
+            metrics.gauge("ieapspect_queued_events",
+                          "Events parsed but not consumed yet",
+                          self._eventqueue.size),
+            metrics.counter("ieapspect_dropped_events_total",
+                            "Events dropped because the event queue was full",
+                            self._eventqueue.dropped),
+            metrics.labeled("ieapspect_queued_packets", "gauge",
+                            "Packets parsed but not consumed yet",
+                            {self.PACK_NAMES.get(t, "%#x" % t): q.size
+                             for t, q in self._packqueues.items()}, "type"),
+            metrics.labeled("ieapspect_dropped_packets_total", "counter",
+                            "Packets dropped because their queue was full",
+                            {self.PACK_NAMES.get(t, "%#x" % t): q.dropped
+                             for t, q in self._packqueues.items()}, "type"),
+            metrics.labeled("ieapspect_unrouted_packets_total", "counter",
+                            "Packets dropped because nobody subscribed to them",
+                            {n: self.packets_unrouted[t]
+                             for t, n in SerSpect.PACK_NAMES.items()
+                             if t != SerSpect.PACK_EVENT}, "type"),
+        ]
+
 
 class DM100(Spectrometer):
 
@@ -445,25 +1047,65 @@ class DM100(Spectrometer):
 
     addlost = RegBit(maskcfg, 7)
 
-    def __init__(self, proc):
+    # Packet structure in 16 bit big endian words, pre is the amount of words
+    # before the length word and suf the amount of words after the samples
+    Layout = collections.namedtuple("Layout", ["pre", "suf", "header", "time",
+                                               "lost", "checksum", "mode"])
+
+    WRAPPER = "ieapspect-wrapper-dm100"
+
+    READ_SIZE = 1 << 16
+    # The consumed bytes at the start of the receive buffer are only dropped
+    # once there are at least this many of them
+    COMPACT_SIZE = 1 << 20
+    # Upper bound on the amount of packets decoded in one go
+    MAX_RUN = 4096
+
+    def __init__(self, proc, ring=None):
         super(DM100, self).__init__(channels=65536)
         self._proc = proc
         self.pipe = self._proc.stdin
-        self._queue = asyncio.Queue()
+        self._ring = ring
+        # Received bytes, the ones before _rxpos were parsed already
+        self._rxbuf = bytearray()
+        self._rxpos = 0
+        # Bytes of an incomplete packet left in the ring
+        self._partial = 0
+        self._decoded = collections.deque()
+        self._layoutkey = None
+        self._layoutval = None
+        self.checksum_errors = 0
+        self.bytes_received = 0
+        self.packets_received = 0
 
     @staticmethod
-    async def connect():
+    async def connect(wrapper=None, ring_size=None):
+        """
+        Starts wrapper (a command line, DM100.WRAPPER by default) and talks
+        to the device through it. If ring_size is given, the data come
+        through a shared memory ring of that many bytes instead of stdout.
+        """
+        cmd = list(wrapper or [DM100.WRAPPER])
+        ring = RingReader(ring_size) if ring_size else None
+        kwargs = {}
+        if ring is not None:
+            cmd += ring.wrapper_args()
+            kwargs["pass_fds"] = ring.pass_fds
         proc = await asyncio.create_subprocess_exec(
-                            "ieapspect-wrapper-dm100",
+                            *cmd,
                             stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            stderr=sys.stderr)
+                            stdout=subprocess.DEVNULL if ring else subprocess.PIPE,
+                            stderr=sys.stderr,
+                            **kwargs)
+        if ring is not None:
+            ring.started()
 
         def _kill_on_exit():
-            proc.kill()
+            if proc.returncode is None:
+                proc.kill()
         atexit.register(_kill_on_exit)
 
-        ret = DM100(proc)
+        ret = DM100(proc, ring)
         await ret._ainit()
         return ret
 
@@ -481,8 +1123,7 @@ class DM100(Spectrometer):
         self.dccoupled = bool(m2[0] & 0x04)
         await asyncio.sleep(0.1)
         if self._proc.returncode is not None:
-            from subprocess import CalledProcessError
-            raise CalledProcessError("Failed to start the DM100 wrapper")
+            raise subprocess.CalledProcessError(self._proc.returncode, DM100.WRAPPER)
 
         self.modecfg = 0x04
         self.lld = 0x0000
@@ -506,6 +1147,12 @@ class DM100(Spectrometer):
     def start(self):
         self.disable_inhibit()
 
+    def close(self):
+        if self._proc.returncode is None:
+            self._proc.kill()
+        if self._ring is not None:
+            self._ring.close()
+
     def send_command(self, cmd, data=0):
         bs = bytes([cmd, data])
         self._proc.stdin.write(bs)
@@ -529,51 +1176,56 @@ class DM100(Spectrometer):
     def sw_trigger(self):
         self.send_command(DM100.CMD_TRIGGER)
 
-    async def next_event(self):
-        # Calculate the packet length based on the device settings
-        data = []
+    def _layout(self):
+        key = (self.packcfg, self.maskcfg, self.modecfg)
+        if key != self._layoutkey:
+            self._layoutkey = key
+            self._layoutval = DM100.Layout(
+                pre=2 if self.addheader else 0,
+                suf=(3 if self.addtime else 0) + int(self.addlost) + int(self.addchecksum),
+                header=self.addheader,
+                time=self.addtime,
+                lost=self.addlost,
+                checksum=self.addchecksum,
+                mode=self.mode)
+        return self._layoutval
+
+    def _decode_packets(self, words, dln, layout):
+        """
+        Decodes an (n, packet length) array of packets which all have dln
+        samples. Returns a DM100.Event with array columns.
+        """
         header0 = None
         header1 = None
         packet_id = None
-        if self.addheader:
-            data.extend(await self._recv_words(2))
-            header0 = data[0]
-            header1 = data[1]
+        col = 0
+        if layout.header:
+            header0 = words[:, 0].astype(np.uint16)
+            header1 = words[:, 1].astype(np.uint16)
             packet_id = (header1 >> 8) & 0b1111
-        dln = await self._recv_word()
-        data.append(dln)
-        samples = await self._recv_words(dln)
+            col = 2
+        samples = words[:, col + 1:col + 1 + dln]
+        col += 1 + dln
         value = None
         tot = None
         waveform = None
-        if self.mode == DM100.MODE_SAMPLE:
-            value = samples[0]
-        elif self.mode == DM100.MODE_SAMPLE_TOT:
-            value = samples[0]
-            tot = samples[1]
-        elif self.mode == DM100.MODE_WAVEFORM:
-            value = max(samples)
-            waveform = samples
-        data += samples
+        if layout.mode == DM100.MODE_SAMPLE and dln >= 1:
+            value = samples[:, 0].astype(np.uint16)
+        elif layout.mode == DM100.MODE_SAMPLE_TOT and dln >= 2:
+            value = samples[:, 0].astype(np.uint16)
+            tot = samples[:, 1].astype(np.uint16)
+        elif layout.mode == DM100.MODE_WAVEFORM and dln >= 1:
+            waveform = samples.astype(np.uint16)
+            value = waveform.max(axis=1)
         times = None
-        if self.addtime:
-            tws = await self._recv_words(3)
-            times = (tws[0] << 32) | (tws[1] << 16) | tws[2]
-            data.extend(tws)
-        lost = None
-        if self.addlost:
-            lost = await self._recv_word()
-            data.append(lost)
-        checksum = None
-        if self.addchecksum:
-            checksum = await self._recv_word()
-            data.append(checksum)
-
+        if layout.time:
+            tws = words[:, col:col + 3].astype(np.uint64)
+            times = (tws[:, 0] << 32) | (tws[:, 1] << 16) | tws[:, 2]
+            col += 3
         checksum_valid = None
-        if checksum is not None:
-            scheck = (sum(data[:-1]) & 0xffff)
-            checksum_valid = scheck == checksum
-
+        if layout.checksum:
+            scheck = words[:, :-1].sum(axis=1, dtype=np.uint64) & 0xffff
+            checksum_valid = scheck == words[:, -1]
         return DM100.Event(
                     header0=header0,
                     header1=header1,
@@ -584,28 +1236,126 @@ class DM100(Spectrometer):
                     timestamp=times,
                     checksum_valid=checksum_valid)
 
-    async def _recv_word(self):
-        w = await self._recv(2)
-        return (w[0] << 8) | w[1]
+    def _decode_buffer(self, buf, pos=0):
+        """
+        Decodes the complete packets in buf starting at pos, returns the
+        position after the last one.
+        """
+        layout = self._layout()
+        while True:
+            avail = (len(buf) - pos) // 2
+            if avail < layout.pre + 1:
+                break
+            dlnoff = pos + layout.pre * 2
+            dln = (buf[dlnoff] << 8) | buf[dlnoff + 1]
+            plen = layout.pre + 1 + dln + layout.suf
+            n = min(avail // plen, DM100.MAX_RUN)
+            if n == 0:
+                break
+            # A view into the receive buffer, the decoded columns are copies
+            words = np.frombuffer(buf, dtype=">u2", count=n * plen,
+                                  offset=pos).reshape(n, plen)
+            # In waveform mode the sample count can change between packets,
+            # take the run of packets with the same length as the first one
+            other = np.flatnonzero(words[:, layout.pre] != dln)
+            if len(other):
+                n = other[0]
+                words = words[:n]
+            self._decoded.append((n, self._decode_packets(words, dln, layout)))
+            self.packets_received += int(n)
+            pos += n * plen * 2
+        return pos
+
+    async def _fill_ring(self):
+        # The packets are decoded straight out of the mapping, an incomplete
+        # one at the end stays there until the rest of it arrives
+        buf = await self._ring.peek(self._partial + 1)
+        pos = self._decode_buffer(buf)
+        self._ring.consume(pos)
+        self.bytes_received += pos
+        self._partial = len(buf) - pos
+
+    async def _fill(self):
+        data = await self._proc.stdout.read(DM100.READ_SIZE)
+        if not data:
+            raise EOFError("The DM100 wrapper has exited")
+        self.bytes_received += len(data)
+        if self._rxpos >= DM100.COMPACT_SIZE and \
+                self._rxpos * 2 >= len(self._rxbuf):
+            # Moves at most as many bytes as were consumed since the last
+            # time, so every received byte gets copied once at most
+            del self._rxbuf[:self._rxpos]
+            self._rxpos = 0
+        elif self._rxpos == len(self._rxbuf):
+            self._rxbuf.clear()
+            self._rxpos = 0
+        self._rxbuf += data
+
+    async def next_packets(self, max_n=None):
+        """
+        Returns a DM100.Event with array columns holding at least one and at
+        most max_n packets.
+        """
+        while not self._decoded:
+            if self._ring is not None:
+                await self._fill_ring()
+                continue
+            # _recv() might have left complete packets behind
+            self._rxpos = self._decode_buffer(self._rxbuf, self._rxpos)
+            if not self._decoded:
+                await self._fill()
+        n, evs = self._decoded.popleft()
+        if max_n is not None and n > max_n:
+            self._decoded.appendleft((n - max_n, DM100.Event(
+                *(None if c is None else c[max_n:] for c in evs))))
+            evs = DM100.Event(*(None if c is None else c[:max_n] for c in evs))
+        return evs
+
+    async def batches(self, max_events=4096, max_latency=0.05):
+        while True:
+            evs = await self.next_packets(max_events)
+            if evs.value is None:
+                continue
+            if evs.checksum_valid is not None and not evs.checksum_valid.all():
+                self.checksum_errors += int((~evs.checksum_valid).sum())
+                evs = DM100.Event(*(None if c is None else c[evs.checksum_valid]
+                                    for c in evs))
+            yield EventBatch(values=evs.value, timestamps=evs.timestamp,
+                             tot=evs.tot, waveforms=evs.waveform)
 
-    async def _recv_words(self, n):
-        ret = [0] * n
-        bs = await self._recv(n * 2)
-        for x in range(n):
-            ret[x] = (bs[x * 2] << 8) | bs[x * 2 + 1]
-        return ret
+    async def next_event(self):
+        evs = await self.next_packets(1)
+        return DM100.Event(*(None if c is None else c[0].tolist() for c in evs))
+
+    def metrics(self):
+        return super(DM100, self).metrics() + [
+            metrics.counter("ieapspect_received_bytes_total",
+                            "Bytes received from the device", self.bytes_received),
+            metrics.gauge("ieapspect_receive_buffer_bytes",
+                          "Bytes received but not parsed yet",
+                          len(self._rxbuf) - self._rxpos if self._ring is None
+                          else self._ring.available),
+            metrics.labeled("ieapspect_packets_total", "counter",
+                            "Packets received by type",
+                            {"event": self.packets_received}, "type"),
+            metrics.counter("ieapspect_checksum_errors_total",
+                            "Packets dropped because of a checksum mismatch",
+                            self.checksum_errors),
+            metrics.gauge("ieapspect_queued_events",
+                          "Events parsed but not consumed yet",
+                          sum(n for n, _ in self._decoded)),
+        ]
 
     async def _recv(self, n):
-        sr = self._proc.stdout
-        while len(sr._buffer) < n:
-            # Apparently, this is evil and could lead to deadlocks if
-            # n > sr._limit (see StreamReader.readexactly sources)
-            await sr._wait_for_data("")
-        ret = await sr.read(n)
-        assert len(ret) == n
-        return ret
-
-        ret = await self._proc.stdout.readexactly(n)
+        if self._ring is not None:
+            ret = bytes((await self._ring.peek(n))[:n])
+            self._ring.consume(n)
+            self.bytes_received += n
+            return ret
+        while len(self._rxbuf) - self._rxpos < n:
+            await self._fill()
+        ret = bytes(self._rxbuf[self._rxpos:self._rxpos + n])
+        self._rxpos += n
         return ret
 
 
@@ -628,6 +1378,8 @@ class Spectrig(Spectrometer, asyncio.SubprocessProtocol):
             self.val = val
             obj._send_packet(self.cmd, [0x00, (val >> 8) & 0xff, val & 0xff])
 
+    WRAPPER = "ieapspect-wrapper-spectrig"
+
     PACKET_HEADER = 0x55
 
     PACKET_RESP_HEADER = 0xaa
@@ -664,24 +1416,50 @@ class Spectrig(Spectrometer, asyncio.SubprocessProtocol):
     sample_rate = CmdProp(CMD_SET_SAMPLE_RATE)
     pretrig = CmdProp(CMD_SET_PRETRIG)
 
-    def __init__(self):
+    # Header byte followed by the 525 byte packet, which ends with the tail
+    FRAME_LENGTH = 526
+    PACKET_LENGTH = 525
+
+    def __init__(self, ring=None):
         super(Spectrig, self).__init__(channels=4096)
         self.pipe = None
         self.trans = None
-        self._buffer = collections.deque()
+        self._ring = ring
+        self._buffer = bytearray()
         self._cmdqueue = asyncio.Queue()
-        self._evqueue = asyncio.Queue()
+        # Decoded (samples, sample counts, timestamps) array triples
+        self._decoded = collections.deque()
+        self._decodedevent = asyncio.Event()
+        self.resync_drops = 0
+        self.bytes_received = 0
+        self.packets_received = collections.Counter()
+        self.lost = None
 
     @staticmethod
-    async def connect():
+    async def connect(wrapper=None, ring_size=None):
+        """
+        Starts wrapper (a command line, Spectrig.WRAPPER by default) and
+        talks to the device through it. If ring_size is given, the data come
+        through a shared memory ring of that many bytes instead of stdout.
+        """
         loop = asyncio.get_event_loop()
-
-        create = loop.subprocess_exec(lambda: Spectrig(),
-                                      "ieapspect-wrapper-spectrig")
+        cmd = list(wrapper or [Spectrig.WRAPPER])
+        ring = RingReader(ring_size) if ring_size else None
+        kwargs = {}
+        if ring is not None:
+            cmd += ring.wrapper_args()
+            kwargs["pass_fds"] = ring.pass_fds
+            kwargs["stdout"] = subprocess.DEVNULL
+
+        create = loop.subprocess_exec(lambda: Spectrig(ring), *cmd, **kwargs)
         trans, prot = await create
+        if ring is not None:
+            ring.started()
+            prot._ring_task = asyncio.ensure_future(prot._ring_loop())
 
         def _kill_on_exit():
-            trans.kill()
+            if trans.get_returncode() is None:
+                trans.kill()
         atexit.register(_kill_on_exit)
 
         prot.pipe = trans.get_pipe_transport(0)
@@ -695,8 +1473,7 @@ class Spectrig(Spectrometer, asyncio.SubprocessProtocol):
         await asyncio.sleep(0.1)
         # TODO: Add a proper handshake
         if self.trans.get_returncode() is not None:
-            from subprocess import CalledProcessError
-            raise CalledProcessError("Failed to start the Spectrig wrapper")
+            raise subprocess.CalledProcessError(self.trans.get_returncode(), Spectrig.WRAPPER)
 
     def _send_packet(self, cmd, pars=[0, 0, 0]):
         pack = []
@@ -712,8 +1489,41 @@ class Spectrig(Spectrometer, asyncio.SubprocessProtocol):
     def start(self):
         self.enable_measurement()
 
+    def close(self):
+        if self.trans is not None:
+            self.trans.close()
+        if self._ring is not None:
+            self._ring_task.cancel()
+            self._ring.close()
+
+    async def _next_decoded(self, max_n=None):
+        while not self._decoded:
+            if self.lost is not None:
+                raise self.lost
+            self._decodedevent.clear()
+            await self._decodedevent.wait()
+        samples, dlens, tss = self._decoded.popleft()
+        if max_n is not None and len(tss) > max_n:
+            self._decoded.appendleft((samples[max_n:], dlens[max_n:], tss[max_n:]))
+            samples, dlens, tss = samples[:max_n], dlens[:max_n], tss[:max_n]
+        return samples, dlens, tss
+
     async def next_event(self):
-        return await self._evqueue.get()
+        samples, dlens, tss = await self._next_decoded(1)
+        return Spectrig.Event(waveform=tuple(samples[0, :dlens[0]].tolist()),
+                              timestamp=int(tss[0]))
+
+    async def batches(self, max_events=4096, max_latency=0.05):
+        while True:
+            samples, dlens, tss = await self._next_decoded(max_events)
+            if (dlens == dlens[0]).all():
+                waveforms = samples[:, :dlens[0]]
+                values = waveforms.max(axis=1, initial=0)
+            else:
+                waveforms = [w[:d] for w, d in zip(samples, dlens)]
+                values = np.array([w.max(initial=0) for w in waveforms])
+            yield EventBatch(values=values, timestamps=tss,
+                             tot=None, waveforms=waveforms)
 
     def sw_trigger(self):
         self._send_packet(Spectrig.CMD_SW_TRIGGER)
@@ -727,74 +1537,220 @@ class Spectrig(Spectrometer, asyncio.SubprocessProtocol):
     def _handle_packet_cmd(self, pack):
         pass
 
-    def _handle_packet_spectro(self, pack):
-        #packid = pack[1] & 0b00111111
-        #trigmark = pack[2] & 0x3f
-        #pulsepart = pack[2] & 0xc0
-        dlen, = struct.unpack(">H", pack[514:516])
-        vals = struct.unpack(">%dH" % dlen, pack[2:2 + dlen * 2])
-        ts = 0
-        for x in pack[517:517 + 8]:
-            ts = (ts << 8) | x
-
-        ev = Spectrig.Event(waveform=vals, timestamp=ts)
-        self._evqueue.put_nowait(ev)
-
-    def _handle_packet(self, pack):
-        type_ = pack[0]
-        if type_ == Spectrig.PACK_TYPE_CMD:
-            self._handle_packet_cmd(pack)
-        elif type_ == Spectrig.PACK_TYPE_SPECTRO:
-            self._handle_packet_spectro(pack)
-        else:
-            # Probably some bytes got lost, let's hope that we can resync soon
-            pass
-
-    def pipe_data_received(self, fd, data):
-        for b in data:
-            self._buffer.append(b)
-        while len(self._buffer) >= 526:
-            start = False
-            while len(self._buffer) >= 526:
-                if self._buffer.popleft() == Spectrig.PACKET_RESP_HEADER:
-                    start = True
+    def _handle_packets_spectro(self, packs):
+        #packid = packs[:, 1] & 0b00111111
+        #trigmark = packs[:, 2] & 0x3f
+        #pulsepart = packs[:, 2] & 0xc0
+        dlens = (packs[:, 514].astype(np.uint16) << 8) | packs[:, 515]
+        dlens = np.minimum(dlens, 256)
+        samples = np.ascontiguousarray(packs[:, 2:514]).view(">u2").astype(np.uint16)
+        tss = np.ascontiguousarray(packs[:, 517:517 + 8]).view(">u8")[:, 0].astype(np.uint64)
+        self._decoded.append((samples, dlens, tss))
+        self._decodedevent.set()
+
+    def _handle_packets(self, packs):
+        types = packs[:, 0]
+        spectro = types == Spectrig.PACK_TYPE_SPECTRO
+        cmd = types == Spectrig.PACK_TYPE_CMD
+        nspectro = int(spectro.sum())
+        ncmd = int(cmd.sum())
+        self.packets_received["spectro"] += nspectro
+        self.packets_received["cmd"] += ncmd
+        self.packets_received["other"] += len(packs) - nspectro - ncmd
+        if nspectro:
+            self._handle_packets_spectro(packs[spectro])
+        for pack in packs[cmd]:
+            self._handle_packet_cmd(pack.tobytes())
+        # Anything else means that some bytes probably got lost, let's hope
+        # that we can resync soon
+
+    def _parse_frames(self, buf):
+        """
+        Handles the complete frames in buf, returns the amount of bytes
+        which were either parsed or skipped as garbage.
+        """
+        flen = Spectrig.FRAME_LENGTH
+        arr = np.frombuffer(buf, dtype=np.uint8)
+        # Only computed if we lose the sync
+        heads = None
+        pos = 0
+        while len(buf) - pos >= flen:
+            if buf[pos] != Spectrig.PACKET_RESP_HEADER:
+                if heads is None:
+                    heads = np.flatnonzero(arr == Spectrig.PACKET_RESP_HEADER)
+                i = np.searchsorted(heads, pos)
+                start = int(heads[i]) if i < len(heads) else len(buf)
+                self.resync_drops += start - pos
+                pos = start
+                if len(buf) - pos < flen:
                     break
-            if not start:
-                break
-            if self._buffer[524] != Spectrig.PACKET_RESP_TAIL:
+            if buf[pos + flen - 1] != Spectrig.PACKET_RESP_TAIL:
                 # This is not a valid packet
-                self._buffer.popleft()
+                self.resync_drops += 1
+                pos += 1
                 continue
-            pack = bytes([self._buffer.popleft() for _ in range(525)])
-            self._handle_packet(pack)
+            # Take the whole run of back to back frames at once, the packets
+            # are just a view into the buffer
+            k = (len(buf) - pos) // flen
+            frames = arr[pos:pos + k * flen].reshape(k, flen)
+            valid = (frames[:, 0] == Spectrig.PACKET_RESP_HEADER) & \
+                (frames[:, -1] == Spectrig.PACKET_RESP_TAIL)
+            run = k if valid.all() else int(np.argmin(valid))
+            self._handle_packets(frames[:run, 1:])
+            pos += run * flen
+        return pos
+
+    def pipe_data_received(self, fd, data):
+        self.bytes_received += len(data)
+        buf = self._buffer
+        buf += data
+        del buf[:self._parse_frames(buf)]
+
+    async def _ring_loop(self):
+        # The frames are parsed straight out of the mapping, an incomplete
+        # one at the end stays there until the rest of it arrives
+        partial = 0
+        try:
+            while True:
+                buf = await self._ring.peek(partial + 1)
+                pos = self._parse_frames(buf)
+                self._ring.consume(pos)
+                self.bytes_received += pos
+                partial = len(buf) - pos
+        except EOFError as e:
+            self.lost = e
+            self._decodedevent.set()
 
     def process_exited(self):
-        pass
+        if self._ring is not None:
+            # Whatever is left in the ring still gets parsed
+            return
+        self.lost = EOFError("The Spectrig wrapper has exited")
+        self._decodedevent.set()
+
+    def metrics(self):
+        return super(Spectrig, self).metrics() + [
+            metrics.counter("ieapspect_received_bytes_total",
+                            "Bytes received from the device", self.bytes_received),
+            metrics.gauge("ieapspect_receive_buffer_bytes",
+                          "Bytes received but not parsed yet",
+                          len(self._buffer) if self._ring is None else self._ring.available),
+            metrics.labeled("ieapspect_packets_total", "counter",
+                            "Packets received by type",
+                            dict(self.packets_received), "type"),
+            metrics.counter("ieapspect_resync_dropped_bytes_total",
+                            "Bytes dropped while looking for a valid frame",
+                            self.resync_drops),
+            metrics.gauge("ieapspect_queued_events",
+                          "Events parsed but not consumed yet",
+                          sum(len(d[2]) for d in self._decoded)),
+        ]
 
 
 class HistFile:
+    """
+    Histogram file, either in the text format
 
-    def __init__(self):
-        self.vals = []
+        -_-
+        from: <unix time or ISO 8601>
+        to: <unix time or ISO 8601>
+        <key>: <value>
+        ---
+        <count of channel 0>
+        <count of channel 1>
+        ...
+
+    or in the binary variant, which has the same header with "-_-npy" as the
+    magic line, followed by the counts in the .npy format.
+    """
+
+    MAGIC = "-_-"
+    MAGIC_BINARY = "-_-npy"
+    SEPARATOR = "---"
+
+    def __init__(self, vals=None):
+        self.vals = np.zeros(0, dtype=np.int64) if vals is None else vals
+
+    @staticmethod
+    def _parse_time(val):
+        try:
+            return datetime.datetime.fromtimestamp(int(val))
+        except ValueError:
+            pass
+        # JavaScript Date.toISOString, as written by the web UI
+        dt = datetime.datetime.fromisoformat(val.replace("Z", "+00:00"))
+        if dt.tzinfo is not None:
+            dt = dt.astimezone().replace(tzinfo=None)
+        return dt
 
     @staticmethod
-    def load_file(fname):
+    def load_file(fname, mmap=True):
+        """
+        Loads a histogram file, the counts of binary files are memory mapped
+        unless mmap is False.
+        """
         ret = HistFile()
-        with open(fname) as f:
-            line = f.readline()
-            if line != "-_-\n":
-                raise ValueError("Invalid magic line %s" % start)
-            while line != "---\n":
+        with open(fname, "rb") as f:
+            magic = f.readline().decode().rstrip("\n")
+            if magic not in (HistFile.MAGIC, HistFile.MAGIC_BINARY):
+                raise ValueError("Invalid magic line %s" % magic)
+            while True:
+                line = f.readline()
+                if not line:
+                    raise ValueError("Missing header separator in %s" % fname)
+                line = line.decode()
+                if line.rstrip("\n") == HistFile.SEPARATOR:
+                    break
                 spl = line.split(": ", maxsplit=1)
                 if len(spl) == 2:
                     key, val = (s.strip() for s in spl)
                     key = key.lower()
                     if key in ["from", "to"]:
-                        val = datetime.datetime.fromtimestamp(int(val))
+                        val = HistFile._parse_time(val)
                         if key == "from":
                             key = "from_"
                     setattr(ret, key, val)
-                line = f.readline()
-            for l in f:
-                ret.vals.append(int(l))
+            if magic == HistFile.MAGIC:
+                ret.vals = np.fromstring(f.read().decode(), dtype=np.int64, sep="\n")
+                return ret
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            if mmap:
+                ret.vals = np.memmap(fname, dtype=dtype, mode="r",
+                                     offset=f.tell(), shape=shape)
+            else:
+                ret.vals = np.fromfile(f, dtype=dtype, count=shape[0])
         return ret
+
+    def _header(self, magic):
+        lines = [magic]
+        attrs = vars(self)
+        keys = [k for k in ["from_", "to"] if k in attrs] + \
+               sorted(k for k in attrs if k not in ["from_", "to", "vals"])
+        for key in keys:
+            val = attrs[key]
+            if isinstance(val, datetime.datetime):
+                val = int(val.timestamp())
+            lines.append("%s: %s" % (key.rstrip("_"), val))
+        lines.append(HistFile.SEPARATOR)
+        return ("\n".join(lines) + "\n").encode()
+
+    def write(self, f, binary=False):
+        """
+        Writes the histogram into a file object opened in binary mode.
+        """
+        vals = np.asarray(self.vals)
+        if binary:
+            f.write(self._header(HistFile.MAGIC_BINARY))
+            np.lib.format.write_array(f, vals.astype(np.uint32 if vals.max(initial=0) < 2**32
+                                                     else np.int64))
+        else:
+            f.write(self._header(HistFile.MAGIC))
+            f.write("".join("%d\n" % x for x in vals.tolist()).encode())
+
+    def save(self, fname, binary=False):
+        with open(fname, "wb") as f:
+            self.write(f, binary=binary)
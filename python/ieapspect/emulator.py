@@ -0,0 +1,315 @@
+# The MIT License (MIT)
+#
+# Copyright (C) 2016 Institute of Applied and Experimental Physics (http://www.utef.cvut.cz/)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import asyncio
+import fcntl
+import numpy as np
+import os
+import struct
+import time
+import tty
+
+from ieapspect import SerSpect
+from ieapspect.spectra import SpectrumModel
+
+
+class DeviceEmulator:
+    """
+    Emulates a spectrometer on a pseudo terminal, so that the serial drivers
+    can be tested without the hardware. Events are generated with Poisson
+    timing at rate events per second and garbage_rate random bytes per second
+    are mixed into the stream. The output is dropped (and counted in
+    overflows) if the other side does not keep up and more than max_pending
+    bytes pile up.
+    """
+
+    def __init__(self, rate=1000, spectrum=None, channels=4096,
+                 garbage_rate=0, seed=None, tick=0.01, max_pending=1 << 20):
+        self.rate = rate
+        self.channels = channels
+        self.spectrum = spectrum or SpectrumModel(channels)
+        self.garbage_rate = garbage_rate
+        self.tick = tick
+        self.max_pending = max_pending
+        self.rng = np.random.default_rng(seed)
+        self.streaming = False
+        self.events_sent = 0
+        self.overflows = 0
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._outbuf = bytearray()
+        self._inbuf = bytearray()
+        self._writing = False
+
+    def open(self):
+        """
+        Opens the pseudo terminal and returns the path of its device.
+        """
+        self._master, self._slave = os.openpty()
+        # Without this, the line discipline would echo and mangle the data
+        tty.setraw(self._slave)
+        fl = fcntl.fcntl(self._master, fcntl.F_GETFL)
+        fcntl.fcntl(self._master, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        self.port = os.ttyname(self._slave)
+        asyncio.get_event_loop().add_reader(self._master, self._on_readable)
+        return self.port
+
+    def close(self):
+        loop = asyncio.get_event_loop()
+        loop.remove_reader(self._master)
+        if self._writing:
+            loop.remove_writer(self._master)
+        os.close(self._master)
+        os.close(self._slave)
+        # Stops run(), the descriptor numbers can get reused
+        self._master = None
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._master, 4096)
+        except (BlockingIOError, OSError):
+            return
+        self._inbuf += data
+        self.handle_input()
+
+    def handle_input(self):
+        del self._inbuf[:]
+
+    def write(self, data):
+        if len(self._outbuf) + len(data) > self.max_pending:
+            self.overflows += 1
+            return False
+        self._outbuf += data
+        self._flush()
+        return True
+
+    def _flush(self):
+        loop = asyncio.get_event_loop()
+        try:
+            n = os.write(self._master, self._outbuf) if self._outbuf else 0
+        except BlockingIOError:
+            n = 0
+        del self._outbuf[:n]
+        if self._outbuf and not self._writing:
+            loop.add_writer(self._master, self._flush)
+            self._writing = True
+        elif not self._outbuf and self._writing:
+            loop.remove_writer(self._master)
+            self._writing = False
+
+    def _garbage(self, data, starts, dt):
+        """
+        Inserts random bytes into the byte array data, only between the
+        packets (which start at the offsets in starts), so that every event
+        counted as sent is still there.
+        """
+        ngarbage = self.rng.poisson(self.garbage_rate * dt)
+        if ngarbage == 0:
+            return data.tobytes()
+        bounds = np.append(starts, len(data))
+        pos = bounds[np.sort(self.rng.integers(0, len(bounds), ngarbage))]
+        garbage = self.rng.integers(0, 256, ngarbage, dtype=np.uint8)
+        return np.insert(data, pos, garbage).tobytes()
+
+    def encode_frames(self, vals):
+        """
+        Returns the events encoded as an (n, framelen) array of bytes, one
+        fixed length frame per event.
+        """
+        raise NotImplementedError
+
+    def encode_packets(self, vals):
+        """
+        Returns the events encoded as a flat byte array and the offsets the
+        packets start at in it. Devices which send more than a frame per
+        event override this.
+        """
+        frames = self.encode_frames(vals)
+        return frames.reshape(-1), np.arange(len(frames)) * frames.shape[1]
+
+    def encode_events(self, vals):
+        """
+        Returns the events encoded as a flat byte array, as they go over the
+        wire.
+        """
+        return self.encode_packets(vals)[0]
+
+    def _threshold(self, vals):
+        return vals
+
+    async def run(self):
+        last = time.monotonic()
+        while self._master is not None:
+            await asyncio.sleep(self.tick)
+            if self._master is None:
+                break
+            now = time.monotonic()
+            dt = now - last
+            last = now
+            if not self.streaming:
+                continue
+            vals = self._threshold(self.spectrum.sample(self.rng.poisson(self.rate * dt),
+                                                        self.rng))
+            if self.write(self._garbage(*self.encode_packets(vals), dt)):
+                self.events_sent += len(vals)
+
+
+class SerSpectEmulator(DeviceEmulator):
+    """
+    Speaks the protocol described in README.md. If wave_every is set, a WAVE
+    packet follows every wave_every-th event.
+    """
+
+    # Host->Device packet lengths, SET depends on the property
+    PACKET_LENGTHS = {
+        SerSpect.PACK_NOP: 1,
+        SerSpect.PACK_PING: 1,
+        SerSpect.PACK_GET: 2,
+        SerSpect.PACK_START: 1,
+        SerSpect.PACK_END: 1,
+    }
+
+    READONLY_PROPS = [SerSpect.PROP_FW, SerSpect.PROP_SERNO]
+
+    def __init__(self, serno=1, fw_version=0x0100, wave_every=0, wave_length=32,
+                 **kwargs):
+        super(SerSpectEmulator, self).__init__(channels=4096, **kwargs)
+        self.wave_every = wave_every
+        self.wave_length = wave_length
+        self.props = {
+            SerSpect.PROP_FW: fw_version,
+            SerSpect.PROP_THRESH: 10,
+            SerSpect.PROP_BIAS: 0,
+            SerSpect.PROP_AMP: 0,
+            SerSpect.PROP_RTHRESH: 0,
+            SerSpect.PROP_SERNO: serno,
+        }
+
+    def _error(self, errno):
+        self.write(bytes([SerSpect.PACK_ERROR, errno]))
+
+    def handle_input(self):
+        buf = self._inbuf
+        while buf:
+            typ = buf[0]
+            if typ == SerSpect.PACK_SET:
+                if len(buf) < 2:
+                    break
+                ln = 2 + SerSpect.PROP_LENGTH_MAP.get(buf[1], 0)
+            elif typ in SerSpectEmulator.PACKET_LENGTHS:
+                ln = SerSpectEmulator.PACKET_LENGTHS[typ]
+            else:
+                self._error(SerSpect.EUNKNOWN)
+                del buf[:1]
+                continue
+            if len(buf) < ln:
+                break
+            pack = bytes(buf[:ln])
+            del buf[:ln]
+            self.handle_packet(pack)
+
+    def handle_packet(self, pack):
+        typ = pack[0]
+        if typ == SerSpect.PACK_PING:
+            self.write(bytes([SerSpect.PACK_PONG]))
+        elif typ == SerSpect.PACK_GET:
+            propid = pack[1]
+            if propid not in self.props:
+                self._error(SerSpect.EINKEY)
+                return
+            ln = SerSpect.PROP_LENGTH_MAP[propid]
+            self.write(bytes([SerSpect.PACK_GETRESP, propid]) +
+                       self.props[propid].to_bytes(ln, "little"))
+        elif typ == SerSpect.PACK_SET:
+            propid = pack[1]
+            if propid not in self.props:
+                self._error(SerSpect.EINKEY)
+            elif propid in SerSpectEmulator.READONLY_PROPS:
+                self._error(SerSpect.EINOP)
+            else:
+                self.props[propid] = int.from_bytes(pack[2:], "little")
+        elif typ == SerSpect.PACK_START:
+            self.streaming = True
+        elif typ == SerSpect.PACK_END:
+            self.streaming = False
+
+    def _threshold(self, vals):
+        return vals[vals >= self.props[SerSpect.PROP_THRESH]]
+
+    def encode_frames(self, vals):
+        frames = np.empty((len(vals), 3), dtype=np.uint8)
+        frames[:, 0] = SerSpect.PACK_EVENT
+        frames[:, 1] = vals & 0xff
+        frames[:, 2] = vals >> 8
+        return frames
+
+    def encode_packets(self, vals):
+        # The EVENT packets, with a WAVE packet after some of them
+        frames = self.encode_frames(vals)
+        starts = np.arange(len(vals)) * 3
+        if not self.wave_every:
+            return frames.reshape(-1), starts
+        # The events which get a WAVE after them, counted across batches
+        waves = np.flatnonzero((self.events_sent + np.arange(len(vals))) %
+                               self.wave_every == 0)
+        if not len(waves):
+            return frames.reshape(-1), starts
+        parts = []
+        wavestarts = []
+        prev = 0
+        inserted = [0]
+        for i in waves:
+            parts.append(frames[prev:i + 1].reshape(-1))
+            wave = self._waveform(int(vals[i]))
+            pack = bytes([SerSpect.PACK_WAVE, len(wave)]) + struct.pack(">%dH" % len(wave), *wave)
+            wavestarts.append((i + 1) * 3 + inserted[-1])
+            parts.append(np.frombuffer(pack, dtype=np.uint8))
+            inserted.append(inserted[-1] + len(pack))
+            prev = i + 1
+        parts.append(frames[prev:].reshape(-1))
+        # Events after the k-th WAVE are shifted by the first k WAVE packets
+        starts += np.array(inserted)[np.searchsorted(waves, np.arange(len(vals)))]
+        return np.concatenate(parts), np.sort(np.concatenate([starts, wavestarts]))
+
+    def _waveform(self, height):
+        t = np.arange(self.wave_length)
+        pulse = height * np.exp(-np.maximum(t - 4, 0) / 6.0) * (t >= 4)
+        return np.clip(pulse + self.rng.normal(0, 2, len(t)), 0, 0xffff).astype(int).tolist()
+
+
+class SIPOSEmulator(DeviceEmulator):
+    """
+    The SIPOS board has no commands and streams 2 byte frames all the time,
+    the first byte has its top bit set.
+    """
+
+    def __init__(self, **kwargs):
+        super(SIPOSEmulator, self).__init__(channels=4096, **kwargs)
+        self.streaming = True
+
+    def encode_frames(self, vals):
+        raw = vals ^ 0xfff
+        frames = np.empty((len(vals), 2), dtype=np.uint8)
+        frames[:, 0] = 0x80 | ((raw >> 6) & 0x3f)
+        frames[:, 1] = raw & 0x3f
+        return frames
@@ -0,0 +1,239 @@
+# The MIT License (MIT)
+#
+# Copyright (C) 2016 Institute of Applied and Experimental Physics (http://www.utef.cvut.cz/)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import asyncio
+import datetime
+import numpy as np
+import os
+import struct
+import time
+
+# File layout:
+# |--------|-------|---------|------------|-----------------|----------
+# | magic  | flags | recsize | started_at | started_mono_ns | records...
+# |--------|-------|---------|------------|-----------------|----------
+#   8B       u32     u32       f64          i64
+# All values are little endian. Records hold the host monotonic time the event
+# was received at, the channel, if FLAG_TOT is set, the time over threshold
+# and, if FLAG_DEVICE_TIME is set, the timestamp the device gave the event.
+
+MAGIC = b"IEAPEVT1"
+HEADER = struct.Struct("<8sIIdq")
+
+FLAG_TOT = 0x01
+FLAG_DEVICE_TIME = 0x02
+
+
+def record_dtype(flags):
+    fields = [("timestamp", "<i8"), ("channel", "<u2")]
+    if flags & FLAG_TOT:
+        fields.append(("tot", "<u2"))
+    if flags & FLAG_DEVICE_TIME:
+        fields.append(("device_time", "<u8"))
+    return np.dtype(fields)
+
+
+RECORD_DTYPE = record_dtype(0)
+RECORD_TOT_DTYPE = record_dtype(FLAG_TOT)
+
+
+class EventLogWriter:
+    """
+    Writes events as fixed size binary records. Records are collected into
+    blocks of buffer_size bytes before being written out, the file is synced
+    to disk at most once every sync_interval seconds. If max_bytes or max_age
+    is set, a new timestamped file is started once the current one gets too
+    big or too old. Both only happen as events get written, run tick() or
+    keep_flushed() so that they also happen while no events arrive.
+    """
+
+    def __init__(self, path, tot=False, device_time=False, max_bytes=None, max_age=None,
+                 buffer_size=1 << 20, flush_interval=1.0, sync_interval=10.0):
+        self.path = path
+        self.tot = tot
+        self.device_time = device_time
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.sync_interval = sync_interval
+        self.flags = (FLAG_TOT if tot else 0) | (FLAG_DEVICE_TIME if device_time else 0)
+        self.dtype = record_dtype(self.flags)
+        self.fname = None
+        self._file = None
+        self._buffer = bytearray()
+        self._open()
+
+    @classmethod
+    def for_batch(cls, path, batch, **kwargs):
+        """
+        Makes a writer with the columns an EventBatch of the driver has.
+        """
+        return cls(path, tot=batch.tot is not None,
+                   device_time=batch.timestamps is not None, **kwargs)
+
+    @property
+    def rotating(self):
+        return self.max_bytes is not None or self.max_age is not None
+
+    def _next_fname(self):
+        if not self.rotating:
+            return self.path
+        base, ext = os.path.splitext(self.path)
+        stamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+        fname = "%s-%s%s" % (base, stamp, ext)
+        n = 1
+        while os.path.exists(fname):
+            fname = "%s-%s.%d%s" % (base, stamp, n, ext)
+            n += 1
+        return fname
+
+    def _open(self):
+        self.fname = self._next_fname()
+        self._file = open(self.fname, "wb", buffering=0)
+        self._opened = time.monotonic()
+        self._flushed = self._opened
+        self._synced = self._opened
+        self._size = HEADER.size
+        self._file.write(HEADER.pack(MAGIC, self.flags, self.dtype.itemsize,
+                                     time.time(), time.monotonic_ns()))
+
+    def write(self, values, tot=None, timestamp=None, device_time=None):
+        """
+        Logs a batch of events, all of them get the same timestamp (the
+        current monotonic time in ns if not given).
+        """
+        recs = np.empty(len(values), dtype=self.dtype)
+        recs["timestamp"] = time.monotonic_ns() if timestamp is None else timestamp
+        recs["channel"] = values
+        if self.tot:
+            recs["tot"] = 0 if tot is None else tot
+        if self.device_time:
+            recs["device_time"] = 0 if device_time is None else device_time
+        self._buffer += recs.tobytes()
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+        self.tick()
+
+    def tick(self):
+        """
+        Flushes the buffer and starts a new file if it is time to.
+        """
+        now = time.monotonic()
+        if now - self._flushed >= self.flush_interval:
+            self.flush()
+        if (self.max_bytes is not None and self._size >= self.max_bytes) or \
+                (self.max_age is not None and now - self._opened >= self.max_age):
+            self.rotate()
+
+    async def keep_flushed(self):
+        """
+        Runs tick() every flush_interval seconds until cancelled.
+        """
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.tick()
+
+    def flush(self):
+        if self._buffer:
+            self._file.write(self._buffer)
+            self._size += len(self._buffer)
+            self._buffer = bytearray()
+        now = time.monotonic()
+        self._flushed = now
+        if now - self._synced >= self.sync_interval:
+            os.fsync(self._file.fileno())
+            self._synced = now
+
+    def rotate(self):
+        self._close_file()
+        self._open()
+
+    def _close_file(self):
+        self.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+    def close(self):
+        if self._file is not None:
+            self._close_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class EventLog:
+
+    def __init__(self):
+        self.records = None
+
+    @property
+    def timestamps(self):
+        return self.records["timestamp"]
+
+    @property
+    def channels(self):
+        return self.records["channel"]
+
+    @property
+    def tot(self):
+        return self.records["tot"] if "tot" in self.records.dtype.names else None
+
+    @property
+    def device_times(self):
+        names = self.records.dtype.names
+        return self.records["device_time"] if "device_time" in names else None
+
+    def wall_times(self):
+        """
+        Converts the record timestamps to seconds since the epoch.
+        """
+        return self.started_at + (self.timestamps - self.started_mono_ns) / 1e9
+
+    @staticmethod
+    def load_file(fname):
+        """
+        Memory maps an event log, the records are not read until accessed.
+        """
+        ret = EventLog()
+        with open(fname, "rb") as f:
+            hdr = f.read(HEADER.size)
+        if len(hdr) != HEADER.size:
+            raise ValueError("Truncated header in %s" % fname)
+        magic, flags, recsize, ret.started_at, ret.started_mono_ns = HEADER.unpack(hdr)
+        if magic != MAGIC:
+            raise ValueError("Invalid magic %r in %s" % (magic, fname))
+        dtype = record_dtype(flags)
+        if dtype.itemsize != recsize:
+            raise ValueError("Unexpected record size %d in %s" % (recsize, fname))
+        # Ignore a partially written record at the end
+        count = (os.path.getsize(fname) - HEADER.size) // recsize
+        if count == 0:
+            ret.records = np.zeros(0, dtype=dtype)
+        else:
+            ret.records = np.memmap(fname, dtype=dtype, mode="r",
+                                    offset=HEADER.size, shape=(count,))
+        return ret
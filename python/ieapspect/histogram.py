@@ -0,0 +1,306 @@
+# The MIT License (MIT)
+#
+# Copyright (C) 2016 Institute of Applied and Experimental Physics (http://www.utef.cvut.cz/)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import math
+import numpy as np
+import time
+
+
+class Histogram:
+    """
+    Event histogram backed by a NumPy array. Rebinned views (for power of two
+    bin sizes) and prefix sums are computed lazily and cached until the next
+    change.
+    """
+
+    def __init__(self, channels):
+        self.channels = channels
+        self.clear()
+
+    def clear(self):
+        self.counts = np.zeros(self.channels, dtype=np.int64)
+        self.since = time.time()
+        self.total = 0
+        self._invalidate()
+
+    def load(self, counts, since):
+        """
+        Replaces the contents with counts collected since the since timestamp.
+        """
+        self.counts = np.array(counts, dtype=np.int64)
+        self.since = since
+        self.total = int(self.counts.sum())
+        self._invalidate()
+
+    def add_counts(self, counts, total=None):
+        """
+        Adds a histogram of events, e.g. a bincount of them. Negative counts
+        take events away.
+        """
+        self.counts += counts
+        self.total += int(np.sum(counts)) if total is None else total
+        self._invalidate()
+
+    def _invalidate(self):
+        # Level k of the pyramid holds the counts in bins of 2**k channels
+        self._pyramid = [self.counts]
+        self._cumsum = None
+
+    def add(self, vals):
+        """
+        Adds the events in vals, returns the values which actually fit into
+        the histogram.
+        """
+        vals = np.asarray(vals)
+        vals = vals[(vals >= 0) & (vals < self.channels)]
+        if len(vals) == 0:
+            return vals
+        # bincount costs O(channels), add.at costs O(len(vals)) but with a
+        # much bigger constant
+        if len(vals) > self.channels // 8:
+            self.counts += np.bincount(vals, minlength=self.channels)
+        else:
+            np.add.at(self.counts, vals, 1)
+        self.total += len(vals)
+        self._invalidate()
+        return vals
+
+    def level(self, k):
+        while len(self._pyramid) <= k:
+            prev = self._pyramid[-1]
+            if len(prev) % 2:
+                prev = np.append(prev, 0)
+            self._pyramid.append(prev.reshape(-1, 2).sum(axis=1))
+        return self._pyramid[k]
+
+    def cumsum(self):
+        """
+        Returns the prefix sums of the counts, cumsum()[i] is the amount of
+        events in channels < i.
+        """
+        if self._cumsum is None:
+            self._cumsum = np.concatenate([[0], np.cumsum(self.counts)])
+        return self._cumsum
+
+    def count_above(self, threshold=None):
+        if threshold is None:
+            return self.total
+        cs = self.cumsum()
+        return int(cs[-1] - cs[min(max(threshold + 1, 0), self.channels)])
+
+    def cpm(self, threshold=None, now=None):
+        dt = (time.time() if now is None else now) - self.since
+        return self.count_above(threshold) / dt * 60 if dt > 0 else 0.0
+
+    def binned(self, binsize=1, threshold=None):
+        """
+        Returns the counts summed into bins of binsize channels, leaving out
+        the channels <= threshold. binsize has to be a power of two.
+        """
+        k = _check_binsize(binsize)
+        ret = self.level(k).copy()
+        if threshold is not None and threshold >= 0:
+            first = threshold + 1
+            b = min(first // binsize, len(ret))
+            ret[:b] = 0
+            if b < len(ret) and first % binsize:
+                cs = self.cumsum()
+                ret[b] -= cs[min(first, self.channels)] - cs[b * binsize]
+        return ret
+
+
+def _check_binsize(binsize):
+    k = binsize.bit_length() - 1
+    if binsize <= 0 or binsize != 1 << k:
+        raise ValueError("Bin size %d is not a power of two" % binsize)
+    return k
+
+
+def _bin_rows(rows, binsize):
+    _check_binsize(binsize)
+    if binsize == 1:
+        return rows
+    pad = -rows.shape[1] % binsize
+    if pad:
+        rows = np.pad(rows, ((0, 0), (0, pad)))
+    return rows.reshape(len(rows), -1, binsize).sum(axis=2)
+
+
+class TimeSlices:
+    """
+    Ring of the histograms of the last depth intervals of interval seconds.
+    The slices are aligned to multiples of interval since the epoch, slice k
+    starts at k * interval, except for the first one, which starts at the
+    clear. The histogram of a slice is only allocated once it gets an event,
+    so idle slices take no memory.
+
+    The events of the last window seconds are kept summed up in the window
+    Histogram. It is updated along with the current slice and whenever a
+    slice leaves the window, so no query has to add the slices up. The
+    window is made of the current slice and as many complete ones before it
+    as fit into window seconds.
+    """
+
+    def __init__(self, channels, interval=10.0, depth=360, window=60.0):
+        self.channels = channels
+        self.interval = interval
+        self.depth = depth
+        self.window_slices = min(max(int(round(window / interval)), 1), depth)
+        self.clear()
+
+    @staticmethod
+    def depth_for(channels, depth, max_bytes):
+        """
+        Returns depth limited to the amount of slices of channels which fit
+        into max_bytes.
+        """
+        return max(1, min(depth, max_bytes // (channels * 4)))
+
+    def clear(self, now=None):
+        now = time.time() if now is None else now
+        # uint32 counts of each slice, None until it gets an event
+        self.rows = [None] * self.depth
+        self.totals = np.zeros(self.depth, dtype=np.int64)
+        self.since = now
+        self.first = self.current = self.slice_at(now)
+        self.window = Histogram(self.channels)
+        self.window.since = now
+
+    def slice_at(self, t):
+        return int(math.floor(t / self.interval))
+
+    def start(self, k):
+        return max(k * self.interval, self.since)
+
+    def end(self, k):
+        return (k + 1) * self.interval
+
+    def advance(self, now=None):
+        """
+        Moves on to the slice now falls into, dropping the slices which
+        leave the window or the ring.
+        """
+        k = self.slice_at(time.time() if now is None else now)
+        if k <= self.current:
+            return
+        if k - self.current >= self.depth:
+            # Nothing in the ring is recent enough to be kept
+            self.rows = [None] * self.depth
+            self.totals[:] = 0
+            self.window.clear()
+            self.current = k
+        while self.current < k:
+            leaving = self.current + 1 - self.window_slices
+            row = self.rows[leaving % self.depth]
+            if leaving >= self.first and row is not None:
+                self.window.add_counts(-row.astype(np.int64),
+                                       -int(self.totals[leaving % self.depth]))
+            # Only now, with a single slice window the row is the same
+            self.current += 1
+            self.rows[self.current % self.depth] = None
+            self.totals[self.current % self.depth] = 0
+        self.window.since = self.start(self.current + 1 - self.window_slices)
+
+    def add(self, vals, now=None):
+        """
+        Adds the events in vals to the slice of now (the current time if not
+        given). The values have to fit into the histogram, such as the ones
+        Histogram.add() returns.
+        """
+        self.advance(now)
+        if len(vals) == 0:
+            return
+        idx = self.current % self.depth
+        row = self.rows[idx]
+        if row is None:
+            row = self.rows[idx] = np.zeros(self.channels, dtype=np.uint32)
+        # Same trade-off as in Histogram.add()
+        if len(vals) > self.channels // 8:
+            counts = np.bincount(vals, minlength=self.channels)
+            np.add(row, counts, out=row, casting="unsafe")
+            self.window.add_counts(counts, len(vals))
+        else:
+            np.add.at(row, vals, 1)
+            self.window.add(vals)
+        self.totals[idx] += len(vals)
+
+    def slices(self, last=None, start=None, end=None):
+        """
+        Returns the numbers of the slices in the ring which did not start
+        before the clear, oldest first. last limits them to the last ones,
+        start and end to the slices which lie within [start, end).
+        """
+        first = max(self.first, self.current - self.depth + 1)
+        if last is not None:
+            first = max(first, self.current - last + 1)
+        ks = np.arange(first, self.current + 1)
+        if start is not None:
+            ks = ks[ks * self.interval >= start]
+        if end is not None:
+            ks = ks[(ks + 1) * self.interval <= end]
+        return ks
+
+    def starts(self, ks):
+        return np.maximum(ks * self.interval, self.since)
+
+    def durations(self, ks, now=None):
+        now = time.time() if now is None else now
+        return np.minimum((ks + 1) * self.interval, now) - self.starts(ks)
+
+    def count_above(self, ks, threshold=None):
+        if threshold is None:
+            return self.totals[ks % self.depth]
+        first = max(threshold + 1, 0)
+        return np.array([0 if r is None else int(r[first:].sum(dtype=np.int64))
+                         for r in (self.rows[k % self.depth] for k in ks)],
+                        dtype=np.int64)
+
+    def cpm(self, ks, threshold=None, now=None):
+        durations = self.durations(ks, now)
+        counts = self.count_above(ks, threshold)
+        return np.where(durations > 0, counts / np.maximum(durations, 1e-9) * 60, 0.0)
+
+    def spectrogram(self, ks, binsize=1, threshold=None):
+        """
+        Returns a (slices, bins) array with the counts of the slices ks
+        summed into bins of binsize channels, leaving out the channels <=
+        threshold.
+        """
+        _check_binsize(binsize)
+        ret = np.zeros((len(ks), -(-self.channels // binsize)), dtype=np.int64)
+        for i, k in enumerate(ks):
+            row = self.rows[k % self.depth]
+            if row is None:
+                continue
+            row = row.astype(np.int64)
+            if threshold is not None and threshold >= 0:
+                row[:threshold + 1] = 0
+            ret[i] = _bin_rows(row[np.newaxis], binsize)[0]
+        return ret
+
+    def sum(self, ks):
+        ret = np.zeros(self.channels, dtype=np.int64)
+        for k in ks:
+            row = self.rows[k % self.depth]
+            if row is not None:
+                ret += row
+        return ret
@@ -0,0 +1,130 @@
+# The MIT License (MIT)
+#
+# Copyright (C) 2016 Institute of Applied and Experimental Physics (http://www.utef.cvut.cz/)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import bisect
+import collections
+
+# The hot paths only bump plain integer attributes, Metric tuples are built
+# from them when somebody asks for them.
+
+# samples is a list of (name, labels dict, value) triples
+Metric = collections.namedtuple("Metric", ["name", "type", "help", "samples"])
+
+
+def counter(name, help, value, labels={}):
+    return Metric(name, "counter", help, [(name, labels, value)])
+
+
+def gauge(name, help, value, labels={}):
+    return Metric(name, "gauge", help, [(name, labels, value)])
+
+
+def labeled(name, type, help, values, label):
+    """
+    Builds a metric with one sample per item of the values dict, the keys
+    become the value of label.
+    """
+    return Metric(name, type, help,
+                  [(name, {label: k}, v) for k, v in sorted(values.items())])
+
+
+class Buckets:
+    """
+    Cumulative histogram of observed values with fixed upper bounds, in the
+    Prometheus sense (not to be confused with the spectrum Histogram).
+    """
+
+    # Seconds, from 100 us to 10 s
+    LATENCY_BOUNDS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                      0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, val):
+        self.counts[bisect.bisect_left(self.bounds, val)] += 1
+        self.sum += val
+        self.count += 1
+
+    def metric(self, name, help):
+        samples = []
+        cum = 0
+        for bound, cnt in zip(self.bounds, self.counts):
+            cum += cnt
+            samples.append((name + "_bucket", {"le": "%g" % bound}, cum))
+        samples.append((name + "_bucket", {"le": "+Inf"}, self.count))
+        samples.append((name + "_sum", {}, self.sum))
+        samples.append((name + "_count", {}, self.count))
+        return Metric(name, "histogram", help, samples)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\")
+                                          .replace('"', '\\"'))
+                             for k, v in sorted(labels.items()))
+
+
+def with_labels(metrics, labels):
+    """
+    Adds labels to all the samples of metrics, e.g. to tell the metrics of
+    several devices apart.
+    """
+    return [m._replace(samples=[(name, dict(labels, **lbls), value)
+                                for name, lbls, value in m.samples])
+            for m in metrics]
+
+
+def format_text(metrics):
+    """
+    Formats metrics in the Prometheus text exposition format, the samples of
+    metrics with the same name are listed together.
+    """
+    merged = collections.OrderedDict()
+    for m in metrics:
+        if m.name in merged:
+            merged[m.name].samples.extend(m.samples)
+        else:
+            merged[m.name] = m._replace(samples=list(m.samples))
+    lines = []
+    for m in merged.values():
+        lines.append("# HELP %s %s" % (m.name, m.help))
+        lines.append("# TYPE %s %s" % (m.name, m.type))
+        for name, labels, value in m.samples:
+            lines.append("%s%s %s" % (name, _format_labels(labels), repr(float(value))
+                                      if isinstance(value, float) else value))
+    return "\n".join(lines) + "\n"
+
+
+def to_dict(metrics):
+    """
+    Flattens metrics into a JSON friendly dict, histogram buckets are left
+    out.
+    """
+    return {name + _format_labels(labels): value
+            for m in metrics
+            for name, labels, value in m.samples
+            if not name.endswith("_bucket")}
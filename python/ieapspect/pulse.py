@@ -0,0 +1,233 @@
+# The MIT License (MIT)
+#
+# Copyright (C) 2016 Institute of Applied and Experimental Physics (http://www.utef.cvut.cz/)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import asyncio
+import collections
+import concurrent.futures
+import numpy as np
+
+# All the functions here work on (events, samples) arrays and process all the
+# events at once.
+
+Pulses = collections.namedtuple("Pulses", ["height", "peak_index", "baseline",
+                                           "tot", "rise_time"])
+
+
+def as_array(waveforms):
+    """
+    Converts waveforms to a 2D float array, waveforms of different lengths
+    are padded with their last sample.
+    """
+    if isinstance(waveforms, np.ndarray) and waveforms.ndim == 2:
+        return waveforms.astype(np.float64)
+    ln = max(len(w) for w in waveforms)
+    ret = np.empty((len(waveforms), ln), dtype=np.float64)
+    for i, w in enumerate(waveforms):
+        ret[i, :len(w)] = w
+        ret[i, len(w):] = w[-1] if len(w) else 0
+    return ret
+
+
+def subtract_baseline(w, nsamples):
+    """
+    Subtracts the mean of the first nsamples samples of every waveform.
+    Returns the corrected waveforms and the baselines.
+    """
+    baseline = w[:, :max(nsamples, 1)].mean(axis=1)
+    return w - baseline[:, None], baseline
+
+
+def trapezoidal(w, rise, flat, tau=None):
+    """
+    Trapezoidal shaper (Jordanov & Knoll). With tau (the decay constant of the
+    input pulses in samples) set, the exponential tail is pole-zero
+    compensated, without it the input is treated as a step. The height of the
+    flat top equals the input pulse amplitude.
+    """
+    k = rise
+    l = rise + flat
+    n = w.shape[1]
+    xp = np.concatenate([np.repeat(w[:, :1], k + l, axis=1), w], axis=1)
+    d = xp[:, k + l:] - xp[:, l:l + n] - xp[:, k:k + n] + xp[:, :n]
+    if tau is None:
+        return np.cumsum(d, axis=1) / k
+    m = 1 / np.expm1(1 / tau)
+    r = np.cumsum(d, axis=1) + m * d
+    return np.cumsum(r, axis=1) / (k * (m + 1))
+
+
+def cr_rc(w, tau, order=1):
+    """
+    CR-(RC)^order shaper with all time constants equal to tau samples. The
+    filters are recursive, so this iterates over the samples, but each step
+    still processes all the events at once.
+    """
+    a = tau / (tau + 1)
+    b = 1 / (tau + 1)
+    ret = np.empty_like(w)
+    y = np.zeros(w.shape[0])
+    prev = w[:, 0].copy()
+    for i in range(w.shape[1]):
+        y = a * (y + w[:, i] - prev)
+        prev = w[:, i]
+        ret[:, i] = y
+    for _ in range(order):
+        y = ret[:, 0].copy()
+        for i in range(w.shape[1]):
+            y = y + b * (ret[:, i] - y)
+            ret[:, i] = y
+    return ret
+
+
+def peak(w):
+    idx = w.argmax(axis=1)
+    return w[np.arange(len(w)), idx], idx
+
+
+def time_over_threshold(w, threshold):
+    return (w > threshold).sum(axis=1)
+
+
+def rise_time(w, height, low=0.1, high=0.9):
+    """
+    Amount of samples between the first crossings of low * height and
+    high * height.
+    """
+    ilow = (w >= low * height[:, None]).argmax(axis=1)
+    ihigh = (w >= high * height[:, None]).argmax(axis=1)
+    return ihigh - ilow
+
+
+def _spec_value(val):
+    for typ in (int, float):
+        try:
+            return typ(val)
+        except ValueError:
+            pass
+    return val
+
+
+class PulseProcessor:
+    """
+    Extracts pulse parameters from batches of waveforms. shaper is None,
+    "trapezoidal" or "cr-rc", shaper_args are passed to the shaping function.
+    The processing can be moved off the event loop by setting executor to
+    "thread", "process" or a concurrent.futures.Executor instance.
+    """
+
+    SHAPERS = ["none", "trapezoidal", "cr-rc"]
+
+    # Spec options which set up the processor rather than the shaper
+    _SPEC_KEYS = {"baseline": "baseline_samples", "threshold": "threshold",
+                  "polarity": "polarity", "scale": "scale", "executor": "executor"}
+
+    def __init__(self, baseline_samples=8, shaper=None, shaper_args={},
+                 threshold=0, polarity=1, scale=1, executor=None):
+        self.baseline_samples = baseline_samples
+        self.shaper = shaper
+        self.shaper_args = dict(shaper_args)
+        self.threshold = threshold
+        self.polarity = polarity
+        self.scale = scale
+        if executor == "thread":
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        elif executor == "process":
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+        self._executor = executor
+
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Makes a processor out of a command line spec, a shaper name from
+        SHAPERS optionally followed by comma separated key=value options,
+        e.g. "trapezoidal:rise=8,flat=4,tau=50,scale=4". The baseline,
+        threshold, polarity, scale and executor options set up the processor,
+        the rest is passed to the shaper.
+        """
+        name, _, opts = spec.partition(":")
+        if name not in cls.SHAPERS:
+            raise ValueError("Unknown shaper %s" % name)
+        kwargs = {}
+        shaper_args = {}
+        for opt in filter(None, opts.split(",")):
+            key, sep, val = opt.partition("=")
+            if not sep:
+                raise ValueError("Expected key=value, got %s" % opt)
+            if key in cls._SPEC_KEYS:
+                kwargs[cls._SPEC_KEYS[key]] = _spec_value(val)
+            else:
+                shaper_args[key] = _spec_value(val)
+        ret = cls(shaper=None if name == "none" else name,
+                  shaper_args=shaper_args, **kwargs)
+        try:
+            # Catches missing and unknown shaper arguments right away
+            ret.process(np.zeros((1, 2)))
+        except TypeError as e:
+            raise ValueError("Invalid options for %s: %s" % (name, e))
+        return ret
+
+    def __getstate__(self):
+        # The executor stays in the parent process
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        return state
+
+    def process(self, waveforms):
+        w = as_array(waveforms) * self.polarity
+        w, baseline = subtract_baseline(w, self.baseline_samples)
+        if self.shaper == "trapezoidal":
+            w = trapezoidal(w, **self.shaper_args)
+        elif self.shaper == "cr-rc":
+            w = cr_rc(w, **self.shaper_args)
+        elif self.shaper is not None:
+            raise ValueError("Unknown shaper %s" % self.shaper)
+        height, idx = peak(w)
+        return Pulses(height=height,
+                      peak_index=idx,
+                      baseline=baseline,
+                      tot=time_over_threshold(w, self.threshold),
+                      rise_time=rise_time(w, height))
+
+    async def process_async(self, waveforms):
+        if self._executor is None:
+            return self.process(waveforms)
+        return await asyncio.get_event_loop().run_in_executor(
+                                self._executor, self.process, waveforms)
+
+    async def batches(self, spect, max_events=4096, max_latency=0.05):
+        """
+        Wraps spect.batches(), replacing the values of batches carrying
+        waveforms by the (scaled) pulse heights and tot by the time over
+        threshold, so that they can be fed into a Histogram directly.
+        """
+        async for batch in spect.batches(max_events, max_latency):
+            if batch.waveforms is None or len(batch.values) == 0:
+                yield batch
+                continue
+            pulses = await self.process_async(batch.waveforms)
+            values = np.clip(np.rint(pulses.height / self.scale), 0, None)
+            yield batch._replace(values=values.astype(np.int64),
+                                 tot=pulses.tot)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
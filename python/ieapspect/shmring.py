@@ -0,0 +1,131 @@
+# The MIT License (MIT)
+#
+# Copyright (C) 2016 Institute of Applied and Experimental Physics (http://www.utef.cvut.cz/)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import asyncio
+import mmap
+import numpy as np
+import os
+import struct
+
+# The layout is described in wrappers/shmring.h
+MAGIC = b"IEAPRNG1"
+OFF_SIZE = 8
+OFF_HEAD = 64
+OFF_TAIL = 128
+OFF_DATA = 256
+
+
+class RingReader:
+    """
+    Consumer side of the byte ring the wrappers write into when started with
+    wrapper_args(). The ring lives in an anonymous memfd, which is passed to
+    the wrapper together with the write end of a pipe the wrapper pokes
+    whenever it adds data. The pipe getting closed means that the wrapper has
+    exited.
+
+    peek() returns a view straight into the mapping, which stays valid until
+    the data are consume()d.
+    """
+
+    # Bytes copied from the start of the ring when the data wrap around
+    JOIN_SIZE = 1 << 16
+
+    def __init__(self, size=1 << 22):
+        self.size = size
+        self.fd = os.memfd_create("ieapspect-ring")
+        os.ftruncate(self.fd, OFF_DATA + size)
+        self.map = mmap.mmap(self.fd, OFF_DATA + size)
+        self.map[:len(MAGIC)] = MAGIC
+        struct.pack_into("<Q", self.map, OFF_SIZE, size)
+        self._head = np.ndarray(1, dtype=np.uint64, buffer=self.map, offset=OFF_HEAD)
+        self._tail = np.ndarray(1, dtype=np.uint64, buffer=self.map, offset=OFF_TAIL)
+        self.data = memoryview(self.map)[OFF_DATA:]
+        self._notify_r, self._notify_w = os.pipe()
+        os.set_blocking(self._notify_r, False)
+        os.set_blocking(self._notify_w, False)
+        self._event = asyncio.Event()
+        self.eof = False
+
+    def wrapper_args(self):
+        return ["--ring", str(self.fd), str(self._notify_w)]
+
+    @property
+    def pass_fds(self):
+        return (self.fd, self._notify_w)
+
+    def started(self):
+        """
+        To be called once the wrapper got the descriptors, we must not keep
+        the write end of the pipe open, or we would never see it exit.
+        """
+        os.close(self._notify_w)
+        os.close(self.fd)
+        asyncio.get_event_loop().add_reader(self._notify_r, self._on_notify)
+
+    def _on_notify(self):
+        try:
+            data = os.read(self._notify_r, 4096)
+        except BlockingIOError:
+            return
+        if not data:
+            self.eof = True
+            asyncio.get_event_loop().remove_reader(self._notify_r)
+        self._event.set()
+
+    @property
+    def available(self):
+        return int(self._head[0]) - int(self._tail[0])
+
+    async def peek(self, min_bytes=1):
+        """
+        Waits until at least min_bytes are available and returns them (and
+        whatever else is there). Raises EOFError if the wrapper exits first.
+        """
+        while True:
+            self._event.clear()
+            avail = self.available
+            if avail >= min_bytes:
+                break
+            if self.eof:
+                raise EOFError("The wrapper has exited")
+            await self._event.wait()
+        start = int(self._tail[0]) % self.size
+        contiguous = min(avail, self.size - start)
+        if contiguous >= min_bytes:
+            return self.data[start:start + contiguous]
+        wrapped = min(avail - contiguous, max(min_bytes - contiguous, self.JOIN_SIZE))
+        return bytes(self.data[start:]) + bytes(self.data[:wrapped])
+
+    def consume(self, n):
+        self._tail[0] = int(self._tail[0]) + n
+
+    def close(self):
+        if not self.eof:
+            asyncio.get_event_loop().remove_reader(self._notify_r)
+            self.eof = True
+        os.close(self._notify_r)
+        self._head = self._tail = self.data = None
+        try:
+            self.map.close()
+        except BufferError:
+            # Somebody still holds a view, the mapping goes with it
+            pass
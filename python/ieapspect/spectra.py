@@ -0,0 +1,94 @@
+# The MIT License (MIT)
+#
+# Copyright (C) 2016 Institute of Applied and Experimental Physics (http://www.utef.cvut.cz/)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections
+import numpy as np
+
+# Synthetic spectra for the emulated devices
+
+# mean and sigma are fractions of the channel count
+Peak = collections.namedtuple("Peak", ["mean", "sigma", "weight"])
+
+# Roughly what the Pu-239/Am-241/Cm-244 source looks like on a bare BPW34
+# (5.157, 5.486 and 5.805 MeV lines), with a tail of low energy noise
+ALPHA_PEAKS = [
+    Peak(mean=0.515, sigma=0.008, weight=0.33),
+    Peak(mean=0.548, sigma=0.008, weight=0.33),
+    Peak(mean=0.580, sigma=0.008, weight=0.34),
+]
+
+# What DummySpect has always generated
+DUMMY_PEAKS = [
+    Peak(mean=0.05, sigma=0.025, weight=0.2),
+    Peak(mean=0.5, sigma=0.075, weight=0.8),
+]
+
+
+class SpectrumModel:
+    """
+    Mixture of gaussian peaks over a uniform noise floor, noise is the
+    fraction of events which come from the noise floor.
+    """
+
+    def __init__(self, channels, peaks=ALPHA_PEAKS, noise=0.05):
+        self.channels = channels
+        self.peaks = list(peaks)
+        self.noise = noise
+
+    def sample(self, n, rng):
+        """
+        Returns n channel numbers in [0, channels).
+        """
+        weights = np.array([p.weight for p in self.peaks], dtype=np.float64)
+        if weights.sum() > 0:
+            probs = np.append(weights / weights.sum() * (1 - self.noise), self.noise)
+        else:
+            probs = np.array([1.0])
+        comp = rng.choice(len(probs), size=n, p=probs)
+        means = np.array([p.mean for p in self.peaks] + [0])[comp]
+        sigmas = np.array([p.sigma for p in self.peaks] + [0])[comp]
+        vals = rng.normal(means, sigmas)
+        noise = comp == len(self.peaks)
+        vals[noise] = rng.uniform(0, 1, noise.sum())
+        vals = np.floor(vals * self.channels).astype(np.int64)
+        # Like DummySpect always did, redraw what falls outside of the range
+        bad = (vals < 0) | (vals >= self.channels)
+        if bad.any():
+            vals[bad] = self.sample(int(bad.sum()), rng)
+        return vals
+
+
+class HistogramModel:
+    """
+    Draws the events from the distribution of an existing histogram (for
+    example HistFile.vals).
+    """
+
+    def __init__(self, counts):
+        counts = np.asarray(counts, dtype=np.float64)
+        if counts.sum() <= 0:
+            raise ValueError("The histogram is empty")
+        self.channels = len(counts)
+        self.p = counts / counts.sum()
+
+    def sample(self, n, rng):
+        return rng.choice(self.channels, size=n, p=self.p)
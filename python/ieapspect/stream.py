@@ -0,0 +1,277 @@
+# The MIT License (MIT)
+#
+# Copyright (C) 2016 Institute of Applied and Experimental Physics (http://www.utef.cvut.cz/)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import json
+import numpy as np
+import struct
+import types
+
+from ieapspect import EventBatch, Spectrometer
+
+# Output formats of the ieapspect-dm100 and ieapspect-spectrig tools:
+#   json            one JSON object per event, e.g. {"value": 3, "tot": 10}
+#   ndjson-batched  one JSON object per batch, holding a list per column and
+#                   the event count in "n"
+#   binary          the blocks described below
+FORMATS = ["json", "ndjson-batched", "binary"]
+
+# Binary stream layout, after the magic come the blocks:
+# |--------|---------|--------|-------|--------|---------|------------
+# | magic  | payload | events | flags | wavlen | records | waveforms
+# |--------|---------|--------|-------|--------|---------|------------
+#   8B       u32       u32      u16     u16
+# All values are little endian. payload is the length of the records and
+# waveforms in bytes. The records hold the value of the events and, if the
+# flags say so, their timestamp and time over threshold. If FLAG_WAVEFORM is
+# set, the u16 samples of the waveforms follow the records, wavlen of them
+# per event. Waveforms of different lengths are written with wavlen 0, as a
+# u16 length per event followed by the samples of all of them.
+
+MAGIC = b"IEAPSTR1"
+BLOCK = struct.Struct("<IIHH")
+
+FLAG_TIMESTAMP = 0x01
+FLAG_TOT = 0x02
+FLAG_WAVEFORM = 0x04
+
+COLUMNS = ["value", "waveform", "tot", "timestamp"]
+
+# EventBatch field of each column
+_FIELDS = {"value": "values", "waveform": "waveforms", "tot": "tot",
+           "timestamp": "timestamps"}
+
+
+def record_dtype(flags):
+    fields = [("value", "<u4")]
+    if flags & FLAG_TIMESTAMP:
+        fields.append(("timestamp", "<u8"))
+    if flags & FLAG_TOT:
+        fields.append(("tot", "<u2"))
+    return np.dtype(fields)
+
+
+def _waveform_column(wfs):
+    """
+    Makes an array out of equally long waveforms, ragged ones stay a list of
+    arrays like in the batches of the drivers.
+    """
+    if len(set(map(len, wfs))) > 1:
+        return [np.asarray(w) for w in wfs]
+    return np.array(wfs)
+
+
+def encode_block(batch):
+    """
+    Encodes an EventBatch as a block of the binary format.
+    """
+    n = len(batch.values)
+    flags = 0
+    if batch.timestamps is not None:
+        flags |= FLAG_TIMESTAMP
+    if batch.tot is not None:
+        flags |= FLAG_TOT
+    recs = np.empty(n, dtype=record_dtype(flags))
+    recs["value"] = batch.values
+    if batch.timestamps is not None:
+        recs["timestamp"] = batch.timestamps
+    if batch.tot is not None:
+        recs["tot"] = batch.tot
+    parts = [recs.tobytes()]
+    wavlen = 0
+    if batch.waveforms is not None:
+        flags |= FLAG_WAVEFORM
+        if isinstance(batch.waveforms, np.ndarray):
+            wavlen = batch.waveforms.shape[1]
+            parts.append(batch.waveforms.astype("<u2").tobytes())
+        else:
+            parts.append(np.array([len(w) for w in batch.waveforms], dtype="<u2").tobytes())
+            parts.extend(np.asarray(w, dtype="<u2").tobytes() for w in batch.waveforms)
+    payload = sum(map(len, parts))
+    return BLOCK.pack(payload, n, flags, wavlen) + b"".join(parts)
+
+
+class StreamWriter:
+    """
+    Writes EventBatch tuples to the binary file object out in one of FORMATS,
+    flushing it once per batch. The JSON formats only hold the given columns,
+    the binary one always has the values.
+    """
+
+    def __init__(self, out, format="json", columns=COLUMNS):
+        if format not in FORMATS:
+            raise ValueError("Unknown format %r" % format)
+        self.out = out
+        self.format = format
+        self.columns = columns
+        if format == "binary":
+            self.out.write(MAGIC)
+
+    def _json_columns(self, batch):
+        cols = []
+        for name in self.columns:
+            col = getattr(batch, _FIELDS[name])
+            if col is None:
+                continue
+            if isinstance(col, np.ndarray):
+                col = col.tolist()
+            else:
+                col = [w.tolist() for w in col]
+            cols.append((name, col))
+        return cols
+
+    def encode(self, batch):
+        if self.format == "binary":
+            return encode_block(batch)
+        cols = self._json_columns(batch)
+        if self.format == "ndjson-batched":
+            obj = dict(cols, n=len(batch.values))
+            return (json.dumps(obj) + "\n").encode()
+        names = [name for name, _ in cols]
+        return "".join(json.dumps(dict(zip(names, ev))) + "\n"
+                       for ev in zip(*(col for _, col in cols))).encode()
+
+    def write(self, batch):
+        self.out.write(self.encode(batch))
+        self.out.flush()
+
+
+class StreamDecoder:
+    """
+    Incremental decoder of what StreamWriter wrote, in any of the formats,
+    which is recognized from the start of the data. feed() takes whatever was
+    read and returns the EventBatch tuples that got complete, so it can be
+    driven by non-blocking reads. Consecutive json events are collected into
+    a single batch.
+    """
+
+    def __init__(self):
+        self.format = None
+        self._buf = bytearray()
+
+    def feed(self, data):
+        self._buf += data
+        if self.format is None:
+            if len(self._buf) < len(MAGIC) and MAGIC.startswith(self._buf):
+                return []
+            if self._buf.startswith(MAGIC):
+                self.format = "binary"
+                del self._buf[:len(MAGIC)]
+            else:
+                self.format = "json"
+        if self.format == "binary":
+            return self._decode_blocks()
+        return self._decode_lines()
+
+    def _decode_blocks(self):
+        buf = self._buf
+        ret = []
+        pos = 0
+        while len(buf) - pos >= BLOCK.size:
+            payload, n, flags, wavlen = BLOCK.unpack_from(buf, pos)
+            end = pos + BLOCK.size + payload
+            if len(buf) < end:
+                break
+            ret.append(self._decode_block(bytes(buf[pos + BLOCK.size:end]),
+                                          n, flags, wavlen))
+            pos = end
+        del buf[:pos]
+        return ret
+
+    @staticmethod
+    def _decode_block(data, n, flags, wavlen):
+        dtype = record_dtype(flags)
+        recs = np.frombuffer(data, dtype=dtype, count=n)
+        waveforms = None
+        if flags & FLAG_WAVEFORM:
+            off = n * dtype.itemsize
+            if wavlen:
+                waveforms = np.frombuffer(data, dtype="<u2", count=n * wavlen,
+                                          offset=off).reshape(n, wavlen)
+            else:
+                lens = np.frombuffer(data, dtype="<u2", count=n, offset=off)
+                samples = np.frombuffer(data, dtype="<u2", offset=off + 2 * n)
+                waveforms = np.split(samples, np.cumsum(lens[:-1], dtype=np.int64))
+        return EventBatch(
+            values=recs["value"],
+            timestamps=recs["timestamp"] if flags & FLAG_TIMESTAMP else None,
+            tot=recs["tot"] if flags & FLAG_TOT else None,
+            waveforms=waveforms)
+
+    def _decode_lines(self):
+        end = self._buf.rfind(b"\n") + 1
+        if not end:
+            return []
+        lines = bytes(self._buf[:end]).split(b"\n")[:-1]
+        del self._buf[:end]
+        ret = []
+        evs = []
+        for line in lines:
+            if not line.strip():
+                continue
+            obj = json.loads(line)
+            if "n" not in obj:
+                evs.append(types.SimpleNamespace(**obj))
+                continue
+            if evs:
+                ret.append(Spectrometer._make_batch(evs))
+                evs = []
+            ret.append(self._batch_from_columns(obj))
+        if evs:
+            ret.append(Spectrometer._make_batch(evs))
+        return ret
+
+    @staticmethod
+    def _batch_from_columns(obj):
+        waveforms = None
+        if "waveform" in obj:
+            waveforms = _waveform_column(obj["waveform"])
+        if "value" in obj:
+            values = np.array(obj["value"])
+        else:
+            values = np.array([max(w) for w in obj["waveform"]])
+        return EventBatch(
+            values=values,
+            timestamps=np.array(obj["timestamp"], dtype=np.uint64)
+            if "timestamp" in obj else None,
+            tot=np.array(obj["tot"]) if "tot" in obj else None,
+            waveforms=waveforms)
+
+
+def read_batches(f, chunk_size=1 << 16):
+    """
+    Yields the EventBatch tuples read from f until its end, f is either a
+    path or a binary file object such as sys.stdin.buffer. A partially
+    written event at the end is ignored.
+    """
+    if isinstance(f, str):
+        with open(f, "rb") as fil:
+            yield from read_batches(fil, chunk_size)
+        return
+    decoder = StreamDecoder()
+    # Returns what is there instead of waiting for the whole chunk
+    read = getattr(f, "read1", f.read)
+    while True:
+        data = read(chunk_size)
+        if not data:
+            break
+        yield from decoder.feed(data)
@@ -31,7 +31,20 @@ state = {
 	ws: null,
 	cfgpropwid: {},
 	autosave: null,
+	autosaveFrom: null,
+	sliceInterval: null,
 	lastFrame: 0,
+	binary: false,
+	seq: 0,
+	binned: null,
+	binmax: 0,
+	bintotal: 0,
+	canvas: null,
+	ymax: null,
+	dirty: [],
+	dirtyMark: null,
+	fullRedraw: true,
+	device: null,
 }
 
 function clamp(v, mi, mx) {
@@ -65,11 +78,36 @@ function getBarWidth() {
 	return ($(state.svg[0][0]).width() / state.histogram.length * state.binsize);
 }
 
-function getBarHeight() {
-	var max = d3.max(state.histogram);
-	if (max == 0)
-		return 10;
-	return $(state.svg[0][0]).height() / max;
+// The binned view is maintained incrementally, so that a redraw does not
+// have to walk over all the channels. It is only recomputed from scratch
+// on snapshots and binsize/threshold changes.
+function rebin() {
+	var nbins = Math.ceil(state.histogram.length / state.binsize);
+	state.binned = new Float64Array(nbins);
+	state.bintotal = 0;
+	for (var i = state.threshold + 1; i < state.histogram.length; i++) {
+		state.binned[Math.floor(i / state.binsize)] += state.histogram[i];
+		state.bintotal += state.histogram[i];
+	}
+	state.binmax = d3.max(state.binned);
+	state.dirty = [];
+	state.dirtyMark = new Uint8Array(nbins);
+	state.fullRedraw = true;
+}
+
+function addCounts(ch, n) {
+	state.histogram[ch] += n;
+	if (ch > state.threshold) {
+		var b = Math.floor(ch / state.binsize);
+		state.binned[b] += n;
+		state.bintotal += n;
+		if (state.binned[b] > state.binmax)
+			state.binmax = state.binned[b];
+		if (state.canvas && !state.dirtyMark[b]) {
+			state.dirtyMark[b] = 1;
+			state.dirty.push(b);
+		}
+	}
 }
 
 function lpad(s, t, p) {
@@ -88,32 +126,38 @@ function updateTimer() {
 	$("#timer").text(lpad(hrs, 2, "0") + ":" + lpad(mins, 2, "0") + ":" + lpad(secs, 2, "0"));
 }
 
+// The canvas renderer rounds the top of the y axis up to a nice value, so
+// that the bars only have to be redrawn from scratch once in a while and
+// not every time the highest bin grows.
+function niceMax(v) {
+	if (v == 0)
+		return 1;
+	return d3.scale.linear().domain([0, v]).nice().domain()[1];
+}
+
 function update() {
 	var barw = getBarWidth();
 
-	var binned = new Array(state.histogram.length / state.binsize).fill(0);
+	var binned = state.binned;
 
-	for (var i = 0; i < state.histogram.length; i++) {
-		if (i > state.threshold)
-			binned[Math.floor(i / state.binsize)] += state.histogram[i];
-	}
-
-	var cpm = binned.reduce(function(i, v) { return i + v; }) /
-		(endTime() - state.since) * 60;
+	var cpm = state.bintotal / (endTime() - state.since) * 60;
 	$("#cpm").text(cpm.toFixed(2) + " CPM")
 
-	var maxh = d3.max(binned);
-	var perh = maxh == 0 ? 10 : $(state.svg[0][0]).height() / maxh;
+	var ymax = state.canvas ? niceMax(state.binmax) : state.binmax;
+	if (ymax != state.ymax) {
+		state.ymax = ymax;
+		state.fullRedraw = true;
+	}
 
 	var tickcount = 10;
-	var tstep = d3.max(binned) / tickcount;
+	var tstep = ymax / tickcount;
 	var tvals = [0];
 	for (var i = 1; i < tickcount; i++)
 		tvals.push(tvals[tvals.length - 1] + tstep);
 
 	state.xscale.range([0, barw * binned.length]);
 
-	state.yscale.domain([d3.max(binned), 0])
+	state.yscale.domain([ymax, 0])
 				.range([0, $(state.svg[0][0]).height()]);
 	var yaxis = d3.svg.axis()
 					.tickValues(tvals)
@@ -133,6 +177,19 @@ function update() {
 	state.svg.selectAll(".y.axis")
 		.call(yaxis);
 
+	if (state.canvas)
+		renderCanvas(barw);
+	else
+		renderSVG(barw);
+
+	d3.select(".pane")
+		.attr("width", $(state.svg[0][0]).width() + "px")
+		.attr("height", $(state.svg[0][0]).height() + "px");
+}
+
+function renderSVG(barw) {
+	var binned = state.binned;
+
 	for (var i = 0; i < binned.length; i++) {
 		if (binned[i] > 0) {
 			if (!state.binbars[i])
@@ -172,10 +229,86 @@ function update() {
 
 	bs.attr("height", function(d) { return d.h + "px"; })
 		.attr("y", function(d) { return d.y; });
+}
 
-	d3.select(".pane")
-		.attr("width", $(state.svg[0][0]).width() + "px")
-		.attr("height", $(state.svg[0][0]).height() + "px");
+function initCanvas() {
+	state.canvas = d3.select("body").append("canvas")
+						.style("position", "absolute")
+						.style("z-index", 0);
+	state.svg.style("position", "relative")
+			.style("z-index", 1)
+			.style("background-color", "transparent");
+}
+
+function resizeCanvas() {
+	var svg = $(state.svg[0][0]);
+	var el = state.canvas[0][0];
+	var off = svg.offset();
+	// Place the canvas over the plot area, inside the SVG padding
+	state.canvas.style("left", (off.left + parseInt(svg.css("padding-left"))) + "px")
+				.style("top", (off.top + parseInt(svg.css("padding-top"))) + "px");
+	if (el.width != svg.width() || el.height != svg.height()) {
+		el.width = svg.width();
+		el.height = svg.height();
+		state.fullRedraw = true;
+	}
+}
+
+// Pixel rectangle of bin i, rounded so that redrawing a bin always touches
+// exactly the same pixels
+function binRect(i, barw) {
+	var sw = barw * state.zoom.scale();
+	var x = state.xscale(i * state.binsize);
+	var w = sw - Math.floor(sw * 0.15);
+	var bx = Math.round(x);
+	return {x: bx, w: Math.max(1, Math.round(x + w) - bx)};
+}
+
+function binAt(px) {
+	return Math.floor(state.xscale.invert(px) / state.binsize);
+}
+
+function drawBin(ctx, i, barw, height) {
+	if (i < 0 || i >= state.binned.length || state.binned[i] <= 0)
+		return;
+	var r = binRect(i, barw);
+	if (r.x + r.w < 0 || r.x > ctx.canvas.width)
+		return;
+	var y = Math.floor(state.yscale(state.binned[i]));
+	ctx.fillRect(r.x, y, r.w, height - y);
+}
+
+function renderCanvas(barw) {
+	resizeCanvas();
+	var ctx = state.canvas[0][0].getContext("2d");
+	var width = ctx.canvas.width;
+	var height = ctx.canvas.height;
+	ctx.fillStyle = "dodgerblue";
+
+	if (state.fullRedraw) {
+		ctx.clearRect(0, 0, width, height);
+		var first = Math.max(0, binAt(0) - 1);
+		var last = Math.min(state.binned.length - 1, binAt(width) + 1);
+		for (var i = first; i <= last; i++)
+			drawBin(ctx, i, barw, height);
+	} else {
+		for (var k = 0; k < state.dirty.length; k++) {
+			var r = binRect(state.dirty[k], barw);
+			if (r.x + r.w < 0 || r.x > width)
+				continue;
+			// When zoomed out, multiple bins can share a pixel column, so
+			// everything overlapping the cleared area has to be redrawn
+			ctx.clearRect(r.x, 0, r.w, height);
+			var last = binAt(r.x + r.w) + 1;
+			for (var i = binAt(r.x) - 1; i <= last; i++)
+				drawBin(ctx, i, barw, height);
+		}
+	}
+
+	for (var k = 0; k < state.dirty.length; k++)
+		state.dirtyMark[state.dirty[k]] = 0;
+	state.dirty = [];
+	state.fullRedraw = false;
 }
 
 function updateLoop(timestamp) {
@@ -219,8 +352,26 @@ function downloadTXT() {
 	download("data-" + startlabel.substring(0, 19) + ".txt", data);
 }
 
+// Saves the time slices the server completed since the previous save, unlike
+// saving and clearing the histogram this does not lose any events
+function saveSlices() {
+	var to = Math.floor(Date.now() / 1000 / state.sliceInterval) * state.sliceInterval;
+	var params = {to: to};
+	if (state.autosaveFrom !== null)
+		params.from = state.autosaveFrom;
+	var startlabel = (new Date(Math.max(params.from || 0, state.since) * 1000)).toISOString();
+	state.autosaveFrom = to;
+	$.get("data.txt" + deviceQuery(params), function(data) {
+		download("data-" + startlabel.substring(0, 19) + ".txt", data);
+	});
+}
+
 function init() {
 	state.svg = d3.select("body").append("svg");
+	// The SVG renderer is kept as a fallback, request it with ?renderer=svg
+	if (location.search.indexOf("renderer=svg") < 0 &&
+			!!document.createElement("canvas").getContext)
+		initCanvas();
 
 	state.xscale = d3.scale.linear()
 			.domain([0, state.histogram.length])
@@ -238,6 +389,7 @@ function init() {
 
 		state.zoom.translate([tx, tr[1]]);
 
+		state.fullRedraw = true;
 		update();
 	});
 
@@ -252,17 +404,19 @@ function init() {
 		.attr("class", "pane")
 		.call(state.zoom);
 
-	state.binsize = $("#binsize").val();
+	state.binsize = parseInt($("#binsize").val());
 	$("#binsize").change(function() {
-		state.binsize = $("#binsize").val();
+		state.binsize = parseInt($("#binsize").val());
 
 		state.svg.selectAll(".bar").remove();
 
 		state.binbars = new Array(state.histogram.length / state.binsize).fill(null);
+		rebin();
 		update();
 	}).trigger("change");
 	$("#threshold").change(function() {
-		state.threshold = $(this).val();
+		state.threshold = parseInt($(this).val()) || 0;
+		rebin();
 		update();
 	}).trigger("change");
 	$("#csv").click(downloadTXT);
@@ -271,8 +425,11 @@ function init() {
 		var v = parseInt($(ev.target).val());
 		if (isNaN(v)) {
 			state.autosave = null;
+		} else if (state.sliceInterval) {
+			state.autosaveFrom = null;
+			state.autosave = setInterval(saveSlices, v * 1000);
 		} else {
-			setInterval(function() {
+			state.autosave = setInterval(function() {
 				downloadTXT();
 				commandSender("clear")();
 			}, v * 1000);
@@ -280,6 +437,61 @@ function init() {
 	});
 }
 
+// See the protocol description in ieapspect-web. Note that the typed arrays
+// use the platform byte order, which is little endian everywhere we care about.
+MSG_SNAPSHOT = 0x01
+MSG_DELTA = 0x02
+
+function handleBinaryMessage(buf) {
+	var dv = new DataView(buf);
+	var type = dv.getUint8(0);
+	var seq = dv.getUint32(4, true);
+	if (type == MSG_SNAPSHOT) {
+		console.log("History received!");
+		var n = dv.getUint32(16, true);
+		state.seq = seq;
+		state.since = dv.getFloat64(8, true);
+		state.histogram = new Uint32Array(buf, 20, n);
+		rebin();
+	} else if (type == MSG_DELTA) {
+		if (seq <= state.seq)
+			return; // Already contained in the last snapshot
+		if (seq != state.seq + 1)
+			commandSender("resync")();
+		state.seq = seq;
+		var n = dv.getUint32(8, true);
+		var pairs = new Uint32Array(buf, 12, n * 2);
+		for (var i = 0; i < n; i++)
+			addCounts(pairs[i * 2], pairs[i * 2 + 1]);
+	} else {
+		console.log("WTF? binary message type " + type);
+	}
+}
+
+// Query string selecting state.device, with the extra parameters in params
+function deviceQuery(params) {
+	if (state.device !== null)
+		params.device = state.device;
+	var q = $.param(params);
+	return q ? "?" + q : "";
+}
+
+function initDevices() {
+	$.get("devices.json", function(devices) {
+		if (devices.length < 2)
+			return;
+		$("<label for=\"device\">Device:</label>").prependTo("#control");
+		var sel = $("<select id=\"device\"></select>").insertAfter("label[for=device]");
+		devices.forEach(function(d) {
+			$("<option></option>").val(d.id).text(d.id + " (" + d.driver + ")").appendTo(sel);
+		});
+		sel.val(state.device);
+		sel.change(function() {
+			location.search = "?" + $.param({device: this.value});
+		});
+	});
+}
+
 function initRemote(data) {
 	data["configprops"].forEach(function (c, i) {
 		var id = "config-" + c.id;
@@ -304,7 +516,7 @@ function initRemote(data) {
 				.appendTo($("body"))
 				.css("display", "none")
 				.html(JSON.stringify(
-							{hist: state.histogram,
+							{hist: Array.from(state.histogram),
 							 since: state.since,
 							 finished: (new Date()).getTime / 1000}));
 
@@ -321,20 +533,40 @@ function initRemote(data) {
 	setInterval(updateTimer, 1000);
 	$("#clear").attr("disabled", null);
 
-	state.ws = new WebSocket("ws://" + location.hostname + ":" + location.port + "/ws");
+	// The best protocol the server offers, old ones only speak plain json
+	var protocols = data["protocols"] || [];
+	state.binary = protocols.indexOf("binary") >= 0;
+	var protocol = state.binary ? "binary" :
+					protocols.indexOf("json-batched") >= 0 ? "json-batched" : null;
+	state.ws = new WebSocket("ws://" + location.hostname + ":" + location.port + "/ws" +
+								deviceQuery(protocol ? {protocol: protocol} : {}));
+	state.ws.binaryType = "arraybuffer";
 	state.ws.onopen = function() {
 		console.log("WebSocket connection opened")
 	}
+	state.ws.onclose = function() {
+		console.log("WebSocket connection closed")
+		$("#cpm").text("disconnected");
+		$("#clear").attr("disabled", true);
+	}
 	state.ws.onmessage = function(msg) {
+		if (msg.data instanceof ArrayBuffer) {
+			handleBinaryMessage(msg.data);
+			return;
+		}
 		var d = $.parseJSON(msg.data);
-		if (d.v) {
-			state.histogram[d.v] += 1;
+		if (d.vs) {
+			for (var i = 0; i < d.vs.length; i++)
+				addCounts(d.vs[i], 1);
+		} else if (d.v) {
+			addCounts(d.v, 1);
 		} else if (d.c) {
 			console.log("Config received!");
 		} else if (d.h) {
 			console.log("History received!");
 			state.histogram = d.h;
 			state.since = d.since;
+			rebin();
 		} else if (d.props) {
 			console.log("Configuration properties received!");
 			for (var k in d.props) {
@@ -355,6 +587,7 @@ $(document).ready(function() {
 	var stored = $("#stored");
 	if (stored.length) {
 		$("svg").remove();
+		$("canvas").remove();
 		var sdata = JSON.parse(stored.html());
 		state.histogram = sdata.hist;
 		state.since = sdata.since;
@@ -365,10 +598,15 @@ $(document).ready(function() {
 		});
 		update();
 	} else {
-		$.get("metadata.json", function(data) {
+		var m = /[?&]device=([^&]*)/.exec(location.search);
+		state.device = m ? decodeURIComponent(m[1]) : null;
+		$.get("metadata.json" + deviceQuery({}), function(data) {
+			state.device = data["id"];
+			state.sliceInterval = data["slice_interval"];
 			state.histogram = new Array(data["channels"]).fill(1);
 			init();
 			initRemote(data);
+			initDevices();
 		})
 	}
 })
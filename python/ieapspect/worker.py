@@ -0,0 +1,495 @@
+# The MIT License (MIT)
+#
+# Copyright (C) 2016 Institute of Applied and Experimental Physics (http://www.utef.cvut.cz/)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import asyncio
+import itertools
+import multiprocessing
+import numpy as np
+import time
+from multiprocessing import shared_memory
+
+from ieapspect import ConfigProp, EventBatch, Spectrometer
+from ieapspect import metrics
+from ieapspect.eventlog import EventLogWriter
+from ieapspect.histogram import Histogram
+
+# Shared memory layout:
+# |--------|-----------------|-------------------
+# | header | counts          | ring
+# |--------|-----------------|-------------------
+#   6 u64    channels * i64    capacity * u32
+# The header words are indexed by the H_* constants below, since is stored
+# as a f64.
+
+H_POS = 0
+H_GEN = 1
+H_TOTAL = 2
+H_SINCE = 3
+H_CHANNELS = 4
+H_CAPACITY = 5
+HEADER_WORDS = 6
+
+
+class SharedHistogram(Histogram):
+    """
+    Histogram in a shared memory segment, followed by a ring holding the
+    last capacity added events. One process adds to it and clears it, any
+    amount of others read it through snapshot() and read().
+
+    The writer changes anything and readers copy anything only while
+    holding lock, a multiprocessing lock shared by all the processes, which
+    also orders the memory accesses on either side of it. Readers give up
+    after lock_timeout seconds rather than stall their event loop behind a
+    writer which died holding it. Positions count all the events ever added,
+    pos % capacity is the index into the ring.
+
+    Created with channels, attached to with the name of an existing
+    segment. Only the creator unlinks the segment.
+    """
+
+    def __init__(self, channels=None, capacity=1 << 22, name=None, lock=None,
+                 lock_timeout=0.05):
+        self._lock = lock if lock is not None else multiprocessing.Lock()
+        self.lock_timeout = lock_timeout
+        if name is None:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=8 * HEADER_WORDS + 8 * channels + 4 * capacity)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        buf = self.shm.buf
+        self._header = np.ndarray(HEADER_WORDS, dtype=np.uint64, buffer=buf)
+        self._since = np.ndarray(1, dtype=np.float64, buffer=buf, offset=8 * H_SINCE)
+        if name is None:
+            self._header[:] = 0
+            self._header[H_CHANNELS] = channels
+            self._header[H_CAPACITY] = capacity
+        self.channels = int(self._header[H_CHANNELS])
+        self.capacity = int(self._header[H_CAPACITY])
+        self.counts = np.ndarray(self.channels, dtype=np.int64, buffer=buf,
+                                 offset=8 * HEADER_WORDS)
+        self.ring = np.ndarray(self.capacity, dtype=np.uint32, buffer=buf,
+                               offset=8 * (HEADER_WORDS + self.channels))
+        self._invalidate()
+        if name is None:
+            self.clear()
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def total(self):
+        return int(self._header[H_TOTAL])
+
+    @total.setter
+    def total(self, val):
+        self._header[H_TOTAL] = val
+
+    @property
+    def since(self):
+        return float(self._since[0])
+
+    @since.setter
+    def since(self, val):
+        self._since[0] = val
+
+    @property
+    def pos(self):
+        return int(self._header[H_POS])
+
+    def clear(self):
+        with self._lock:
+            self.counts[:] = 0
+            self.since = time.time()
+            self.total = 0
+            self._header[H_GEN] += 1
+        self._invalidate()
+
+    def add(self, vals):
+        vals = np.asarray(vals)
+        vals = vals[(vals >= 0) & (vals < self.channels)]
+        if len(vals) == 0:
+            return vals
+        with self._lock:
+            pos = self.pos + len(vals)
+            # Only the last capacity events fit into the ring
+            tail = vals[-self.capacity:]
+            start = (pos - len(tail)) % self.capacity
+            first = min(len(tail), self.capacity - start)
+            self.ring[start:start + first] = tail[:first]
+            self.ring[:len(tail) - first] = tail[first:]
+            super(SharedHistogram, self).add(vals)
+            self._header[H_POS] = pos
+        return vals
+
+    def _consistent(self, fn):
+        """
+        Returns fn() evaluated while the writer was not touching anything, or
+        None if the writer did not let go of the lock in time.
+        """
+        if not self._lock.acquire(timeout=self.lock_timeout):
+            return None
+        try:
+            return fn()
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        Returns (counts, since, pos, generation), a copy of the counts of the
+        events before pos, or None if the writer is too busy right now.
+        """
+        return self._consistent(lambda: (self.counts.copy(), self.since, self.pos,
+                                         int(self._header[H_GEN])))
+
+    def read(self, pos, generation):
+        """
+        Returns (values, pos, generation) with the events added since pos.
+        values is None if the histogram got cleared since generation or the
+        events were overwritten in the ring in the meantime, the reader has
+        to start over from a snapshot() then. If the writer is busy, there
+        are no new values this time.
+        """
+        def read():
+            end = self.pos
+            gen = int(self._header[H_GEN])
+            if gen != generation or end - pos > self.capacity:
+                return None, end, gen
+            start = pos % self.capacity
+            n = end - pos
+            if start + n <= self.capacity:
+                vals = self.ring[start:start + n].copy()
+            else:
+                vals = np.concatenate([self.ring[start:], self.ring[:start + n - self.capacity]])
+            return vals, end, gen
+
+        ret = self._consistent(read)
+        if ret is None:
+            return np.zeros(0, dtype=np.uint32), pos, generation
+        return ret
+
+    def close(self):
+        # The arrays have to go before the mapping can be closed
+        self._header = self._since = self.counts = self.ring = None
+        self._pyramid = self._cumsum = None
+        self.shm.close()
+
+    def unlink(self):
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class WorkerException(Exception):
+    pass
+
+
+async def _acquire(factory, conn, lock, pulses):
+    loop = asyncio.get_event_loop()
+    spect = factory()
+    if asyncio.iscoroutine(spect):
+        spect = await spect
+    conn.send(("ready", {
+        "driver": spect.__class__.__name__,
+        "channels": spect.channels,
+        "fw_version": spect.fw_version,
+        "serno": getattr(spect, "serno", None),
+        "configprops": [(c.id, c.name, c.fr, c.to) for c in spect.configprops],
+    }))
+    _, name = conn.recv()
+    hist = SharedHistogram(name=name, lock=lock)
+    # The log is opened with the first batch, which tells what columns it has
+    logargs = None
+    evlog = None
+    flusher = None
+    done = loop.create_future()
+
+    async def get_props(reqid, props, cached):
+        try:
+            conn.send(("prop", reqid, await spect.get_props(props, cached), None))
+        except Exception as e:
+            # The exception itself might not survive pickling
+            conn.send(("prop", reqid, None, "%s: %s" % (e.__class__.__name__, e)))
+
+    def close_log():
+        nonlocal evlog, flusher
+        if flusher:
+            flusher.cancel()
+        if evlog:
+            evlog.close()
+        evlog = flusher = None
+
+    def on_control():
+        nonlocal logargs
+        try:
+            msg = conn.recv()
+        except EOFError:
+            msg = ("stop",)
+        cmd = msg[0]
+        if cmd == "clear":
+            hist.clear()
+        elif cmd == "set_prop":
+            spect.set_prop(msg[1], msg[2])
+        elif cmd == "get_props":
+            asyncio.ensure_future(get_props(msg[1], msg[2], msg[3]))
+        elif cmd == "log":
+            close_log()
+            logargs = msg[1:]
+        elif cmd == "stop" and not done.done():
+            done.set_result(None)
+
+    async def run():
+        nonlocal evlog, flusher
+        spect.start()
+        batches = spect.batches() if pulses is None else pulses.batches(spect)
+        async for batch in batches:
+            if logargs and evlog is None:
+                path, max_bytes, max_age = logargs
+                evlog = EventLogWriter.for_batch(path, batch, max_bytes=max_bytes,
+                                                 max_age=max_age)
+                flusher = asyncio.ensure_future(evlog.keep_flushed())
+            if evlog:
+                evlog.write(batch.values, tot=batch.tot, device_time=batch.timestamps)
+            hist.add(batch.values)
+
+    async def send_metrics():
+        while True:
+            await asyncio.sleep(1)
+            conn.send(("metrics", spect.metrics()))
+
+    loop.add_reader(conn.fileno(), on_control)
+    tasks = [asyncio.ensure_future(run()), asyncio.ensure_future(send_metrics())]
+    try:
+        await asyncio.wait(tasks + [done], return_when=asyncio.FIRST_COMPLETED)
+        for t in tasks:
+            if t.done():
+                t.result()
+    finally:
+        loop.remove_reader(conn.fileno())
+        for t in tasks:
+            t.cancel()
+        spect.close()
+        close_log()
+        hist.close()
+
+
+def _worker_main(factory, conn, lock, pulses):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(_acquire(factory, conn, lock, pulses))
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        try:
+            conn.send(("error", "%s: %s" % (e.__class__.__name__, e)))
+        except OSError:
+            pass
+
+
+class WorkerSpect(Spectrometer):
+    """
+    Runs a driver in a worker process of its own, so that parsing and
+    histogramming never wait for whatever else runs on our event loop (and
+    the other way around). The worker adds the events into a
+    SharedHistogram which this side polls every poll_interval seconds, all
+    the rest (clear, properties, event logging, metrics) goes over a pipe.
+
+    factory is called in the worker and returns the driver or a coroutine
+    returning it, e.g. functools.partial(SerSpect.connect, port). It has to
+    be picklable, the worker is spawned rather than forked, so that it does
+    not inherit our event loop and descriptors. If pulses (a PulseProcessor)
+    is given, the worker histograms the pulse heights of waveforms instead
+    of the values.
+    """
+
+    def __init__(self, factory, capacity=1 << 22, poll_interval=0.01, pulses=None):
+        super(WorkerSpect, self).__init__(channels=0)
+        self.capacity = capacity
+        self.poll_interval = poll_interval
+        self.driver = None
+        self.serno = None
+        self.histogram = None
+        self.lost = None
+        self.resyncs = 0
+        self._pos = None
+        self._gen = None
+        self._ready = None
+        self._requests = {}
+        self._reqids = itertools.count()
+        self._metrics = []
+        ctx = multiprocessing.get_context("spawn")
+        self._conn, child = ctx.Pipe()
+        # Locks can only be handed over when the process starts, the
+        # histogram does not exist yet then
+        self._lock = ctx.Lock()
+        self.process = ctx.Process(target=_worker_main,
+                                   args=(factory, child, self._lock, pulses), daemon=True)
+        self.process.start()
+        child.close()
+
+    @classmethod
+    async def connect(cls, factory, **kwargs):
+        self = cls(factory, **kwargs)
+        loop = asyncio.get_event_loop()
+        self._ready = loop.create_future()
+        loop.add_reader(self._conn.fileno(), self._on_message)
+        try:
+            meta = await self._ready
+        except Exception:
+            self.close()
+            raise
+        self.driver = meta["driver"]
+        self.channels = meta["channels"]
+        self.fw_version = meta["fw_version"]
+        self.serno = meta["serno"]
+        self.configprops = [ConfigProp(self, *c) for c in meta["configprops"]]
+        self.histogram = SharedHistogram(self.channels, self.capacity, lock=self._lock)
+        self._send("attach", self.histogram.name)
+        return self
+
+    def _send(self, *msg):
+        try:
+            self._conn.send(msg)
+        except OSError:
+            pass
+
+    def _fail(self, exc):
+        if self.lost is None:
+            self.lost = exc
+        asyncio.get_event_loop().remove_reader(self._conn.fileno())
+        for fut in [self._ready] + list(self._requests.values()):
+            if fut is not None and not fut.done():
+                fut.set_exception(self.lost)
+        self._requests = {}
+
+    def _on_message(self):
+        try:
+            msg = self._conn.recv()
+        except (EOFError, OSError):
+            self._fail(EOFError("Worker process exited"))
+            return
+        typ = msg[0]
+        if typ == "ready":
+            self._ready.set_result(msg[1])
+        elif typ == "metrics":
+            self._metrics = msg[1]
+        elif typ == "prop":
+            fut = self._requests.pop(msg[1], None)
+            if fut is None or fut.done():
+                return
+            if msg[3] is not None:
+                fut.set_exception(WorkerException(msg[3]))
+            else:
+                fut.set_result(msg[2])
+        elif typ == "error":
+            self._fail(WorkerException(msg[1]))
+
+    def clear(self):
+        """
+        Clears the histogram, readers see it as a new generation.
+        """
+        self._send("clear")
+
+    def log_to(self, path, max_bytes=None, max_age=None):
+        """
+        Makes the worker log the events with an EventLogWriter.
+        """
+        self._send("log", path, max_bytes, max_age)
+
+    def set_prop(self, prop, val):
+        self._send("set_prop", prop, val)
+
+    async def get_prop(self, prop):
+        return (await self.get_props([prop], cached=False))[prop]
+
+    async def get_props(self, props, cached=True):
+        if self.lost is not None:
+            raise self.lost
+        reqid = next(self._reqids)
+        fut = self._requests[reqid] = asyncio.get_event_loop().create_future()
+        self._send("get_props", reqid, list(props), cached)
+        return await fut
+
+    async def updates(self):
+        """
+        Yields (snapshot, values) pairs. snapshot is None or (counts, since)
+        if the counts were cleared or this side fell more than capacity
+        events behind, values are the events added since the last update (or
+        since the snapshot).
+        """
+        while True:
+            if self.lost is not None:
+                raise self.lost
+            snap = None
+            if self._pos is None:
+                ret = self.histogram.snapshot()
+                if ret is not None:
+                    counts, since, self._pos, self._gen = ret
+                    snap = (counts, since)
+            if self._pos is not None:
+                vals, pos, gen = self.histogram.read(self._pos, self._gen)
+                if vals is None:
+                    if gen == self._gen:
+                        self.resyncs += 1
+                    self._pos = None
+                    continue
+                self._pos = pos
+                if snap is not None or len(vals):
+                    yield snap, vals
+            await asyncio.sleep(self.poll_interval)
+
+    async def batches(self, max_events=None, max_latency=None):
+        # Snapshots are lost on the way, use updates() to follow clears
+        async for _, vals in self.updates():
+            if len(vals):
+                yield EventBatch(values=vals, timestamps=None, tot=None, waveforms=None)
+
+    def metrics(self):
+        behind = 0
+        if self.histogram is not None and self._pos is not None:
+            behind = self.histogram.pos - self._pos
+        return self._metrics + [
+            metrics.counter("ieapspect_worker_resyncs_total",
+                            "Times the reader fell a whole ring behind the worker",
+                            self.resyncs),
+            metrics.gauge("ieapspect_worker_backlog",
+                          "Events added by the worker which were not read yet", behind),
+        ]
+
+    def close(self):
+        if self.lost is None:
+            self._send("stop")
+            self._fail(EOFError("Worker process stopped"))
+        self._conn.close()
+        if self.histogram is not None:
+            self.histogram.unlink()
+            self.histogram.close()
+            self.histogram = None
+        # Give the worker a moment to shut the device down properly
+        asyncio.get_event_loop().call_later(2, self._reap)
+
+    def _reap(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(1)
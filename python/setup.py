@@ -19,8 +19,10 @@ setup(
     packages=["ieapspect", "ieapspect.web"],
     package_data={"": ["*.css", "*.html", "*.js", "*.ico"]},
     include_package_data=True,
+    install_requires=["numpy", "pyserial", "aiohttp"],
     scripts=["bin/ieapspect-cpm", "bin/ieapspect-filedump", "bin/ieapspect-web",
-             "bin/ieapspect-dm100", "bin/ieapspect-spectrig", "bin/ieapspect-simplegui"],
+             "bin/ieapspect-dm100", "bin/ieapspect-spectrig", "bin/ieapspect-simplegui",
+             "bin/ieapspect-emulator"],
     #data_files=[("bin", ["wrappers/ieapspect-wrapper-" + f
     #                     for f in ["dm100", "spectrig"]])],
     description="Python library for some of the spectrometers developed at the IEAP",
@@ -0,0 +1,70 @@
+import asyncio
+import numpy as np
+import pytest
+
+
+class FakeTransport:
+    """
+    Stands in for the serial transport and the stdin of the wrappers.
+    """
+
+    def __init__(self):
+        self.written = bytearray()
+        self.paused = False
+        self.pauses = 0
+
+    def write(self, data):
+        self.written += data
+
+    def pause_reading(self):
+        self.paused = True
+        self.pauses += 1
+
+    def resume_reading(self):
+        self.paused = False
+
+    def close(self):
+        pass
+
+    def get_returncode(self):
+        return None
+
+
+class FakeProcess:
+
+    def __init__(self):
+        self.stdin = FakeTransport()
+        self.stdout = asyncio.StreamReader(limit=1 << 30)
+        self.returncode = None
+
+
+def run(coro):
+    """
+    Runs coro in a fresh event loop, the drivers create their futures and
+    queues on the current one.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+def chunks(data, rng, maxlen=997):
+    """
+    Splits data at random points, like reads from a pipe or a serial port.
+    """
+    ret = []
+    pos = 0
+    while pos < len(data):
+        n = int(rng.integers(1, maxlen + 1))
+        ret.append(bytes(data[pos:pos + n]))
+        pos += n
+    return ret
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(1)
@@ -0,0 +1,121 @@
+import asyncio
+import numpy as np
+import pytest
+
+from ieapspect import DM100
+
+from conftest import FakeProcess, chunks, run
+
+
+def packet(dln_samples, timestamp, header=None, checksum=True, bad=False):
+    words = []
+    if header is not None:
+        words += list(header)
+    words.append(len(dln_samples))
+    words += list(dln_samples)
+    words += [(timestamp >> 32) & 0xffff, (timestamp >> 16) & 0xffff, timestamp & 0xffff]
+    if checksum:
+        words.append((sum(words) + int(bad)) & 0xffff)
+    return np.array(words, dtype=">u2").tobytes()
+
+
+def build_waveforms(rng, n=3000):
+    # Runs of packets with different sample counts
+    waves = [rng.integers(0, 1 << 14, 4 + (i // 37) % 5) for i in range(n)]
+    data = b"".join(packet(w, 1000 * i, header=(0xa5a5, i & 0xf00)) for i, w in enumerate(waves))
+    return data, waves
+
+
+def make_spect(mode, header=True):
+    # The StreamReader has to be made on the loop that runs the test
+    spect = DM100(FakeProcess())
+    spect.packcfg = 0x00
+    spect.maskcfg = 0x00
+    spect.modecfg = 0x00
+    spect.bus8 = True
+    spect.addheader = header
+    spect.addtime = True
+    spect.addchecksum = True
+    spect.mode = mode
+    return spect
+
+
+async def decode(data_chunks, n, max_n=500):
+    spect = make_spect(DM100.MODE_WAVEFORM)
+
+    async def feed():
+        for c in data_chunks:
+            spect._proc.stdout.feed_data(c)
+            await asyncio.sleep(0)
+
+    async def consume():
+        ret = []
+        got = 0
+        while got < n:
+            evs = await spect.next_packets(max_n)
+            ret.append(evs)
+            got += len(evs.timestamp)
+        return ret
+
+    ret, _ = await asyncio.gather(consume(), feed())
+    return spect, ret
+
+
+@pytest.mark.parametrize("maxlen", [None, 1, 7, 1000, 1 << 16])
+def test_waveform_chunks(rng, monkeypatch, maxlen):
+    # Small enough that the receive buffer gets compacted many times
+    monkeypatch.setattr(DM100, "COMPACT_SIZE", 256)
+    data, waves = build_waveforms(rng)
+    data_chunks = [data] if maxlen is None else chunks(data, rng, maxlen)
+    spect, evs = run(decode(data_chunks, len(waves)))
+    wfs = [w for e in evs for w in e.waveform]
+    assert [w.tolist() for w in wfs] == [w.tolist() for w in waves]
+    assert np.concatenate([e.value for e in evs]).tolist() == [int(w.max()) for w in waves]
+    assert np.concatenate([e.timestamp for e in evs]).tolist() == \
+        [1000 * i for i in range(len(waves))]
+    assert np.concatenate([e.packet_id for e in evs]).tolist() == \
+        [(i >> 8) & 0xf for i in range(len(waves))]
+    assert all(e.checksum_valid.all() for e in evs)
+    assert spect.packets_received == len(waves)
+    assert spect.bytes_received == len(data)
+    assert len(spect._rxbuf) - spect._rxpos == 0
+    assert len(spect._rxbuf) < 256 + (1 << 16) + len(data) // 2
+
+
+def test_sample_tot_batches(rng):
+    vals = rng.integers(0, 1 << 14, (2000, 2))
+    parts = [packet(v, 7 * i, bad=(i % 100 == 5)) for i, v in enumerate(vals)]
+    data = b"".join(parts)
+
+    async def main():
+        spect = make_spect(DM100.MODE_SAMPLE_TOT, header=False)
+        for c in chunks(data, rng, 333):
+            spect._proc.stdout.feed_data(c)
+        batches = spect.batches()
+        got = []
+        while sum(len(b.values) for b in got) < 1980:
+            got.append(await batches.__anext__())
+        return spect, got
+
+    spect, got = run(main())
+    keep = np.array([i % 100 != 5 for i in range(len(vals))])
+    assert np.concatenate([b.values for b in got]).tolist() == vals[keep, 0].tolist()
+    assert np.concatenate([b.tot for b in got]).tolist() == vals[keep, 1].tolist()
+    assert np.concatenate([b.timestamps for b in got]).tolist() == \
+        (7 * np.flatnonzero(keep)).tolist()
+    assert spect.checksum_errors == 20
+
+
+def test_recv_after_packets():
+    # read_masked() style reads share the buffer with the packet decoder
+    async def main():
+        spect = make_spect(DM100.MODE_SAMPLE, header=False)
+        spect._proc.stdout.feed_data(b"\x01\x02\x03\x04" + packet([9], 5) + b"\x05\x06")
+        first = await spect._recv(4)
+        evs = await spect.next_packets()
+        return first, evs, await spect._recv(2)
+
+    first, evs, last = run(main())
+    assert first == b"\x01\x02\x03\x04"
+    assert evs.value.tolist() == [9]
+    assert last == b"\x05\x06"
@@ -0,0 +1,93 @@
+import asyncio
+import numpy as np
+import pytest
+import types
+
+from ieapspect import SerSpect, SerSpectException
+from ieapspect.emulator import SerSpectEmulator, SIPOSEmulator
+
+from conftest import run
+from test_serspect import parse
+
+
+@pytest.mark.parametrize("wave_every", [0, 1, 7])
+def test_serspect_packets(rng, wave_every):
+    vals = rng.integers(0, 4096, 100)
+    data, starts = SerSpectEmulator(wave_every=wave_every, wave_length=5,
+                                    seed=1).encode_packets(vals)
+    # The waveforms are noisy, the same seed gives the same ones
+    em = SerSpectEmulator(wave_every=wave_every, wave_length=5, seed=1)
+    assert em.encode_events(vals).tobytes() == data.tobytes()
+    # Every packet starts where it says
+    assert set(data[starts].tolist()) <= {SerSpect.PACK_EVENT, SerSpect.PACK_WAVE}
+    assert (data[starts] == SerSpect.PACK_EVENT).sum() == len(vals)
+    nwaves = len(range(0, len(vals), wave_every)) if wave_every else 0
+    gvals, gwaves, spect = run(parse([data.tobytes()], len(vals), nwaves))
+    assert gvals.tolist() == vals.tolist()
+    assert all(len(w) == 5 for w in gwaves)
+    assert spect.resync_drops == 0
+
+
+def test_garbage_between_packets(rng):
+    em = SerSpectEmulator(garbage_rate=1e6, seed=1)
+    integers = em.rng.integers
+
+    def zero_garbage(low, high, size, dtype=np.int64):
+        # Random garbage can look like packets, zeros are always skipped
+        if dtype == np.uint8:
+            return np.zeros(size, dtype=np.uint8)
+        return integers(low, high, size, dtype=dtype)
+
+    em.rng = types.SimpleNamespace(poisson=em.rng.poisson, integers=zero_garbage)
+    vals = rng.integers(0, 4096, 300)
+    data = em._garbage(*em.encode_packets(vals), 0.001)
+    garbage = len(data) - 3 * len(vals)
+    assert garbage > 0
+    gvals, _, spect = run(parse([data], len(vals), 0))
+    assert gvals.tolist() == vals.tolist()
+    assert spect.resync_drops == garbage
+
+
+def test_sipos_frames():
+    frames = SIPOSEmulator(seed=1).encode_frames(np.array([0, 0xfff, 0x123]))
+    assert frames.shape == (3, 2)
+    assert (frames[:, 0] & 0x80).all() and not (frames[:, 1] & 0x80).any()
+    raw = ((frames[:, 0].astype(int) & 0x3f) << 6) | frames[:, 1]
+    assert (raw ^ 0xfff).tolist() == [0, 0xfff, 0x123]
+
+
+def test_serspect_pty():
+    async def main():
+        em = SerSpectEmulator(rate=5000, seed=1, serno=42)
+        port = em.open()
+        task = asyncio.ensure_future(em.run())
+        spect = await asyncio.wait_for(SerSpect.connect(port), 2)
+        try:
+            await asyncio.wait_for(spect.ping(), 2)
+            assert await asyncio.wait_for(spect.get_prop(SerSpect.PROP_SERNO), 2) == 42
+            spect.set_prop(SerSpect.PROP_THRESH, 100)
+            assert await asyncio.wait_for(spect.get_prop(SerSpect.PROP_THRESH), 2) == 100
+            spect.set_prop(SerSpect.PROP_SERNO, 5)
+            with pytest.raises(SerSpectException):
+                await asyncio.wait_for(spect.get_prop(SerSpect.PROP_SERNO), 2)
+            spect.start()
+            vals = []
+            batches = spect.batches()
+            while len(vals) < 500:
+                batch = await asyncio.wait_for(batches.__anext__(), 2)
+                vals.extend(batch.values.tolist())
+            # The emulator applies the threshold which was set
+            assert min(vals) >= 100
+            spect.end()
+            await asyncio.sleep(0.05)
+            assert not em.streaming
+        finally:
+            spect.close()
+            em.close()
+            task.cancel()
+            # The receive loop of the driver runs until cancelled
+            for t in asyncio.all_tasks():
+                if t is not asyncio.current_task():
+                    t.cancel()
+
+    run(main())
@@ -0,0 +1,127 @@
+import asyncio
+import glob
+import numpy as np
+import os
+import pytest
+import time
+import types
+
+from ieapspect import eventlog
+from ieapspect.eventlog import EventLog, EventLogWriter
+
+from conftest import run
+
+
+@pytest.mark.parametrize("tot", [False, True])
+@pytest.mark.parametrize("device_time", [False, True])
+def test_roundtrip(tmp_path, rng, tot, device_time):
+    fname = str(tmp_path / "events.bin")
+    batches = []
+    with EventLogWriter(fname, tot=tot, device_time=device_time, buffer_size=1000) as w:
+        for i in range(50):
+            n = int(rng.integers(0, 100))
+            batch = (rng.integers(0, 4096, n), rng.integers(0, 1000, n),
+                     rng.integers(0, 2**63, n, dtype=np.uint64), 1000 * i)
+            w.write(batch[0], tot=batch[1] if tot else None, timestamp=batch[3],
+                    device_time=batch[2] if device_time else None)
+            batches.append(batch)
+    log = EventLog.load_file(fname)
+    assert log.channels.tolist() == np.concatenate([b[0] for b in batches]).tolist()
+    assert log.timestamps.tolist() == [b[3] for b in batches for _ in b[0]]
+    if tot:
+        assert log.tot.tolist() == np.concatenate([b[1] for b in batches]).tolist()
+    else:
+        assert log.tot is None
+    if device_time:
+        assert log.device_times.tolist() == np.concatenate([b[2] for b in batches]).tolist()
+    else:
+        assert log.device_times is None
+
+
+def test_for_batch(tmp_path):
+    batch = types.SimpleNamespace(values=[1, 2], tot=[3, 4], timestamps=None)
+    with EventLogWriter.for_batch(str(tmp_path / "events.bin"), batch) as w:
+        assert w.tot and not w.device_time
+
+
+def test_wall_times(tmp_path):
+    fname = str(tmp_path / "events.bin")
+    before = time.time()
+    with EventLogWriter(fname) as w:
+        w.write([5])
+    log = EventLog.load_file(fname)
+    assert before - 1 <= log.wall_times()[0] <= time.time() + 1
+
+
+def test_partial_record(tmp_path):
+    fname = str(tmp_path / "events.bin")
+    with EventLogWriter(fname) as w:
+        w.write([1, 2, 3])
+    with open(fname, "ab") as f:
+        f.write(b"\x00\x01\x02")
+    assert EventLog.load_file(fname).channels.tolist() == [1, 2, 3]
+
+
+def test_empty(tmp_path):
+    fname = str(tmp_path / "events.bin")
+    EventLogWriter(fname).close()
+    assert len(EventLog.load_file(fname).records) == 0
+
+
+@pytest.mark.parametrize("data", [b"IEAP", b"NOTMAGIC" + bytes(eventlog.HEADER.size - 8)])
+def test_invalid(tmp_path, data):
+    fname = str(tmp_path / "events.bin")
+    with open(fname, "wb") as f:
+        f.write(data)
+    with pytest.raises(ValueError):
+        EventLog.load_file(fname)
+
+
+def test_rotation(tmp_path):
+    path = str(tmp_path / "events.bin")
+    recsize = eventlog.RECORD_DTYPE.itemsize
+    with EventLogWriter(path, max_bytes=eventlog.HEADER.size + 100 * recsize,
+                        buffer_size=0) as w:
+        for i in range(25):
+            w.write(np.arange(10) + 10 * i)
+    # Files started within the same second get a counter
+    fnames = sorted(glob.glob(str(tmp_path / "events-*.bin")),
+                    key=os.path.getmtime)
+    assert len(fnames) == 3
+    got = np.concatenate([EventLog.load_file(f).channels for f in fnames])
+    assert sorted(got.tolist()) == list(range(250))
+
+
+def test_keep_flushed(tmp_path):
+    """
+    Events written before the input stops reach the file without further
+    writes.
+    """
+    fname = str(tmp_path / "events.bin")
+
+    async def main():
+        w = EventLogWriter(fname, flush_interval=0.01)
+        flusher = asyncio.ensure_future(w.keep_flushed())
+        try:
+            w.write([1, 2])
+            assert len(EventLog.load_file(fname).records) == 0
+            await asyncio.sleep(0.05)
+            return EventLog.load_file(fname).channels.tolist()
+        finally:
+            flusher.cancel()
+            w.close()
+
+    assert run(main()) == [1, 2]
+
+
+def test_tick_rotates_by_age(tmp_path, monkeypatch):
+    path = str(tmp_path / "events.bin")
+    now = [1000.0]
+    monkeypatch.setattr(eventlog.time, "monotonic", lambda: now[0])
+    with EventLogWriter(path, max_age=60) as w:
+        first = w.fname
+        w.tick()
+        assert w.fname == first
+        now[0] += 61
+        w.tick()
+        assert w.fname != first
@@ -0,0 +1,56 @@
+import datetime
+import numpy as np
+import pytest
+
+from ieapspect import HistFile
+
+
+def make_hist(rng, big=False):
+    hist = HistFile(rng.integers(0, 1000, 4096).astype(np.int64))
+    if big:
+        hist.vals[7] = 2**40
+    hist.from_ = datetime.datetime(2016, 3, 1, 12, 0, 0)
+    hist.to = datetime.datetime(2016, 3, 1, 13, 30, 5)
+    hist.device = "serspect"
+    hist.serno = "42"
+    return hist
+
+
+@pytest.mark.parametrize("binary", [False, True])
+@pytest.mark.parametrize("mmap", [False, True])
+@pytest.mark.parametrize("big", [False, True])
+def test_roundtrip(tmp_path, rng, binary, mmap, big):
+    hist = make_hist(rng, big)
+    fname = tmp_path / "hist.txt"
+    hist.save(fname, binary=binary)
+    got = HistFile.load_file(fname, mmap=mmap)
+    assert np.asarray(got.vals).tolist() == hist.vals.tolist()
+    assert got.from_ == hist.from_
+    assert got.to == hist.to
+    assert got.device == "serspect"
+    assert got.serno == "42"
+
+
+def test_text_format(tmp_path):
+    hist = HistFile(np.array([3, 0, 5]))
+    hist.gain = "2"
+    fname = tmp_path / "hist.txt"
+    hist.save(fname)
+    assert fname.read_bytes() == b"-_-\ngain: 2\n---\n3\n0\n5\n"
+
+
+def test_iso_times(tmp_path):
+    fname = tmp_path / "hist.txt"
+    fname.write_bytes(b"-_-\nfrom: 2016-03-01T12:00:00\nTo: 1456837200\n---\n1\n2\n")
+    got = HistFile.load_file(fname)
+    assert got.from_ == datetime.datetime(2016, 3, 1, 12, 0, 0)
+    assert got.to == datetime.datetime.fromtimestamp(1456837200)
+    assert got.vals.tolist() == [1, 2]
+
+
+@pytest.mark.parametrize("data", [b"spectrum\n---\n1\n", b"-_-\nfrom: 1\n1\n2\n"])
+def test_invalid(tmp_path, data):
+    fname = tmp_path / "hist.txt"
+    fname.write_bytes(data)
+    with pytest.raises(ValueError):
+        HistFile.load_file(fname)
@@ -0,0 +1,119 @@
+import asyncio
+import pytest
+
+from ieapspect import BoundedQueue
+
+from conftest import run
+
+
+def drain(queue):
+    ret = []
+    while len(queue):
+        ret.append(queue.get_nowait())
+    return ret
+
+
+def test_unbounded():
+    queue = BoundedQueue()
+    for i in range(1000):
+        assert queue.put(i, n=10)
+    assert queue.size == 10000
+    assert drain(queue) == list(range(1000))
+    assert queue.size == 0 and queue.dropped == 0
+
+
+def test_drop_oldest():
+    queue = BoundedQueue(10, BoundedQueue.DROP_OLDEST)
+    for i in range(5):
+        assert queue.put(i, n=3)
+    # Only what fits next to the newest item is kept
+    assert queue.size == 9
+    assert queue.dropped == 6
+    assert drain(queue) == [2, 3, 4]
+
+
+def test_drop_newest():
+    queue = BoundedQueue(10, BoundedQueue.DROP_NEWEST)
+    for i in range(5):
+        assert queue.put(i, n=3)
+    assert queue.dropped == 6
+    assert drain(queue) == [0, 1, 2]
+
+
+def test_oversized_item():
+    # An item bigger than the limit still fits into an empty queue
+    for policy in BoundedQueue.POLICIES:
+        queue = BoundedQueue(10, policy)
+        assert queue.put("big", n=100)
+        assert queue.full()
+        assert drain(queue) == ["big"]
+
+
+def test_block():
+    spaces = []
+    queue = BoundedQueue(4, BoundedQueue.BLOCK, on_space=lambda: spaces.append(len(queue)))
+    assert queue.put(0, n=2)
+    assert queue.put(1, n=2)
+    assert not queue.put(2, n=2)
+    assert not queue.put(2, n=2)
+    assert queue.dropped == 0
+    assert queue.get_nowait() == 0
+    # on_space is called once per refusal streak, after the item is removed
+    assert spaces == [1]
+    assert queue.put(2, n=2)
+    assert queue.get_nowait() == 1
+    assert spaces == [1]
+    assert drain(queue) == [2]
+
+
+def test_unget():
+    queue = BoundedQueue(10)
+    queue.put([1, 2, 3], n=3)
+    queue.put([4], n=1)
+    item = queue.get_nowait()
+    queue.unget(item[1:], n=2)
+    assert queue.size == 3
+    assert drain(queue) == [[2, 3], [4]]
+
+
+def test_configure():
+    queue = BoundedQueue()
+    queue.configure(2, BoundedQueue.DROP_NEWEST)
+    queue.put(0)
+    queue.put(1)
+    queue.put(2)
+    assert drain(queue) == [0, 1]
+    with pytest.raises(ValueError):
+        queue.configure(2, "drop-random")
+
+
+def test_get_waits():
+    async def main():
+        queue = BoundedQueue()
+        getter = asyncio.ensure_future(queue.get())
+        await asyncio.sleep(0)
+        assert not getter.done()
+        queue.put("x")
+        return await getter
+
+    assert run(main()) == "x"
+
+
+def test_close():
+    async def main():
+        queue = BoundedQueue()
+        queue.put(1)
+        queue.put(2)
+        queue.close(EOFError())
+        got = [await queue.get(), await queue.get()]
+        with pytest.raises(EOFError):
+            await queue.get()
+        waiter = BoundedQueue()
+        getter = asyncio.ensure_future(waiter.get())
+        await asyncio.sleep(0)
+        waiter.close(EOFError())
+        with pytest.raises(EOFError):
+            await getter
+        return got
+
+    assert run(main()) == [1, 2]
@@ -0,0 +1,110 @@
+import asyncio
+import numpy as np
+import struct
+
+from ieapspect import BoundedQueue, SerSpect
+
+from conftest import FakeTransport, chunks, run
+
+
+def build_stream(rng, n=5000):
+    """
+    Returns EVENT packets mixed with other packets and garbage, the event
+    values, the WAVE samples and the amount of garbage bytes.
+    """
+    vals = rng.integers(0, 4096, n)
+    parts = []
+    waves = []
+    garbage = 0
+    for i, v in enumerate(vals.tolist()):
+        parts.append(bytes([SerSpect.PACK_EVENT, v & 0xff, v >> 8]))
+        if i % 701 == 0:
+            wave = rng.integers(0, 1 << 16, 1 + i % 40).tolist()
+            waves.append(tuple(wave))
+            parts.append(bytes([SerSpect.PACK_WAVE, len(wave)]) +
+                         struct.pack(">%dH" % len(wave), *wave))
+        if i % 997 == 0:
+            parts.append(bytes([SerSpect.PACK_PONG]))
+        if i % 1231 == 0:
+            parts.append(b"\x00\x13")
+            garbage += 2
+    return b"".join(parts), vals, waves, garbage
+
+
+async def parse(data_chunks, nvals, nwaves, maxsize=None):
+    spect = SerSpect()
+    spect.connection_made(FakeTransport())
+    if maxsize is not None:
+        spect.subscribe(SerSpect.PACK_EVENT, maxsize, BoundedQueue.BLOCK)
+    spect.subscribe(SerSpect.PACK_WAVE)
+    recv = asyncio.ensure_future(spect._recv_loop())
+
+    async def feed():
+        for c in data_chunks:
+            spect.data_received(c)
+            await asyncio.sleep(0)
+
+    async def consume():
+        got = []
+        n = 0
+        while n < nvals:
+            evs = await spect.next_events(333)
+            got.append(evs)
+            n += len(evs)
+        return np.concatenate(got)
+
+    vals, _ = await asyncio.gather(consume(), feed())
+    waves = [await spect.next_wave() for _ in range(nwaves)]
+    recv.cancel()
+    return vals, waves, spect
+
+
+def test_chunked_equivalence(rng):
+    data, vals, waves, garbage = build_stream(rng)
+    whole = run(parse([data], len(vals), len(waves)))
+    for maxlen in [1, 2, 3, 64, 4096]:
+        got = run(parse(chunks(data, rng, maxlen), len(vals), len(waves)))
+        for ret in (whole, got):
+            gvals, gwaves, spect = ret
+            assert gvals.tolist() == vals.tolist()
+            assert gwaves == waves
+            assert spect.resync_drops == garbage
+            assert spect.packets_received[SerSpect.PACK_PONG] == 1 + (len(vals) - 1) // 997
+            assert len(spect._recvbuf) == 0
+
+
+def test_blocked_queue_keeps_events(rng):
+    # The parser stops at a full queue and picks up where it left once the
+    # consumer makes room, nothing gets dropped
+    data, vals, waves, _ = build_stream(rng)
+    gvals, gwaves, spect = run(parse(chunks(data, rng, 4096), len(vals), len(waves),
+                                     maxsize=100))
+    assert gvals.tolist() == vals.tolist()
+    assert gwaves == waves
+    assert spect._eventqueue.dropped == 0
+    assert spect._transport.pauses > 0
+    assert not spect._transport.paused
+
+
+def test_getresp_updates_mirror():
+    async def main():
+        spect = SerSpect()
+        spect.connection_made(FakeTransport())
+        recv = asyncio.ensure_future(spect._recv_loop())
+        get = asyncio.ensure_future(spect.get_props([SerSpect.PROP_THRESH,
+                                                     SerSpect.PROP_SERNO]))
+        await asyncio.sleep(0)
+        assert bytes(spect._transport.written) == bytes([
+            SerSpect.PACK_GET, SerSpect.PROP_THRESH, SerSpect.PACK_GET, SerSpect.PROP_SERNO])
+        spect.data_received(bytes([SerSpect.PACK_GETRESP, SerSpect.PROP_THRESH, 50, 0,
+                                   SerSpect.PACK_EVENT, 1, 0,
+                                   SerSpect.PACK_GETRESP, SerSpect.PROP_SERNO]) +
+                            (1234).to_bytes(2, "little"))
+        ret = await get
+        recv.cancel()
+        return ret, spect
+
+    ret, spect = run(main())
+    assert ret == {SerSpect.PROP_THRESH: 50, SerSpect.PROP_SERNO: 1234}
+    assert spect.props[SerSpect.PROP_THRESH] == 50
+    assert not spect._inflight
@@ -0,0 +1,75 @@
+import asyncio
+import numpy as np
+import pytest
+
+from ieapspect import Spectrig
+
+from conftest import FakeTransport, chunks, run
+
+
+def frame(samples, timestamp, tail=Spectrig.PACKET_RESP_TAIL):
+    ret = np.zeros(Spectrig.FRAME_LENGTH, dtype=np.uint8)
+    ret[0] = Spectrig.PACKET_RESP_HEADER
+    ret[1] = Spectrig.PACK_TYPE_SPECTRO
+    padded = np.zeros(256, dtype=">u2")
+    padded[:len(samples)] = samples
+    ret[3:515] = padded.view(np.uint8)
+    ret[515] = len(samples) >> 8
+    ret[516] = len(samples) & 0xff
+    # The timestamp ends with the tail byte
+    ret[518:526] = np.array([timestamp], dtype=">u8").view(np.uint8)
+    ret[-1] = tail
+    return ret.tobytes()
+
+
+def build_stream(rng, n=400):
+    """
+    Returns frames with garbage and broken frames between them, the
+    waveforms and timestamps of the good ones and the bytes dropped.
+    """
+    parts = []
+    waves = []
+    tss = []
+    dropped = 0
+    for i in range(n):
+        # No byte of the samples looks like a header or a tail, so that the
+        # resync does not depend on where it starts looking
+        samples = rng.integers(0, 4096, 16 + (i // 50) * 30) & 0x0f7f
+        ts = (i << 8) | Spectrig.PACKET_RESP_TAIL
+        if i % 97 == 3:
+            parts.append(frame(samples, ts, tail=0x00))
+            dropped += Spectrig.FRAME_LENGTH
+            continue
+        parts.append(frame(samples, ts))
+        waves.append(samples)
+        tss.append(ts)
+        if i % 41 == 7:
+            parts.append(b"\x01\x02\x03")
+            dropped += 3
+    return b"".join(parts), waves, tss, dropped
+
+
+async def parse(data_chunks, n):
+    spect = Spectrig()
+    spect.pipe = FakeTransport()
+    for c in data_chunks:
+        spect.pipe_data_received(1, c)
+    batches = spect.batches(max_events=64)
+    got = []
+    while sum(len(b.values) for b in got) < n:
+        got.append(await batches.__anext__())
+    return spect, got
+
+
+@pytest.mark.parametrize("maxlen", [None, 1, 100, 525, 527, 5000])
+def test_chunked_equivalence(rng, maxlen):
+    data, waves, tss, dropped = build_stream(rng)
+    data_chunks = [data] if maxlen is None else chunks(data, rng, maxlen)
+    spect, got = run(parse(data_chunks, len(waves)))
+    wfs = [w for b in got for w in b.waveforms]
+    assert [w.tolist() for w in wfs] == [w.tolist() for w in waves]
+    assert np.concatenate([b.values for b in got]).tolist() == [int(w.max()) for w in waves]
+    assert np.concatenate([b.timestamps for b in got]).tolist() == tss
+    assert spect.resync_drops == dropped
+    assert spect.packets_received["spectro"] == len(waves)
+    assert len(spect._buffer) == 0
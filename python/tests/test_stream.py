@@ -0,0 +1,111 @@
+import io
+import numpy as np
+import pytest
+
+from ieapspect import EventBatch
+from ieapspect.stream import FORMATS, StreamDecoder, StreamWriter, read_batches
+
+from conftest import chunks
+
+
+def make_batches(rng, timestamps=True, tot=True, waveforms="fixed"):
+    ret = []
+    for i in range(20):
+        n = int(rng.integers(1, 50))
+        if waveforms == "fixed":
+            wfs = rng.integers(0, 4096, (n, 16))
+        elif waveforms == "ragged":
+            wfs = [rng.integers(0, 4096, int(rng.integers(1, 40))) for _ in range(n)]
+        else:
+            wfs = None
+        ret.append(EventBatch(
+            values=rng.integers(0, 4096, n),
+            timestamps=rng.integers(0, 2**63, n, dtype=np.uint64) if timestamps else None,
+            tot=rng.integers(0, 1000, n) if tot else None,
+            waveforms=wfs))
+    return ret
+
+
+def events(batches):
+    """
+    Flattens the batches into per event tuples, json batches get split
+    differently than they were written.
+    """
+    ret = []
+    for b in batches:
+        for i in range(len(b.values)):
+            ret.append((int(b.values[i]),
+                        None if b.timestamps is None else int(b.timestamps[i]),
+                        None if b.tot is None else int(b.tot[i]),
+                        None if b.waveforms is None else np.asarray(b.waveforms[i]).tolist()))
+    return ret
+
+
+def decode(data, data_chunks):
+    decoder = StreamDecoder()
+    got = []
+    for c in data_chunks:
+        got.extend(decoder.feed(c))
+    return decoder, got
+
+
+@pytest.mark.parametrize("format", FORMATS)
+@pytest.mark.parametrize("waveforms", ["fixed", "ragged", None])
+@pytest.mark.parametrize("maxlen", [None, 1, 7, 1000])
+def test_roundtrip(rng, format, waveforms, maxlen):
+    batches = make_batches(rng, waveforms=waveforms)
+    out = io.BytesIO()
+    writer = StreamWriter(out, format=format)
+    for b in batches:
+        writer.write(b)
+    data = out.getvalue()
+    decoder, got = decode(data, [data] if maxlen is None else chunks(data, rng, maxlen))
+    assert decoder.format == ("binary" if format == "binary" else "json")
+    assert events(got) == events(batches)
+    if format != "json":
+        assert [len(b.values) for b in got] == [len(b.values) for b in batches]
+
+
+@pytest.mark.parametrize("format", FORMATS)
+def test_missing_columns(rng, format):
+    batches = make_batches(rng, timestamps=False, tot=False, waveforms=None)
+    out = io.BytesIO()
+    writer = StreamWriter(out, format=format)
+    for b in batches:
+        writer.write(b)
+    _, got = decode(out.getvalue(), [out.getvalue()])
+    assert all(b.timestamps is None and b.tot is None and b.waveforms is None for b in got)
+    assert events(got) == events(batches)
+
+
+def test_columns(rng):
+    batches = make_batches(rng)
+    out = io.BytesIO()
+    writer = StreamWriter(out, format="ndjson-batched", columns=["waveform"])
+    for b in batches:
+        writer.write(b)
+    _, got = decode(out.getvalue(), [out.getvalue()])
+    # The values are the maxima of the waveforms without the value column
+    assert np.concatenate([b.values for b in got]).tolist() == \
+        [int(w.max()) for b in batches for w in b.waveforms]
+    assert all(b.tot is None for b in got)
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        StreamWriter(io.BytesIO(), format="xml")
+
+
+@pytest.mark.parametrize("format", FORMATS)
+def test_read_batches(tmp_path, rng, format):
+    batches = make_batches(rng, waveforms="ragged")
+    fname = str(tmp_path / "stream")
+    with open(fname, "wb") as f:
+        writer = StreamWriter(f, format=format)
+        for b in batches:
+            writer.write(b)
+        # A partially written event at the end is ignored
+        f.write(writer.encode(batches[0])[:30])
+    assert events(read_batches(fname, chunk_size=100)) == events(batches)
+    with open(fname, "rb") as f:
+        assert events(read_batches(f)) == events(batches)
@@ -0,0 +1,171 @@
+import asyncio
+import importlib.machinery
+import importlib.util
+import json
+import numpy as np
+import os
+import pytest
+import struct
+import types
+
+from ieapspect import DummySpect
+
+from conftest import run
+
+
+def load_web():
+    path = os.path.join(os.path.dirname(__file__), os.pardir, "bin", "ieapspect-web")
+    loader = importlib.machinery.SourceFileLoader("ieapspect_web", path)
+    spec = importlib.util.spec_from_loader("ieapspect_web", loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+web = load_web()
+
+
+class FakeWebSocket:
+    """
+    Collects what gets sent, sending blocks while the gate is closed.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def send_bytes(self, data):
+        await self.gate.wait()
+        self.messages.append(data)
+
+    async def send_str(self, data):
+        await self.gate.wait()
+        self.messages.append(data)
+
+
+class Reconstruction:
+    """
+    Tracks the histogram from the messages like index.js does.
+    """
+
+    def __init__(self):
+        self.counts = None
+        self.seq = 0
+        self.since = None
+
+    def feed(self, msg):
+        if isinstance(msg, bytes):
+            typ, seq = struct.unpack_from("<B3xI", msg)
+            if typ == web.MSG_SNAPSHOT:
+                self.seq = seq
+                self.since, n = struct.unpack_from("<dI", msg, 8)
+                self.counts = np.frombuffer(msg, dtype="<u4", count=n, offset=20).astype(np.int64)
+            else:
+                assert typ == web.MSG_DELTA
+                if seq <= self.seq:
+                    return
+                assert seq == self.seq + 1
+                self.seq = seq
+                n, = struct.unpack_from("<I", msg, 8)
+                pairs = np.frombuffer(msg, dtype="<u4", count=2 * n, offset=12).reshape(n, 2)
+                np.add.at(self.counts, pairs[:, 0], pairs[:, 1])
+            return
+        d = json.loads(msg)
+        if "h" in d:
+            self.counts = np.array(d["h"], dtype=np.int64)
+            self.since = d["since"]
+        elif "vs" in d:
+            np.add.at(self.counts, d["vs"], 1)
+        elif "v" in d:
+            self.counts[d["v"]] += 1
+
+
+def make_device(max_queue=100):
+    app = types.SimpleNamespace(max_queue=max_queue, slice_depth=0, pulses=None)
+    return web.Device(app, "1", DummySpect(channels=256))
+
+
+def connect(dev, protocol):
+    client = web.Client(FakeWebSocket(), dev, protocol)
+    dev.clients.append(client)
+    client.send_history()
+    return client
+
+
+async def settle():
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+
+def add_events(dev, rng, n):
+    # Out of range values do not make it into the histogram or the frames
+    dev._pending.append(dev.histogram.add(rng.integers(-5, 260, n)))
+
+
+def reconstruct(client):
+    rec = Reconstruction()
+    for msg in client.ws.messages:
+        rec.feed(msg)
+    return rec
+
+
+@pytest.mark.parametrize("protocol", web.PROTOCOLS)
+def test_snapshot_and_deltas(rng, protocol):
+    async def main():
+        dev = make_device()
+        dev.histogram.add(rng.integers(0, 256, 1000))
+        client = connect(dev, protocol)
+        for i in range(30):
+            add_events(dev, rng, int(rng.integers(0, 300)))
+            dev.flush_events()
+            if i == 10:
+                # Late joiners start from a snapshot of everything so far
+                late = connect(dev, protocol)
+            await settle()
+        client.close()
+        late.close()
+        return dev, client, late
+
+    dev, client, late = run(main())
+    for c in [client, late]:
+        rec = reconstruct(c)
+        assert rec.counts.tolist() == dev.histogram.counts.tolist()
+        assert rec.since == dev.histogram.since
+    if protocol == "json":
+        assert all(isinstance(m, str) for m in client.ws.messages)
+        assert {"v"} <= set(json.loads(client.ws.messages[-1]))
+
+
+def test_snapshot_layout():
+    dev = make_device()
+    dev.histogram.add([0, 3, 3, 255])
+    dev.seq = 7
+    msg = dev.encode_snapshot("binary")
+    assert struct.unpack_from("<B3xIdI", msg) == (web.MSG_SNAPSHOT, 7, dev.histogram.since, 256)
+    assert len(msg) == 20 + 4 * 256
+    dev._pending.append(np.array([3, 5, 3]))
+    frame = dev.encode_frame(np.concatenate(dev._pending), "binary")
+    assert frame == struct.pack("<B3xII4I", web.MSG_DELTA, 7, 2, 3, 2, 5, 1)
+
+
+@pytest.mark.parametrize("protocol", web.PROTOCOLS)
+def test_resync_after_falling_behind(rng, protocol):
+    async def main():
+        dev = make_device(max_queue=3)
+        client = connect(dev, protocol)
+        await settle()
+        client.ws.gate.clear()
+        for i in range(20):
+            add_events(dev, rng, 50)
+            dev.flush_events()
+            await settle()
+        client.ws.gate.set()
+        await settle()
+        client.close()
+        return dev, client
+
+    dev, client = run(main())
+    assert dev.client_resyncs > 0
+    assert len(client._outqueue) == 0
+    assert reconstruct(client).counts.tolist() == dev.histogram.counts.tolist()
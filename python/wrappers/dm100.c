@@ -171,15 +171,19 @@ close:
 int main(int argc, char *argv[])
 {
 	struct ftdi_context ftdi;
+	struct shmring ringbuf;
+	struct shmring *ring;
 	int ret;
 
+	ring = shmring_from_args(argc, argv, &ringbuf);
+
 	ret = dm100_connect(&ftdi);
 	if (ret < 0) {
 		perror("dm100_connect failed");
 		exit(EXIT_FAILURE);
 	}
 
-	enter_rw_loop(&ftdi);
+	enter_rw_loop(&ftdi, ring);
 
 	//epollfd = epoll_create1(0);
 	//ev.events = EPOLLIN;
@@ -0,0 +1,124 @@
+/*
+ * The MIT License (MIT)
+ *
+ * Copyright (C) 2016 Institute of Applied and Experimental Physics (http://www.utef.cvut.cz/)
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining a copy
+ * of this software and associated documentation files (the "Software"), to deal
+ * in the Software without restriction, including without limitation the rights
+ * to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the Software is
+ * furnished to do so, subject to the following conditions:
+ *
+ * The above copyright notice and this permission notice shall be included in
+ * all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ * IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ * FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ * AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ * LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ * OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ * THE SOFTWARE.
+ */
+
+/*
+ * Stands in for the device wrappers without any hardware, replays a
+ * recording of what a wrapper wrote to its stdout. Commands from the driver
+ * are read and thrown away.
+ *
+ * Usage: ieapspect-wrapper-loopback [-n REPEAT] [-r BYTES_PER_SECOND]
+ *                                   [--ring FD NOTIFY_FD] FILE
+ * REPEAT 0 replays the file forever, the rate defaults to no limit.
+ */
+
+#include <errno.h>
+#include <fcntl.h>
+#include <stdbool.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+
+#include "shmring.h"
+
+#define CHUNK_SIZE 0x10000
+
+static double now(void)
+{
+	struct timespec ts;
+
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+	return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+/* Returns false once stdin got closed */
+static bool drain_stdin(void)
+{
+	uint8_t buf[1024];
+	ssize_t ret;
+
+	while ((ret = read(STDIN_FILENO, buf, sizeof(buf))) > 0)
+		;
+	return ret < 0 && errno == EAGAIN;
+}
+
+int main(int argc, char *argv[])
+{
+	struct shmring ringbuf;
+	struct shmring *ring;
+	static uint8_t buf[CHUNK_SIZE];
+	const char *fname = NULL;
+	long repeat = 1;
+	double rate = 0;
+	double start;
+	uint64_t sent = 0;
+	size_t ret;
+	long i;
+	FILE *fil;
+
+	ring = shmring_from_args(argc, argv, &ringbuf);
+	for (i = 1; i < argc; i++) {
+		if (strcmp(argv[i], "--ring") == 0)
+			i += 2;
+		else if (strcmp(argv[i], "-n") == 0 && i + 1 < argc)
+			repeat = atol(argv[++i]);
+		else if (strcmp(argv[i], "-r") == 0 && i + 1 < argc)
+			rate = atof(argv[++i]);
+		else
+			fname = argv[i];
+	}
+	if (fname == NULL) {
+		fprintf(stderr, "Usage: %s [-n REPEAT] [-r BYTES_PER_SECOND] "
+				"[--ring FD NOTIFY_FD] FILE\n", argv[0]);
+		exit(EXIT_FAILURE);
+	}
+	fil = fopen(fname, "rb");
+	if (fil == NULL) {
+		perror("Failed to open the recording");
+		exit(EXIT_FAILURE);
+	}
+
+	fcntl(STDIN_FILENO, F_SETFL, O_NONBLOCK);
+	start = now();
+	for (i = 0; repeat == 0 || i < repeat; i++) {
+		rewind(fil);
+		while ((ret = fread(buf, 1, sizeof(buf), fil)) > 0) {
+			if (!drain_stdin())
+				goto out;
+			if (output_data(ring, buf, ret) < 0)
+				goto out;
+			sent += ret;
+			if (rate > 0 && sent / rate > now() - start)
+				usleep((sent / rate - (now() - start)) * 1e6);
+		}
+	}
+
+out:
+	fclose(fil);
+	if (ring != NULL)
+		shmring_close(ring);
+	return 0;
+}
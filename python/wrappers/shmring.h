@@ -0,0 +1,176 @@
+
+#ifndef _SHMRING_H_
+#define _SHMRING_H_
+
+/*
+ * Single producer single consumer byte ring in a shared mapping, the
+ * producer being the wrapper and the consumer ieapspect.shmring.RingReader.
+ *
+ * |-------|------|-------|-------|---------
+ * | magic | size | head  | tail  | data...
+ * |-------|------|-------|-------|---------
+ *   0       8      64      128     256
+ *
+ * head and tail are u64 byte counts which only ever grow, data[x % size] is
+ * where byte x goes. Each of them lives on a cache line of its own. After
+ * every write, the producer writes a byte into the notification pipe, so
+ * that the consumer does not have to poll. Closing the pipe (e.g. by
+ * exiting) tells the consumer that no more data are coming.
+ */
+
+#include <errno.h>
+#include <stdatomic.h>
+#include <stdbool.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#define SHMRING_MAGIC "IEAPRNG1"
+#define SHMRING_OFF_SIZE 8
+#define SHMRING_OFF_HEAD 64
+#define SHMRING_OFF_TAIL 128
+#define SHMRING_OFF_DATA 256
+
+struct shmring {
+	uint8_t *map;
+	size_t maplen;
+	uint64_t size;
+	_Atomic uint64_t *head;
+	_Atomic uint64_t *tail;
+	uint8_t *data;
+	int notify_fd;
+};
+
+static inline int shmring_open(struct shmring *ring, int fd, int notify_fd)
+{
+	struct stat st;
+
+	if (fstat(fd, &st) < 0)
+		return -1;
+	if (st.st_size < SHMRING_OFF_DATA) {
+		errno = EINVAL;
+		return -1;
+	}
+	ring->maplen = st.st_size;
+	ring->map = mmap(NULL, ring->maplen, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+	if (ring->map == MAP_FAILED)
+		return -1;
+	if (memcmp(ring->map, SHMRING_MAGIC, 8) != 0) {
+		munmap(ring->map, ring->maplen);
+		errno = EINVAL;
+		return -1;
+	}
+	memcpy(&ring->size, ring->map + SHMRING_OFF_SIZE, sizeof(ring->size));
+	if (ring->size == 0 || ring->size > ring->maplen - SHMRING_OFF_DATA) {
+		munmap(ring->map, ring->maplen);
+		errno = EINVAL;
+		return -1;
+	}
+	ring->head = (_Atomic uint64_t *)(ring->map + SHMRING_OFF_HEAD);
+	ring->tail = (_Atomic uint64_t *)(ring->map + SHMRING_OFF_TAIL);
+	ring->data = ring->map + SHMRING_OFF_DATA;
+	ring->notify_fd = notify_fd;
+	return 0;
+}
+
+static inline int shmring_notify(struct shmring *ring)
+{
+	uint8_t b = 0;
+
+	/* The pipe being full means that a wakeup is pending anyway */
+	if (write(ring->notify_fd, &b, 1) < 0 && errno != EAGAIN)
+		return -1;
+	return 0;
+}
+
+/*
+ * Copies len bytes into the ring, waiting for the consumer while the ring is
+ * full. Returns -1 if the consumer went away in the meantime.
+ */
+static inline int shmring_write(struct shmring *ring, const uint8_t *buf, size_t len)
+{
+	uint64_t head = atomic_load_explicit(ring->head, memory_order_relaxed);
+	uint64_t tail;
+	uint64_t n;
+	uint64_t off;
+	uint64_t first;
+	bool notified = true;
+
+	while (len > 0) {
+		tail = atomic_load_explicit(ring->tail, memory_order_acquire);
+		n = ring->size - (head - tail);
+		if (n == 0) {
+			/* There is nobody to wake us up, the device flow control
+			 * holds the data back in the meantime */
+			if (!notified && shmring_notify(ring) < 0)
+				return -1;
+			notified = true;
+			if (getppid() == 1)
+				return -1;
+			usleep(500);
+			continue;
+		}
+		if (n > len)
+			n = len;
+		off = head % ring->size;
+		first = n < ring->size - off ? n : ring->size - off;
+		memcpy(ring->data + off, buf, first);
+		memcpy(ring->data, buf + first, n - first);
+		head += n;
+		buf += n;
+		len -= n;
+		atomic_store_explicit(ring->head, head, memory_order_release);
+		notified = false;
+	}
+	return notified ? 0 : shmring_notify(ring);
+}
+
+static inline void shmring_close(struct shmring *ring)
+{
+	munmap(ring->map, ring->maplen);
+	close(ring->notify_fd);
+}
+
+/*
+ * Picks the transport from the command line, "--ring FD NOTIFY_FD" makes
+ * the wrapper write into the ring mapped from FD instead of stdout. Returns
+ * NULL for stdout, exits on errors.
+ */
+static inline struct shmring *shmring_from_args(int argc, char *argv[],
+												 struct shmring *ring)
+{
+	int i;
+
+	for (i = 1; i < argc; i++) {
+		if (strcmp(argv[i], "--ring") != 0)
+			continue;
+		if (i + 2 >= argc) {
+			fprintf(stderr, "Usage: %s [--ring FD NOTIFY_FD]\n", argv[0]);
+			exit(EXIT_FAILURE);
+		}
+		if (shmring_open(ring, atoi(argv[i + 1]), atoi(argv[i + 2])) < 0) {
+			perror("Failed to map the ring");
+			exit(EXIT_FAILURE);
+		}
+		return ring;
+	}
+	return NULL;
+}
+
+/*
+ * Hands the data received from the device over to the driver.
+ */
+static inline int output_data(struct shmring *ring, const uint8_t *buf, size_t len)
+{
+	if (ring != NULL)
+		return shmring_write(ring, buf, len);
+	fwrite(buf, 1, len, stdout);
+	fflush(stdout);
+	return ferror(stdout) ? -1 : 0;
+}
+
+#endif
@@ -105,13 +105,17 @@ close:
 int main(int argc, char *argv[])
 {
 	struct ftdi_context ftdi;
+	struct shmring ringbuf;
+	struct shmring *ring;
 	int ret;
 
+	ring = shmring_from_args(argc, argv, &ringbuf);
+
 	ret = spectrig_connect(&ftdi);
 	if (ret < 0) {
 		perror("spectrig_connect failed");
 		exit(EXIT_FAILURE);
 	}
 
-	enter_rw_loop(&ftdi);
+	enter_rw_loop(&ftdi, ring);
 }
@@ -10,6 +10,8 @@
 #include <string.h>
 #include <sys/epoll.h>
 
+#include "shmring.h"
+
 #define ARRAY_SIZE(x) (sizeof(x) / sizeof(x[0]))
 #define msleep(x) usleep((x) * 1000)
 
@@ -52,7 +54,7 @@ static inline int open_by_desc_prefix(struct ftdi_context *ftdi,
 	return match ? ftdi_usb_open_dev(ftdi, list->dev) : -1;
 }
 
-static inline void enter_rw_loop(struct ftdi_context *ftdi)
+static inline void enter_rw_loop(struct ftdi_context *ftdi, struct shmring *ring)
 {
 	uint8_t buf[10000];
 	int ret;
@@ -64,10 +66,8 @@ static inline void enter_rw_loop(struct ftdi_context *ftdi)
 		 * This should be possible by using libusb directly.
 		 * */
 		ret = ftdi_read_data(ftdi, buf, sizeof(buf));
-		if (ret > 0) {
-			fwrite(buf, 1, ret, stdout);
-			fflush(stdout);
-		}
+		if (ret > 0 && output_data(ring, buf, ret) < 0)
+			break;
 		ret = 1;
 		if (ret > 0) {
 			ret = fread(buf, 1, sizeof(buf), stdin);
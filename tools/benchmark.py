@@ -0,0 +1,589 @@
+#! /usr/bin/env python3
+#
+# Offline benchmarks of the hot paths of the drivers and the web server.
+# Synthetic byte streams are fed through in-memory transports, so no hardware
+# is needed. The wrapper transports are only measured if the loopback wrapper
+# is built (make -C python/wrappers ieapspect-wrapper-loopback). Usage:
+#
+#   ./benchmark.py -o results.json                   # run everything
+#   ./benchmark.py -k serspect -k dm100              # only some benchmarks
+#   ./benchmark.py -b baseline.json -o results.json  # compare, exit 1 on regressions
+
+import argparse
+import asyncio
+import datetime
+import importlib.machinery
+import importlib.util
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+TOPDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python")
+sys.path.insert(0, TOPDIR)
+
+import numpy as np
+from ieapspect import DM100, DummySpect, EventBatch, HistFile, SIPOSSpect, SerSpect, Spectrig
+from ieapspect import stream
+from ieapspect.emulator import SerSpectEmulator, SIPOSEmulator
+from ieapspect.shmring import RingReader
+from ieapspect.spectra import SpectrumModel
+
+parser = argparse.ArgumentParser(
+    prog = "benchmark.py"
+)
+parser.add_argument(
+    "-k", "--keyword",
+    help = "Only run benchmarks whose name contains this, can be given multiple times",
+    action = "append"
+)
+parser.add_argument(
+    "-n", "--events",
+    help = "Amount of events fed through each driver",
+    type = int,
+    default = 200000
+)
+parser.add_argument(
+    "-r", "--repeat",
+    help = "Run every benchmark this many times and keep the best run",
+    type = int,
+    default = 3
+)
+parser.add_argument(
+    "-c", "--clients",
+    help = "Amounts of simulated WebSocket clients",
+    type = int,
+    nargs = "+",
+    default = [1, 10, 50]
+)
+parser.add_argument(
+    "-o", "--output",
+    help = "Write the results as JSON into this file"
+)
+parser.add_argument(
+    "-b", "--baseline",
+    help = "Compare the results against this JSON file"
+)
+parser.add_argument(
+    "-t", "--tolerance",
+    help = "Relative change of a metric which is considered a regression",
+    type = float,
+    default = 0.15
+)
+parser.add_argument(
+    "--seed",
+    type = int,
+    default = 1
+)
+
+# Metric name -> True if higher is better
+METRICS = {
+    "events_per_s": True,
+    "cpu_us_per_event": False,
+    "latency_p50_ms": False,
+    "latency_p99_ms": False,
+}
+
+CHUNK_SIZE = 4096
+
+
+class FakeTransport:
+    """
+    Stands in for the serial and pipe transports, swallows everything.
+    """
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def close(self):
+        pass
+
+    def get_returncode(self):
+        return None
+
+
+class FakeProcess:
+
+    def __init__(self):
+        self.stdin = FakeTransport()
+        self.stdout = asyncio.StreamReader(limit=1 << 30)
+        self.returncode = None
+
+
+class FakeWebSocket:
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send_str(self, data):
+        self.sent += len(data)
+        # A real socket write yields to the event loop at least this often
+        await asyncio.sleep(0)
+
+    async def send_bytes(self, data):
+        self.sent += len(data)
+        await asyncio.sleep(0)
+
+
+def chunked(data, size=CHUNK_SIZE):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+async def feed(chunks, deliver):
+    for chunk in chunks:
+        deliver(chunk)
+        await asyncio.sleep(0)
+
+
+async def consume_batches(spect, nevents):
+    n = 0
+    async for batch in spect.batches():
+        n += len(batch.values)
+        if n >= nevents:
+            return n
+
+
+async def consume_events(spect, nevents):
+    for _ in range(nevents):
+        await spect.next_event()
+    return nevents
+
+
+def run_timed(coro_fn):
+    """
+    Runs coro_fn() in a fresh event loop, returns its result and the wall
+    clock and CPU time it took.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        ret = loop.run_until_complete(coro_fn())
+        return ret, time.perf_counter() - wall, time.process_time() - cpu
+    finally:
+        loop.close()
+
+
+def throughput(n, wall, cpu, **extra):
+    ret = {
+        "events": n,
+        "wall_s": wall,
+        "events_per_s": n / wall,
+        "cpu_us_per_event": cpu / n * 1e6,
+    }
+    ret.update(extra)
+    return ret
+
+
+def values(args, n, channels=4096):
+    rng = np.random.default_rng(args.seed)
+    return SpectrumModel(channels).sample(n, rng)
+
+
+# SerSpect
+
+def serspect_stream(args, n):
+    em = SerSpectEmulator(seed=args.seed)
+    data = em.encode_events(values(args, n)).tobytes()
+    # A GETRESP every ~64 kB, as if the web UI was polling the config
+    getresp = bytes([SerSpect.PACK_GETRESP, SerSpect.PROP_THRESH, 50, 0])
+    parts = chunked(data, 65535 * 3)
+    return getresp.join(parts)
+
+
+def bench_serspect(args, consume):
+    n = args.events // (10 if consume is consume_events else 1)
+    chunks = chunked(serspect_stream(args, n))
+
+    async def run():
+        spect = SerSpect()
+        spect.connection_made(FakeTransport())
+        recv = asyncio.ensure_future(spect._recv_loop())
+        ret, _ = await asyncio.gather(consume(spect, n),
+                                      feed(chunks, spect.data_received))
+        recv.cancel()
+        return ret
+
+    return throughput(*run_timed(run))
+
+
+def bench_serspect_recv_packet(args):
+    # The generic packet path, used for everything but EVENT packets
+    n = args.events // 10
+    chunks = chunked(serspect_stream(args, n))
+
+    async def run():
+        spect = SerSpect()
+        spect.connection_made(FakeTransport())
+        for c in chunks:
+            spect.data_received(c)
+        cnt = 0
+        while cnt < n:
+            if (await spect.recv_packet())[0] == SerSpect.PACK_EVENT:
+                cnt += 1
+        return cnt
+
+    return throughput(*run_timed(run))
+
+
+# SIPOSSpect
+
+def bench_sipos(args, consume):
+    n = args.events // (10 if consume is consume_events else 1)
+    em = SIPOSEmulator(seed=args.seed)
+    chunks = chunked(em.encode_events(values(args, n)).tobytes())
+
+    async def run():
+        spect = SIPOSSpect()
+        spect.connection_made(FakeTransport())
+        ret, _ = await asyncio.gather(consume(spect, n),
+                                      feed(chunks, spect.data_received))
+        return ret
+
+    return throughput(*run_timed(run))
+
+
+# DM100
+
+DM100_SAMPLES = {
+    DM100.MODE_SAMPLE: 1,
+    DM100.MODE_SAMPLE_TOT: 2,
+    DM100.MODE_WAVEFORM: 32,
+}
+
+
+def dm100_stream(args, n, mode):
+    dln = DM100_SAMPLES[mode]
+    rng = np.random.default_rng(args.seed)
+    # length, samples, 3 time words, checksum
+    words = np.zeros((n, 1 + dln + 3 + 1), dtype=np.uint64)
+    words[:, 0] = dln
+    words[:, 1:1 + dln] = rng.integers(0, 1 << 14, (n, dln))
+    ts = np.arange(n, dtype=np.uint64) * 1000
+    words[:, 1 + dln] = (ts >> 32) & 0xffff
+    words[:, 2 + dln] = (ts >> 16) & 0xffff
+    words[:, 3 + dln] = ts & 0xffff
+    words[:, -1] = words[:, :-1].sum(axis=1) & 0xffff
+    return words.astype(">u2").tobytes()
+
+
+def bench_dm100(args, mode, consume):
+    n = args.events // (10 if consume is consume_events else 1)
+    if mode == DM100.MODE_WAVEFORM:
+        n //= 4
+    chunks = chunked(dm100_stream(args, n, mode), DM100.READ_SIZE)
+
+    async def run():
+        proc = FakeProcess()
+        spect = DM100(proc)
+        spect.packcfg = 0x00
+        spect.maskcfg = 0x00
+        spect.modecfg = 0x00
+        spect.bus8 = True
+        spect.addtime = True
+        spect.addchecksum = True
+        spect.mode = mode
+        ret, _ = await asyncio.gather(consume(spect, n),
+                                      feed(chunks, proc.stdout.feed_data))
+        return ret
+
+    return throughput(*run_timed(run))
+
+
+# Spectrig
+
+def spectrig_stream(args, n):
+    rng = np.random.default_rng(args.seed)
+    frames = np.zeros((n, Spectrig.FRAME_LENGTH), dtype=np.uint8)
+    frames[:, 0] = Spectrig.PACKET_RESP_HEADER
+    frames[:, 1] = Spectrig.PACK_TYPE_SPECTRO
+    samples = rng.integers(0, 4096, (n, 256)).astype(">u2")
+    frames[:, 3:515] = samples.view(np.uint8)
+    frames[:, 515] = 1
+    frames[:, 516] = 0
+    frames[:, -1] = Spectrig.PACKET_RESP_TAIL
+    data = frames.tobytes()
+    # Lose a few bytes every now and then, so that the resync path runs too
+    cuts = sorted(rng.integers(0, len(data), max(n // 1000, 1)))
+    return b"".join(data[a + 1:b] for a, b in zip([-1] + cuts, cuts + [len(data)]))
+
+
+def bench_spectrig(args, consume):
+    n = args.events // (100 if consume is consume_events else 10)
+    chunks = chunked(spectrig_stream(args, n), 1 << 16)
+    # Frames broken by the cuts never arrive, count what does get through
+    counter = Spectrig()
+    for c in chunks:
+        counter.pipe_data_received(1, c)
+    expected = sum(len(d[2]) for d in counter._decoded)
+
+    async def run():
+        spect = Spectrig()
+        spect.pipe = FakeTransport()
+        ret, _ = await asyncio.gather(
+            consume(spect, expected),
+            feed(chunks, lambda c: spect.pipe_data_received(1, c)))
+        return ret
+
+    return throughput(*run_timed(run))
+
+
+# Wrapper transports, replayed by the loopback wrapper if it is built
+
+LOOPBACK = os.path.join(TOPDIR, "wrappers", "ieapspect-wrapper-loopback")
+
+
+async def consume_until_eof(spect):
+    n = 0
+    try:
+        async for batch in spect.batches():
+            n += len(batch.values)
+    except EOFError:
+        pass
+    return n
+
+
+def bench_transport(args, driver, ring_size):
+    if driver is DM100:
+        data = dm100_stream(args, args.events, DM100.MODE_SAMPLE)
+    else:
+        data = spectrig_stream(args, args.events // 10)
+    with tempfile.NamedTemporaryFile(suffix=".rec") as rec:
+        rec.write(data)
+        rec.flush()
+
+        async def run():
+            # Like connect(), minus the device initialization
+            ring = RingReader(ring_size) if ring_size else None
+            cmd = [LOOPBACK, rec.name] + (ring.wrapper_args() if ring else [])
+            kwargs = {"stdout": subprocess.DEVNULL if ring else subprocess.PIPE,
+                      "pass_fds": ring.pass_fds if ring else ()}
+            if driver is DM100:
+                proc = await asyncio.create_subprocess_exec(
+                    *cmd, stdin=subprocess.PIPE, **kwargs)
+                spect = DM100(proc, ring)
+                spect.packcfg = 0x00
+                spect.maskcfg = 0x00
+                spect.modecfg = 0x00
+                spect.bus8 = True
+                spect.addtime = True
+                spect.addchecksum = True
+                spect.mode = DM100.MODE_SAMPLE
+            else:
+                trans, spect = await asyncio.get_event_loop().subprocess_exec(
+                    lambda: Spectrig(ring), *cmd, **kwargs)
+                spect.pipe = trans.get_pipe_transport(0)
+                spect.trans = trans
+                if ring:
+                    spect._ring_task = asyncio.ensure_future(spect._ring_loop())
+            if ring:
+                ring.started()
+            try:
+                return await consume_until_eof(spect)
+            finally:
+                spect.close()
+
+        return throughput(*run_timed(run))
+
+
+# HistFile
+
+def bench_histfile(args, channels, binary):
+    rng = np.random.default_rng(args.seed)
+    hfil = HistFile(rng.integers(0, 1 << 20, channels))
+    hfil.from_ = datetime.datetime.fromtimestamp(1500000000)
+    hfil.to = datetime.datetime.fromtimestamp(1500003600)
+    loads = 200
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, "hist")
+        hfil.save(fname, binary=binary)
+
+        async def run():
+            for _ in range(loads):
+                # Touch the data, a memmap is not read otherwise
+                int(HistFile.load_file(fname).vals.sum())
+            return loads * channels
+
+        # An "event" is a histogram channel here
+        return throughput(*run_timed(run))
+
+
+# Event streams of the command line tools
+
+def bench_stream(args, format):
+    n = min(args.events, 100000)
+    batch = 4096
+    rng = np.random.default_rng(args.seed)
+    # DM100 waveforms, the worst case for the JSON formats
+    waveforms = rng.integers(0, 1 << 14, (n, 32)).astype(np.uint16)
+    batches = [EventBatch(values=w.max(axis=1),
+                          timestamps=np.arange(i, i + len(w), dtype=np.uint64),
+                          tot=None, waveforms=w)
+               for i, w in ((i, waveforms[i:i + batch]) for i in range(0, n, batch))]
+
+    async def run():
+        out = io.BytesIO()
+        writer = stream.StreamWriter(out, format)
+        for b in batches:
+            writer.write(b)
+        out.seek(0)
+        return sum(len(b.values) for b in stream.read_batches(out))
+
+    return throughput(*run_timed(run))
+
+
+# WebApp
+
+def load_webapp():
+    fname = os.path.join(TOPDIR, "bin", "ieapspect-web")
+    loader = importlib.machinery.SourceFileLoader("ieapspect_web", fname)
+    spec = importlib.util.spec_from_loader("ieapspect_web", loader)
+    mod = importlib.util.module_from_spec(spec)
+    loader.exec_module(mod)
+    return mod
+
+
+def bench_webapp(args, nclients, protocol):
+    web = load_webapp()
+    frames = 200
+    # 50 ms worth of events at 200 kHz per update frame
+    per_frame = 10000
+    vals = values(args, frames * per_frame).reshape(frames, per_frame)
+    latencies = []
+
+    async def run():
+        # Not added through add_device, which would start acquiring
+        dev = web.Device(web.WebApp(), "bench", DummySpect(channels=4096))
+        sockets = [FakeWebSocket() for _ in range(nclients)]
+        dev.clients = [web.Client(ws, dev, protocol=protocol) for ws in sockets]
+        for frame in vals:
+            dev._pending.append(dev.histogram.add(frame))
+            t = time.perf_counter()
+            dev.flush_events()
+            while any(c._outqueue for c in dev.clients):
+                await asyncio.sleep(0)
+            latencies.append(time.perf_counter() - t)
+        for c in dev.clients:
+            c.close()
+        return frames * per_frame
+
+    n, wall, cpu = run_timed(run)
+    latencies.sort()
+    return throughput(n, wall, cpu,
+                      latency_p50_ms=statistics.median(latencies) * 1e3,
+                      latency_p99_ms=latencies[int(len(latencies) * 0.99)] * 1e3)
+
+
+def benchmarks(args):
+    yield "serspect.batches", lambda: bench_serspect(args, consume_batches)
+    yield "serspect.next_event", lambda: bench_serspect(args, consume_events)
+    yield "serspect.recv_packet", lambda: bench_serspect_recv_packet(args)
+    yield "sipos.batches", lambda: bench_sipos(args, consume_batches)
+    yield "sipos.next_event", lambda: bench_sipos(args, consume_events)
+    for mode, name in [(DM100.MODE_SAMPLE, "sample"),
+                       (DM100.MODE_SAMPLE_TOT, "sample_tot"),
+                       (DM100.MODE_WAVEFORM, "waveform")]:
+        yield ("dm100.%s.batches" % name,
+               lambda mode=mode: bench_dm100(args, mode, consume_batches))
+        yield ("dm100.%s.next_event" % name,
+               lambda mode=mode: bench_dm100(args, mode, consume_events))
+    yield "spectrig.batches", lambda: bench_spectrig(args, consume_batches)
+    yield "spectrig.next_event", lambda: bench_spectrig(args, consume_events)
+    if os.path.exists(LOOPBACK):
+        for driver in [DM100, Spectrig]:
+            for ring_size in [None, 1 << 22]:
+                yield ("%s.loopback.%s" % (driver.__name__.lower(),
+                                           "ring" if ring_size else "pipe"),
+                       lambda driver=driver, ring_size=ring_size:
+                           bench_transport(args, driver, ring_size))
+    for channels in [4096, 65536]:
+        for binary in [False, True]:
+            yield ("histfile.%s.%d" % ("binary" if binary else "text", channels),
+                   lambda channels=channels, binary=binary:
+                       bench_histfile(args, channels, binary))
+    for format in stream.FORMATS:
+        yield "stream.%s" % format, lambda format=format: bench_stream(args, format)
+    for nclients in args.clients:
+        # The plain json protocol sends a message per event, it is only kept for
+        # old clients and would take ages here
+        for protocol in ["json-batched", "binary"]:
+            yield ("webapp.%s.%d_clients" % (protocol, nclients),
+                   lambda nclients=nclients, protocol=protocol:
+                       bench_webapp(args, nclients, protocol))
+
+
+def best(runs):
+    return max(runs, key=lambda r: r["events_per_s"])
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the relative changes against the baseline, returns the list of
+    regressed (benchmark, metric) pairs.
+    """
+    regressions = []
+    for name, res in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric, higher_better in METRICS.items():
+            if res.get(metric) is None or not base.get(metric):
+                continue
+            change = res[metric] / base[metric] - 1
+            worse = -change if higher_better else change
+            mark = ""
+            if worse > tolerance:
+                mark = "  REGRESSION"
+                regressions.append((name, metric))
+            print("%-32s %-18s %12.4g -> %12.4g  %+7.1f%%%s" %
+                  (name, metric, base[metric], res[metric], change * 100, mark))
+    return regressions
+
+
+def main():
+    args = parser.parse_args()
+
+    results = {}
+    for name, fn in benchmarks(args):
+        if args.keyword and not any(k in name for k in args.keyword):
+            continue
+        res = best([fn() for _ in range(args.repeat)])
+        res = {k: v for k, v in res.items() if v is not None}
+        results[name] = res
+        line = "%-32s %12.0f ev/s %9.3f us/ev" % (name, res["events_per_s"],
+                                                  res["cpu_us_per_event"])
+        if "latency_p99_ms" in res:
+            line += "  p50 %.2f ms  p99 %.2f ms" % (res["latency_p50_ms"],
+                                                     res["latency_p99_ms"])
+        print(line, flush=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "created": datetime.datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "machine": platform.machine(),
+                "events": args.events,
+                "results": results,
+            }, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        print()
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\n%d regressions" % len(regressions))
+            sys.exit(1)
+
+main()